@@ -133,6 +133,7 @@ setup(
     entry_points={
         'console_scripts': [
             'streamcorpus_dump = streamcorpus.dump:main',
+            'streamcorpus_zstd_dictionary = streamcorpus.zstd_dictionary:main',
         ]
     },
     install_requires=[
@@ -148,9 +149,23 @@ setup(
     extras_require = {
         'snappy': [
             'python-snappy',
+            'crc32c',
         ],
         'xz': [
             'backports.lzma',
         ],
+        'zstd': [
+            'zstandard',
+        ],
+        'lz4': [
+            'lz4',
+        ],
+        'neardup': [
+            'numpy',
+        ],
+        'columns': [
+            'numpy',
+            'pyarrow',
+        ],
     },
 )
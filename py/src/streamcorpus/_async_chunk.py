@@ -0,0 +1,301 @@
+#!/usr/bin/env python
+'''
+Non-blocking reading and writing of chunks for event loops.
+
+An AsyncChunk runs every blocking operation of a Chunk, opening the
+file, reading and decompressing, serializing, compressing and writing,
+on the threads of a shared ChunkIOPool, and returns a ChunkFuture for
+each.  The futures have the same methods as those of
+concurrent.futures, including add_done_callback, so an event loop can
+resume its coroutine when one is done, e.g. by passing the result to
+the loop's thread-safe callback scheduling.  One loop can thus drive
+many chunk streams at once, while the pool bounds how many threads do
+the work.
+
+Operations on one AsyncChunk run in the order they were started, one
+at a time; the pool moves between chunks after every operation so
+that no stream starves the others.
+
+This software is released under an MIT/X11 open source license.
+
+Copyright 2012-2015 Diffeo, Inc.
+'''
+from __future__ import absolute_import
+import collections
+import itertools
+import logging
+import Queue
+import sys
+import threading
+
+from streamcorpus._chunk import Chunk
+
+logger = logging.getLogger('streamcorpus')
+
+
+class ChunkFuture(object):
+    '''
+    Result of an operation of an AsyncChunk, with the methods of
+    concurrent.futures.Future that a caller waits on.  Callbacks
+    added with add_done_callback run on the pool thread that finished
+    the operation, or right away if it is already done.
+    '''
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._event = threading.Event()
+        self._result = None
+        self._exc_info = None
+        self._callbacks = []
+
+    def _set(self, result=None, exc_info=None):
+        with self._lock:
+            self._result = result
+            self._exc_info = exc_info
+            self._event.set()
+            callbacks, self._callbacks = self._callbacks, None
+        for callback in callbacks:
+            self._call(callback)
+
+    def _call(self, callback):
+        try:
+            callback(self)
+        except Exception:
+            logger.exception('ChunkFuture callback failed')
+
+    def add_done_callback(self, callback):
+        'call `callback(self)` once this future is done'
+        with self._lock:
+            if self._callbacks is not None:
+                self._callbacks.append(callback)
+                return
+        self._call(callback)
+
+    def done(self):
+        return self._event.is_set()
+
+    def _wait(self, timeout):
+        if not self._event.wait(timeout):
+            raise RuntimeError('ChunkFuture not done after %r seconds' % timeout)
+
+    def result(self, timeout=None):
+        '''wait for the operation, and return its result or raise its
+        exception
+        '''
+        self._wait(timeout)
+        if self._exc_info is not None:
+            exc_type, exc, tb = self._exc_info
+            raise exc_type, exc, tb
+        return self._result
+
+    def exception(self, timeout=None):
+        'wait for the operation, and return its exception or None'
+        self._wait(timeout)
+        return self._exc_info and self._exc_info[1]
+
+
+class ChunkIOPool(object):
+    '''
+    Threads that run the operations of any number of AsyncChunks.
+    `workers` is how many operations run at once, and so how many
+    chunks are read, decompressed, or written in parallel.
+    '''
+    def __init__(self, workers=4):
+        self._chunks = Queue.Queue()
+        self._threads = []
+        for i in range(workers):
+            thread = threading.Thread(target=self._run, name='ChunkIOPool-%d' % i)
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def _run(self):
+        while True:
+            chunk = self._chunks.get()
+            if chunk is None:
+                return
+            chunk._run_one()
+
+    def _schedule(self, chunk):
+        self._chunks.put(chunk)
+
+    def close(self):
+        'stop the threads once they finish the operations already queued'
+        for thread in self._threads:
+            self._chunks.put(None)
+        for thread in self._threads:
+            thread.join()
+
+
+_default_pool = None
+_default_pool_lock = threading.Lock()
+
+def default_pool():
+    'the ChunkIOPool used by AsyncChunks that are not given one'
+    global _default_pool
+    with _default_pool_lock:
+        if _default_pool is None:
+            _default_pool = ChunkIOPool()
+        return _default_pool
+
+
+class AsyncChunk(object):
+    '''
+    A Chunk whose blocking operations run on the threads of `pool`,
+    each returning a ChunkFuture.  All other arguments are passed to
+    Chunk, which is opened on the pool too and is available as
+    `chunk` once any operation is done.
+
+    Read with read_batch, whose future is a list of at most
+    `batch_size` messages, or [] at the end.  At most `max_pending`
+    batches are read ahead of the caller, which bounds memory.
+
+    Write with add, whose future is done once the message is written.
+    Messages added while earlier ones are being written are collected
+    into batches of up to `batch_size` for Chunk.add_many.  At most
+    `max_pending_writes` batches wait for the pool; once that many do,
+    add returns a future that is done only after a slot frees up and
+    its message is written, so a producer that waits on its adds is
+    held back to the pace of the pool.  close, and flush, are done
+    after every earlier add.
+
+    Call the methods of one AsyncChunk from one thread, e.g. the event
+    loop's.
+    '''
+    def __init__(self, *args, **kwargs):
+        self.pool = kwargs.pop('pool', None) or default_pool()
+        self.batch_size = kwargs.pop('batch_size', 100)
+        self.max_pending = kwargs.pop('max_pending', 4)
+        self.max_pending_writes = kwargs.pop('max_pending_writes', 4)
+        self.chunk = None
+        self._open_exc_info = None
+        self._lock = threading.Lock()
+        self._ops = collections.deque()
+        self._scheduled = False
+        ## write batches given to the pool and not yet done, and the
+        ## operations held back until one is
+        self._writes = 0
+        self._held = collections.deque()
+        self._reads = collections.deque()
+        self._messages = None
+        ## messages added but not yet being written, and their future
+        self._batch = None
+        self._batch_future = None
+        self._submit(self._open, args, kwargs)
+
+    def _submit(self, func, *args):
+        future = ChunkFuture()
+        with self._lock:
+            if self._held or (func == self._write and
+                              self._writes >= self.max_pending_writes):
+                ## behind the writes held back, to keep the order
+                self._held.append((future, func, args))
+                return future
+            schedule = self._queue(future, func, args)
+        if schedule:
+            self.pool._schedule(self)
+        return future
+
+    def _queue(self, future, func, args):
+        '''add an operation for the pool, with the lock held, and return
+        whether this chunk needs to be scheduled
+        '''
+        if func == self._write:
+            self._writes += 1
+        self._ops.append((future, func, args))
+        if self._scheduled:
+            return False
+        self._scheduled = True
+        return True
+
+    def _release(self):
+        'queue the held operations that a finished write made room for'
+        while self._held:
+            future, func, args = self._held[0]
+            if func == self._write and self._writes >= self.max_pending_writes:
+                return
+            self._held.popleft()
+            self._queue(future, func, args)
+
+    def _run_one(self):
+        'called by the pool to run the next operation'
+        with self._lock:
+            future, func, args = self._ops.popleft()
+        try:
+            if self._open_exc_info is not None:
+                ## every operation fails as opening did
+                exc_type, exc, tb = self._open_exc_info
+                raise exc_type, exc, tb
+            result = func(*args)
+        except Exception:
+            exc_info = sys.exc_info()
+            if func == self._open:
+                self._open_exc_info = exc_info
+            future._set(exc_info=exc_info)
+        else:
+            future._set(result)
+        with self._lock:
+            if func == self._write:
+                self._writes -= 1
+                self._release()
+            if not self._ops:
+                self._scheduled = False
+                return
+        ## to the back of the line, behind other chunks
+        self.pool._schedule(self)
+
+    def _open(self, args, kwargs):
+        self.chunk = Chunk(*args, **kwargs)
+
+    def _read(self):
+        if self._messages is None:
+            self._messages = iter(self.chunk)
+        return list(itertools.islice(self._messages, self.batch_size))
+
+    def read_batch(self):
+        '''returns a ChunkFuture of the next list of at most
+        `batch_size` messages, which is empty at the end of the chunk
+        '''
+        while len(self._reads) < self.max_pending:
+            self._reads.append(self._submit(self._read))
+        return self._reads.popleft()
+
+    def _write(self, batch):
+        with self._lock:
+            ## later adds start a new batch
+            if self._batch is batch:
+                self._batch = None
+                self._batch_future = None
+        self.chunk.add_many(batch)
+        return len(batch)
+
+    def add(self, msg):
+        '''returns a ChunkFuture that is done once `msg` is written to
+        the chunk
+        '''
+        with self._lock:
+            if self._batch is not None and len(self._batch) < self.batch_size:
+                self._batch.append(msg)
+                return self._batch_future
+            batch = self._batch = [msg]
+        future = self._submit(self._write, batch)
+        with self._lock:
+            if self._batch is batch:
+                self._batch_future = future
+        return future
+
+    def _end_batch(self):
+        with self._lock:
+            self._batch = None
+            self._batch_future = None
+
+    def flush(self):
+        'returns a ChunkFuture that is done once earlier adds are flushed'
+        self._end_batch()
+        return self._submit(lambda: self.chunk.flush())
+
+    def close(self):
+        '''returns a ChunkFuture that is done once earlier adds are
+        written and the chunk is closed
+        '''
+        self._end_batch()
+        return self._submit(lambda: self.chunk.close())
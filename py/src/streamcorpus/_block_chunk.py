@@ -0,0 +1,357 @@
+#!/usr/bin/env python
+'''
+Provides a seekable, block-compressed container for Thrift messages.
+
+A plain `.sc.xz` chunk is a single compressed stream, so reading any
+message means decompressing everything before it.  A block chunk
+(`.scb`) instead compresses messages in independent blocks of at most
+`block_items` messages or `block_bytes` uncompressed bytes, and ends
+with a footer that records, for every block, its compressed offset and
+length, its offset in the uncompressed stream of messages, its message
+count, the stream_id of its first message, and the md5 of its
+uncompressed bytes.  Readers can then decompress only the blocks they
+need, and workers can split one large chunk by block ranges.
+
+Layout::
+
+    MAGIC | block 0 | block 1 | ... | footer (JSON) | footer length | END_MAGIC
+
+The concatenation of the uncompressed blocks is exactly the byte
+stream of an uncompressed `.sc` chunk, so md5_hexdigest and the offsets
+in an index sidecar mean the same thing for both formats.
+
+This software is released under an MIT/X11 open source license.
+
+Copyright 2012-2015 Diffeo, Inc.
+'''
+from __future__ import absolute_import
+
+import base64
+import bisect
+import collections
+import hashlib
+import json
+import logging
+import os
+import struct
+from cStringIO import StringIO
+
+from thrift.transport import TTransport
+
+from ._bloom import BloomFilter
+from ._chunk import Chunk, serialize, protocol, xz, new_digest, _digest_name
+from ._codecs import codecs
+from ._chunk_index import ChunkIndex, index_path_for
+from ._raw_messages import iter_raw_messages
+
+logger = logging.getLogger('streamcorpus')
+
+BLOCK_EXTENSION = '.scb'
+
+MAGIC = 'SCBLOCK1'
+END_MAGIC = 'SCBLKEND'
+_TRAILER = struct.Struct('<Q8s')
+
+BlockInfo = collections.namedtuple(
+    'BlockInfo', ['offset', 'length', 'raw_offset', 'raw_length',
+                  'count', 'first_stream_id', 'md5'])
+
+
+def _identity(data):
+    return data
+
+## block codecs: name --> (compress, decompress), for each of the
+## `codecs` that can be used here
+block_codecs = dict((name, (codec.compress, codec.decompress))
+                    for name, codec in codecs.items() if codec.available)
+block_codecs[''] = (_identity, _identity)
+
+
+class BlockChunk(Chunk):
+    '''
+    Chunk stored as independently compressed blocks with a footer
+    index.  `Chunk(path)` returns a BlockChunk for paths that end in
+    `.scb`.
+
+    In addition to the parameters of Chunk, BlockChunk accepts:
+
+    :param block_items: maximum number of messages in a block
+
+    :param block_bytes: maximum number of uncompressed bytes in a
+    block; a single message larger than this gets a block of its own.
+
+    :param codec: name of the block compression in `block_codecs`,
+    used when writing.  Readers use the codec named in the footer.
+    '''
+    def __init__(self, *args, **kwargs):
+        self.block_items = kwargs.pop('block_items', 1000)
+        self.block_bytes = kwargs.pop('block_bytes', 16 * 2**20)
+        self.codec = kwargs.pop('codec', 'xz' if xz is not None else '')
+        if self.codec not in block_codecs:
+            raise ValueError('Unrecognized block codec %r (known: %r)' % (
+                self.codec, block_codecs.keys()))
+        ## digest of the uncompressed stream of messages, which this
+        ## class computes instead of BaseChunk, since the file is
+        ## compressed block by block
+        digest_name = _digest_name(kwargs.pop('inline_md5', True))
+        kwargs['inline_md5'] = False
+        self._digest = None
+        self.blocks = []
+
+        ## state of the block being written
+        self._o_block = []
+        self._o_block_len = 0
+        self._o_block_first = None
+        self._o_offset = 0
+        self._o_raw_offset = 0
+
+        super(BlockChunk, self).__init__(*args, **kwargs)
+        self.digest_name = digest_name
+        self._reset_digest()
+        if self.mode == 'ab' and self.path is None:
+            raise ValueError('BlockChunk can only append to a path')
+
+        if self.mode == 'rb':
+            self._read_footer(self._i_chunk_fh)
+        elif self.mode == 'ab' and os.path.getsize(self.path):
+            ## like Chunk, hexdigest and len() cover only the
+            ## messages added by this writer
+            with open(self.path, 'rb') as fh:
+                footer_offset = self._read_footer(fh)
+            ## new blocks overwrite the old footer
+            self._o_chunk_fh.truncate(footer_offset)
+            self._o_offset = footer_offset
+            if self.blocks:
+                last = self.blocks[-1]
+                self._o_raw_offset = last.raw_offset + last.raw_length
+        else:
+            self._o_chunk_fh.write(MAGIC)
+            self._o_offset = len(MAGIC)
+
+    def _reset_digest(self):
+        if self.digest_name is not None:
+            self._digest = new_digest(self.digest_name)
+
+    def _update_digest(self, data):
+        if self._digest is not None:
+            self._digest.update(data)
+
+    def _read_footer(self, fh):
+        '''load self.blocks from the footer of the block chunk in `fh`, and
+        return the offset at which the footer starts
+        '''
+        fh.seek(0, os.SEEK_END)
+        size = fh.tell()
+        if size < len(MAGIC) + _TRAILER.size:
+            raise IOError('%s is too short to be a block chunk' % (self.path or fh))
+        fh.seek(size - _TRAILER.size)
+        footer_len, end_magic = _TRAILER.unpack(fh.read(_TRAILER.size))
+        if end_magic != END_MAGIC:
+            raise IOError('%s is not a block chunk, or was not closed' % (self.path or fh))
+        footer_offset = size - _TRAILER.size - footer_len
+        fh.seek(footer_offset)
+        footer = json.loads(fh.read(footer_len))
+        self.codec = footer['codec']
+        if self.codec not in block_codecs:
+            raise IOError('block codec %r is not available' % self.codec)
+        self.blocks = []
+        for block in footer['blocks']:
+            first_stream_id = block['first_stream_id']
+            if first_stream_id is not None:
+                first_stream_id = first_stream_id.encode('utf8')
+            self.blocks.append(BlockInfo(
+                block['offset'], block['length'], block['raw_offset'],
+                block['raw_length'], block['count'], first_stream_id,
+                block['md5'].encode('ascii')))
+        if 'bloom' in footer:
+            self._i_bloom = BloomFilter.from_string(base64.b64decode(footer['bloom']))
+        return footer_offset
+
+    @property
+    def block_md5s(self):
+        'md5 hexdigest of the uncompressed bytes of each block'
+        return [block.md5 for block in self.blocks]
+
+    def read_block_data(self, i):
+        '''returns the uncompressed bytes of the i-th block, after
+        checking them against the block's md5
+        '''
+        assert self._i_chunk_fh, 'cannot read blocks from a Chunk open for writing'
+        block = self.blocks[i]
+        self._i_chunk_fh.seek(block.offset)
+        data = block_codecs[self.codec][1](self._i_chunk_fh.read(block.length))
+        if hashlib.md5(data).hexdigest() != block.md5:
+            raise IOError('md5 mismatch in block %d of %s' % (i, self.path))
+        return data
+
+    def _iter_data(self, data, skip=0):
+        i_protocol = protocol(TTransport.TMemoryBuffer(data[skip:] if skip else data))
+        while 1:
+            try:
+                msg = self._read_msg(i_protocol)
+            except EOFError:
+                break
+            yield msg
+
+    def iter_blocks(self, start=0, stop=None):
+        '''iterate over the messages in blocks start <= i < stop,
+        decompressing only those blocks
+        '''
+        for i in range(len(self.blocks))[start:stop]:
+            for msg in self._iter_data(self.read_block_data(i)):
+                yield msg
+
+    def iter_raw(self):
+        '''
+        Iterator over the serialized bytes of each message, without
+        decoding them
+        '''
+        assert self._i_chunk_fh, 'cannot iterate over a Chunk open for writing'
+        self._reset_digest()
+        for i in range(len(self.blocks)):
+            data = self.read_block_data(i)
+            self._update_digest(data)
+            for blob in iter_raw_messages(StringIO(data)):
+                self._count += 1
+                yield blob
+
+    def read_msg_impl(self):
+        '''
+        Iterator over messages in the chunk, starting from the position
+        set by seek_to
+        '''
+        assert self._i_chunk_fh, 'cannot iterate over a Chunk open for writing'
+        start = 0
+        skip = 0
+        if self._i_start:
+            raw_offsets = [block.raw_offset for block in self.blocks]
+            start = max(bisect.bisect_right(raw_offsets, self._i_start) - 1, 0)
+            skip = self._i_start - raw_offsets[start] if self.blocks else 0
+        else:
+            ## only a full pass computes hexdigest
+            self._reset_digest()
+        for i in range(start, len(self.blocks)):
+            data = self.read_block_data(i)
+            if not self._i_start:
+                self._update_digest(data)
+            for msg in self._iter_data(data, skip):
+                yield msg
+            skip = 0
+
+    def _read_at(self, entry):
+        '''read the single message described by the IndexEntry `entry`,
+        decompressing only the block that contains it
+        '''
+        raw_offsets = [block.raw_offset for block in self.blocks]
+        i = bisect.bisect_right(raw_offsets, entry.offset) - 1
+        data = self.read_block_data(i)
+        start = entry.offset - self.blocks[i].raw_offset
+        blob = data[start:start + entry.length]
+        if len(blob) != entry.length:
+            raise IOError('block %d of %s does not hold index entry %r' % (
+                i, self.path, entry))
+        msg = self._read_msg(protocol(TTransport.TMemoryBuffer(blob)))
+        if self.read_wrapper is not None:
+            msg = self.read_wrapper(msg)
+        return msg
+
+    def _load_or_build_index(self):
+        index = ChunkIndex.load_path(index_path_for(self.path))
+        if index is None:
+            logger.info('building index of existing messages in %s', self.path)
+            index = ChunkIndex()
+            i_chunk = BlockChunk(path=self.path, mode='rb', message=self.message)
+            for i, block in enumerate(i_chunk.blocks):
+                block_index = ChunkIndex.build(
+                    StringIO(i_chunk.read_block_data(i)), self.message, protocol)
+                for entry in block_index:
+                    index.add(block.raw_offset + entry.offset, *entry[1:])
+        return index
+
+    def write_msg_impl(self, msg):
+        'add message instance to the current block'
+        assert self._o_chunk_fh is not None, 'cannot Chunk.add after Chunk.close'
+        self._check_type(msg)
+        self._write_blob(serialize(msg), msg)
+
+    def _write_blobs(self, blobs, msgs):
+        ## blocks are written whole when they fill up
+        for blob, msg in zip(blobs, msgs):
+            self._write_blob(blob, msg)
+        self._count += len(blobs)
+
+    def _write_blob(self, blob, msg=None):
+        '''add one serialized message to the current block; `msg` is
+        the message it came from, if known
+        '''
+        if self._o_block and (
+                len(self._o_block) >= self.block_items or
+                self._o_block_len + len(blob) > self.block_bytes):
+            self._flush_block()
+        if msg is None and (self._o_index is not None or
+                            self._o_bloom_keys is not None or not self._o_block):
+            msg = self._decode_ids(blob)
+        self._add_bloom_keys(msg)
+        if not self._o_block:
+            self._o_block_first = getattr(msg, 'stream_id', None)
+        if self._o_index is not None:
+            self._o_index.add(self._o_raw_offset + self._o_block_len, len(blob),
+                              getattr(msg, 'stream_id', None),
+                              getattr(msg, 'doc_id', None),
+                              getattr(msg, 'abs_url', None))
+        self._o_block.append(blob)
+        self._o_block_len += len(blob)
+
+    def _flush_block(self):
+        if not self._o_block:
+            return
+        data = ''.join(self._o_block)
+        self._update_digest(data)
+        cdata = block_codecs[self.codec][0](data)
+        self._o_chunk_fh.write(cdata)
+        self.blocks.append(BlockInfo(
+            self._o_offset, len(cdata), self._o_raw_offset, len(data),
+            len(self._o_block), self._o_block_first,
+            hashlib.md5(data).hexdigest()))
+        self._o_offset += len(cdata)
+        self._o_raw_offset += len(data)
+        self._o_block = []
+        self._o_block_len = 0
+        self._o_block_first = None
+
+    def flush(self):
+        '''write out the current block, so that it is in the file even if
+        the process dies before close; this ends the block early.
+        '''
+        if self._o_chunk_fh is not None:
+            self._flush_block()
+        super(BlockChunk, self).flush()
+
+    def close(self):
+        if self._o_chunk_fh is not None:
+            self._flush_block()
+            footer = dict(
+                codec=self.codec,
+                blocks=[block._asdict() for block in self.blocks],
+            )
+            if self._o_bloom_keys is not None:
+                ## in the footer rather than a sidecar
+                footer['bloom'] = base64.b64encode(self._build_bloom().to_string())
+            footer = json.dumps(footer)
+            self._o_chunk_fh.write(footer)
+            self._o_chunk_fh.write(_TRAILER.pack(len(footer), END_MAGIC))
+            if self._digest is not None:
+                self._hexdigest = self._digest.hexdigest()
+        super(BlockChunk, self).close()
+
+    @property
+    def hexdigest(self):
+        '''digest of the uncompressed stream of messages, as for a `.sc`
+        chunk.  For readers, only available after a full pass.
+        '''
+        if self._hexdigest:
+            return self._hexdigest
+        if self._digest is None:
+            return None
+        return self._digest.hexdigest()
+
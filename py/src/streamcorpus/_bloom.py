@@ -0,0 +1,149 @@
+#!/usr/bin/env python
+'''
+Bloom filter over byte string keys, for remembering a very large set
+of keys in a fixed amount of memory.
+
+A key that was added is always found; a key that was not added is
+found with probability about `error_rate` once `capacity` keys have
+been added, and more often beyond that.
+
+to_string and from_string store a filter compactly, e.g. in a
+catalog.  Chunk(bloom=True) saves a filter of the stream_ids and doc_ids of
+a chunk in a sidecar file, e.g. `foo.sc.xz.bloom` for `foo.sc.xz`, so
+that readers can rule the chunk out without decompressing it.
+
+This software is released under an MIT/X11 open source license.
+
+Copyright 2012-2015 Diffeo, Inc.
+'''
+from __future__ import absolute_import
+
+import hashlib
+import logging
+import math
+import os
+import struct
+
+logger = logging.getLogger('streamcorpus')
+
+BLOOM_EXTENSION = '.bloom'
+
+## false positive rate of the filters that chunks write
+CHUNK_ERROR_RATE = 0.01
+
+## version, error_rate, capacity, num_bits, num_hashes, count
+_HEADER = struct.Struct('<BdQQII')
+_VERSION = 1
+
+
+class BloomFilter(object):
+    '''
+    Set of byte strings in `num_bits` bits, sized for `capacity` keys
+    at a false positive rate of `error_rate`.  Each key sets
+    `num_hashes` bits, found by double hashing of its md5.
+    '''
+    def __init__(self, capacity, error_rate=0.001):
+        assert capacity > 0 and 0 < error_rate < 1, (capacity, error_rate)
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.num_bits = int(math.ceil(
+            -capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.num_hashes = max(1, int(round(self.num_bits * math.log(2) / capacity)))
+        self.bits = bytearray((self.num_bits + 7) // 8)
+        self.count = 0
+
+    def _positions(self, key):
+        if isinstance(key, unicode):
+            key = key.encode('utf8')
+        h1, h2 = struct.unpack('<QQ', hashlib.md5(key).digest())
+        ## odd, so that it never cycles early
+        h2 |= 1
+        for i in xrange(self.num_hashes):
+            yield (h1 + i * h2) % self.num_bits
+
+    def add(self, key):
+        '''add `key`, returning True if it was not in the filter before,
+        which is wrong for about `error_rate` of new keys
+        '''
+        new = False
+        bits = self.bits
+        for pos in self._positions(key):
+            byte, mask = pos >> 3, 1 << (pos & 7)
+            if not bits[byte] & mask:
+                bits[byte] |= mask
+                new = True
+        if new:
+            self.count += 1
+        return new
+
+    def __contains__(self, key):
+        bits = self.bits
+        return all(bits[pos >> 3] & (1 << (pos & 7))
+                   for pos in self._positions(key))
+
+    def __len__(self):
+        'number of keys added that were new to the filter'
+        return self.count
+
+    def to_string(self):
+        'the filter as bytes, for from_string'
+        return _HEADER.pack(_VERSION, self.error_rate, self.capacity,
+                            self.num_bits, self.num_hashes, self.count) + str(self.bits)
+
+    @classmethod
+    def from_string(cls, data):
+        'returns the BloomFilter stored in the bytes `data` by to_string'
+        version, error_rate, capacity, num_bits, num_hashes, count = \
+            _HEADER.unpack_from(data)
+        if version != _VERSION:
+            raise ValueError('unknown BloomFilter version %d' % version)
+        bloom = cls.__new__(cls)
+        bloom.capacity = capacity
+        bloom.error_rate = error_rate
+        bloom.num_bits = num_bits
+        bloom.num_hashes = num_hashes
+        bloom.count = count
+        bloom.bits = bytearray(data[_HEADER.size:])
+        if len(bloom.bits) != (num_bits + 7) // 8:
+            raise ValueError('BloomFilter of %d bits in %d bytes'
+                             % (num_bits, len(bloom.bits)))
+        return bloom
+
+    def save(self, path):
+        '''write the filter to `path` via a temp file, so that readers
+        never see a partially written filter
+        '''
+        t_path = path + '.tmp'
+        with open(t_path, 'wb') as fh:
+            fh.write(self.to_string())
+        os.rename(t_path, path)
+
+    @classmethod
+    def load_path(cls, path):
+        '''returns the filter saved at `path`, or None if there is no
+        such file
+        '''
+        if not os.path.exists(path):
+            return None
+        with open(path, 'rb') as fh:
+            return cls.from_string(fh.read())
+
+
+def bloom_path_for(path):
+    '''returns the path of the sidecar BloomFilter for the chunk at
+    `path`
+    '''
+    return path + BLOOM_EXTENSION
+
+
+def load_bloom_sidecar(path):
+    '''returns the BloomFilter in the sidecar of the chunk at `path`, or
+    None if there is none or it is older than the chunk
+    '''
+    bloom_path = bloom_path_for(path)
+    if not os.path.exists(bloom_path):
+        return None
+    if os.path.getmtime(bloom_path) < os.path.getmtime(path):
+        logger.warn('ignoring %s, which is older than its chunk', bloom_path)
+        return None
+    return BloomFilter.load_path(bloom_path)
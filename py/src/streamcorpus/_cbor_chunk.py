@@ -69,6 +69,10 @@ class BufferedReader(object):
     def md5_hexdigest(self):
         return getattr(self._fh, 'md5_hexdigest', None)
 
+    @property
+    def hexdigest(self):
+        return getattr(self._fh, 'hexdigest', None)
+
 
 class CborChunk(BaseChunk):
     '''
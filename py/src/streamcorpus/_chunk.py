@@ -14,14 +14,12 @@ from __future__ import absolute_import
 
 import errno
 import exceptions
-import gzip as gz
 import hashlib
 import logging
+import mmap
 import os
 import uuid
 import re
-import shutil
-import subprocess
 from cStringIO import StringIO
 
 try:
@@ -49,35 +47,78 @@ except ImportError:
     xz = None
 
 try:
-    import snappy as sz
+    import xxhash
 except ImportError:
-    sz = None
+    xxhash = None
 
+try:
+    from pyblake2 import blake2b
+except ImportError:
+    blake2b = getattr(hashlib, 'blake2b', None)
+
+from ._bloom import CHUNK_ERROR_RATE, BloomFilter, bloom_path_for, \
+    load_bloom_sidecar
+from ._chunk_index import ChunkIndex, id_spec, index_path_for
+from ._intern import InternTable, intern_strings
+from ._codecs import XZ_MAGIC, Codec, codecs, codec_for_path, codec_stream, \
+    codec_writer, detect_codec, get_codec, known_compression_schemes
+from ._gpg import GpgContext
+from ._pipeline import PREFETCH_BYTES, BackgroundWriter, ChunkPipeline, \
+    CompressorProcess, ReadAhead, compress_stage, decompress_stage, encrypt_stage
+from ._raw_messages import iter_raw_messages
+from ._projection import project_spec, read_projected
 from .ttypes import StreamItem as StreamItem_v0_3_0
 from .ttypes_v0_1_0 import StreamItem as StreamItem_v0_1_0
 from .ttypes_v0_2_0 import StreamItem as StreamItem_v0_2_0
 
 logger = logging.getLogger('streamcorpus')
 
+## bytes that Chunk reads from its file at a time
+READ_BUFFER_SIZE = 2**20
+
+## most bytes that Chunk.add_many serializes before writing them
+ADD_MANY_BYTES = 16 * 2**20
+
+## bytes that Chunk buffers before passing them on to its file
+WRITE_BUFFER_SIZE = 4 * 2**20
+
 
 class VersionMismatchError(Exception):
     '''The version of a stream item is not what was expected.'''
     pass
 
 
-def serialize(msg):
+def serialize(msg, compression=None, compression_level=None):
     '''
-    Generate a serialized binary blob for a single message
+    Generate a serialized binary blob for a single message, compressed
+    with `compression` at `compression_level` if given.  That is the
+    name of one of the `codecs` or a Codec, such as a ZstdCodec with a
+    dictionary trained on similar messages, which is what makes such
+    small payloads compress well.  deserialize detects the compression.
     '''
+    if compression:
+        return get_codec(compression).compress(serialize(msg), compression_level)
+    if not fastbinary_import_failure:
+        ## what msg.write does with the accelerated protocol, without
+        ## going through a transport
+        return fastbinary.encode_binary(msg, (msg.__class__, msg.thrift_spec))
     o_transport = StringIO()
     o_protocol = protocol(o_transport)
     msg.write(o_protocol)
     o_transport.seek(0)
     return o_transport.getvalue()
 
+def serialize_many(msgs):
+    '''
+    Generate one serialized binary blob for all of the messages in
+    `msgs`, as they would appear one after another in a chunk
+    '''
+    return ''.join(map(serialize, msgs))
+
 def deserialize(blob, message=StreamItem_v0_3_0):
     '''
-    Generate a msg from a serialized binary blob for a single msg
+    Generate a msg from a serialized binary blob for a single msg,
+    which may be compressed, see serialize
     '''
     chunk = Chunk(data=blob, message=message)
     mesgs = list(chunk)
@@ -85,14 +126,55 @@ def deserialize(blob, message=StreamItem_v0_3_0):
         len(mesgs), mesgs)
     return mesgs[0]
 
+## digests that a chunk can compute over its uncompressed bytes, see
+## the inline_md5 parameter of BaseChunk: name --> constructor, or
+## None if the library that provides it is not installed
+digests = {
+    'md5': hashlib.md5,
+    'xxh64': xxhash and xxhash.xxh64,
+    ## same length as md5, so it fits wherever an md5 did
+    'blake2b': blake2b and (lambda: blake2b(digest_size=16)),
+}
+
+def new_digest(name):
+    '''returns a new hash object for the digest called `name`, one of
+    the keys of `digests`
+    '''
+    if name not in digests:
+        raise ValueError('Unrecognized digest %r (known: %r)' % (
+            name, sorted(digests)))
+    if digests[name] is None:
+        raise ImportError('digest %r is not available; install %s' % (
+            name, {'xxh64': 'xxhash', 'blake2b': 'pyblake2'}.get(name, name)))
+    return digests[name]()
+
+def _digest_name(inline_md5):
+    '''map the inline_md5 parameter of BaseChunk to a digest name or None
+    '''
+    if inline_md5 is True:
+        return 'md5'
+    elif not inline_md5:
+        return None
+    new_digest(inline_md5)
+    return inline_md5
+
 class md5_file(object):
     '''
     Adapter around a filehandle that wraps .read and .write so that it
-    can construct an md5_hexdigest property
+    can construct a hexdigest property, an md5 unless another of
+    `digests` is named.
+
+    Small reads are collected and digested together, in strides of at
+    least DIGEST_STRIDE bytes, rather than one update per read.
     '''
-    def __init__(self, fh):
+    DIGEST_STRIDE = 2**20
+
+    def __init__(self, fh, digest='md5'):
         self._fh = fh
-        self._md5 = hashlib.md5()
+        self.digest_name = digest
+        self._digest = new_digest(digest)
+        self._pending = []
+        self._pending_len = 0
         if hasattr(fh, 'get_value'):
             self.get_value = fh.get_value
         if hasattr(fh, 'seek'):
@@ -104,23 +186,35 @@ class md5_file(object):
         if hasattr(fh, 'close'):
             self.close = fh.close
 
+    def _update(self, data):
+        if self._pending_len + len(data) < self.DIGEST_STRIDE:
+            self._pending.append(data)
+            self._pending_len += len(data)
+            return
+        if self._pending:
+            self._pending.append(data)
+            data = ''.join(self._pending)
+            self._pending = []
+            self._pending_len = 0
+        self._digest.update(data)
+
     def read(self, *args, **kwargs):
         data = self._fh.read(*args, **kwargs)
-        self._md5.update(data)
+        self._update(data)
         return data
 
     def readline(self, *args, **kwargs):
         data = self._fh.readline(*args, **kwargs)
-        self._md5.update(data)
+        self._update(data)
         return data
 
     def __iter__(self):
         for data in self._fh:
-            self._md5.update(data)
+            self._update(data)
             yield data
 
     def write(self, data, *args, **kwargs):
-        self._md5.update(data)
+        self._update(data)
         self._fh.write(data, *args, **kwargs)
 
 
@@ -144,9 +238,132 @@ class md5_file(object):
         return buff
 
 
+    @property
+    def hexdigest(self):
+        if self._pending:
+            self._digest.update(''.join(self._pending))
+            self._pending = []
+            self._pending_len = 0
+        return self._digest.hexdigest()
+
+    @property
+    def md5_hexdigest(self):
+        if self.digest_name == 'md5':
+            return self.hexdigest
+        return None
+
+class mmap_file(object):
+    '''
+    Read-only file-like view of a memory-mapped file.  Reads come
+    straight from the mapped pages, which several processes reading
+    the same chunk share through the page cache, and
+    TMemoryBuffer(mmap_file.map) lets the accelerated protocol decode
+    from them without copying.
+
+    hexdigest is computed lazily over the whole file, in large
+    strides, the first time it is requested.
+    '''
+    DIGEST_STRIDE = 16 * 2**20
+
+    def __init__(self, fh, digest='md5'):
+        self._fh = fh
+        self.digest_name = digest
+        self.mode = 'rb'
+        size = os.fstat(fh.fileno()).st_size
+        if size == 0:
+            ## cannot map an empty file
+            self.map = ''
+        else:
+            self.map = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+        ## cStringIO reads from the map's buffer without copying it
+        self._buf = StringIO(self.map)
+        self._hexdigest = None
+
+    def read(self, *args):
+        return self._buf.read(*args)
+
+    def readline(self, *args):
+        return self._buf.readline(*args)
+
+    def __iter__(self):
+        return iter(self._buf)
+
+    def seek(self, *args):
+        self._buf.seek(*args)
+
+    def tell(self):
+        return self._buf.tell()
+
+    def readAll(self, sz):
+        data = self._buf.read(sz)
+        if len(data) < sz:
+            raise EOFError()
+        return data
+
+    def close(self):
+        self._buf.close()
+        if isinstance(self.map, mmap.mmap):
+            self.map.close()
+        self._fh.close()
+
+    @property
+    def hexdigest(self):
+        if self._hexdigest is None and self.digest_name is not None:
+            digest = new_digest(self.digest_name)
+            for start in xrange(0, len(self.map), self.DIGEST_STRIDE):
+                digest.update(buffer(self.map, start, self.DIGEST_STRIDE))
+            self._hexdigest = digest.hexdigest()
+        return self._hexdigest
+
     @property
     def md5_hexdigest(self):
-        return self._md5.hexdigest()
+        if self.digest_name == 'md5':
+            return self.hexdigest
+        return None
+
+class xz_stream(codec_stream):
+    '''
+    codec_stream for xz, which reads concatenated xz streams one after
+    another, like `xzcat` does.
+    '''
+    def __init__(self, fh, block_size=64 * 1024):
+        if xz is None:
+            raise RuntimeError('streaming xz decompression requires backports.lzma')
+        super(xz_stream, self).__init__(fh, codecs['xz'], block_size)
+
+def _open_reader(fh, codec):
+    '''decompress the file-like `fh` with `codec` as it is read, in
+    this thread if the codec's library is installed, or else in a
+    child process
+    '''
+    if codec.library is not None:
+        return codec_stream(fh, codec)
+    if not codec.has_command:
+        raise Exception('%s data but neither its library nor %s is installed'
+                        % (codec.name, codec.decompress_command()[0]))
+    return ChunkPipeline(fh, [decompress_stage(codec.name)])
+
+def _open_writer(path, mode, background=None, level=None):
+    '''open `path` for writing, compressed at `level` by the codec for
+    its extension, with compression moved to the `background` thread
+    or process if requested, see BaseChunk
+    '''
+    codec = codec_for_path(path)
+    if codec is None:
+        file_obj = open(path, mode)
+    elif background == 'process' or codec.library is None:
+        if not codec.has_command:
+            raise Exception('file extension is .%s but neither its library nor %s is installed'
+                            % (codec.name, codec.compress_command()[0]))
+        ## the child writes straight to the file
+        file_obj = CompressorProcess(
+            codec.compress_command(level, threads=background == 'process'),
+            open(path, mode))
+    else:
+        file_obj = codec_writer(open(path, mode), codec, level)
+    if background is not None:
+        file_obj = BackgroundWriter(file_obj)
+    return file_obj
 
 class BaseChunk(object):
     '''
@@ -159,7 +376,9 @@ class BaseChunk(object):
     def __init__(self, path=None, data=None, file_obj=None, mode='rb',
                  message=StreamItem_v0_3_0,
                  read_wrapper=None, write_wrapper=None,
-                 inline_md5=True
+                 inline_md5=True, use_mmap=False, gpg=None,
+                 background_compression=None, compression_level=None,
+                 prefetch_bytes=None
         ):
         '''Load a chunk from an existing file handle or buffer of data.
         If no data is passed in, then chunk starts as empty and
@@ -169,9 +388,10 @@ class BaseChunk(object):
         open.
 
         :param path: path to a file in the local file system.  If path
-        ends in .xz then mode must be 'rb' and the entire file is
-        loaded into memory and decompressed before the Chunk is ready
-        for reading.
+        ends in the name of one of the `codecs`, e.g. .xz or .zst, the
+        file is decompressed as it is read, using codec_stream, or a
+        child process such as `xz --decompress` if the codec's library
+        is not installed, and compressed as it is written.
 
         :param mode: read/write mode for opening the file; if
         mode='wb', then a file will be created.
@@ -179,7 +399,10 @@ class BaseChunk(object):
         :file_obj: already opened file, mode must agree with mode
         parameter.
 
-        :param data: bytes of data from which to read messages
+        :param data: bytes of data from which to read messages.  If
+        `data` starts with the magic bytes of one of the `codecs`, it
+        is decompressed incrementally as messages are read, see
+        codec_stream.
 
         :param message: defaults to StreamItem_v0_3_0; you can specify
         your own Thrift-generated class here.
@@ -191,28 +414,85 @@ class BaseChunk(object):
         :param write_wrapper: a function used in Chunk.add(obj) that
         takes the added object as input and returns another object
         that is a thrift class that can be serialized.
+
+        :param inline_md5: digest to compute over the uncompressed
+        bytes as they are read or written: True or 'md5' for md5, the
+        name of one of the faster `digests`, 'xxh64' or 'blake2b', or
+        False or None to skip digesting.  The result is `hexdigest`;
+        `md5_hexdigest` is only set for md5.
+
+        :param use_mmap: if True and `path` is an uncompressed chunk
+        opened with mode='rb', memory-map the file instead of reading
+        it through a buffer, see mmap_file.  hexdigest is then the
+        digest of the whole file, computed when it is first requested.
+
+        :param gpg: a GpgContext holding the private key with which to
+        decrypt a `path` ending in .gpg, e.g. foo.sc.xz.gpg.  Without one, gpg uses the
+        default keyring.  Such paths are read through a ChunkPipeline,
+        available as `self.pipeline`, whose stats() report the
+        throughput of decryption and decompression.
+
+        :param background_compression: when writing to `path`, 'thread'
+        compresses and writes on a BackgroundWriter thread, so that
+        serialization overlaps compression; 'process' pipes the bytes
+        through a compressor child, see COMPRESSOR_COMMANDS, which for
+        .xz uses every core.  The digest is the same either way.
+        Errors from the background are raised by flush or close.
+
+        :param compression_level: level at which to compress when
+        writing a compressed `path`, in the range of its codec, or
+        None for the codec's default.
+
+        :param prefetch_bytes: when reading from `path`, read the file
+        ahead of decoding on a ReadAhead thread, holding up to this
+        many bytes, or PREFETCH_BYTES if True.  This hides the round
+        trips of NFS or FUSE mounts, whether the file is then decoded
+        here, decompressed by a child such as xz, or decrypted.  The
+        ReadAhead is `self.read_ahead`, whose stats() report the bytes
+        read, the stalls, and the time blocked on I/O.
         '''
 
         self.read_wrapper = read_wrapper
         self.write_wrapper = write_wrapper
 
+        ## remember where we came from, so that sidecar files can be
+        ## found next to the chunk
+        self.path = path
+
         allowed_modes = ['wb', 'ab', 'rb']
         assert mode in allowed_modes, 'mode=%r not in %r' % (mode, allowed_modes)
         self.mode = mode
 
+        allowed_background = [None, 'thread', 'process']
+        assert background_compression in allowed_background, \
+            'background_compression=%r not in %r' % (background_compression, allowed_background)
+
+        ## name of the digest to compute, or None
+        self.digest_name = _digest_name(inline_md5)
+
         ## class for constructing messages when reading
         self.message = message
 
         ## initialize internal state before figuring out what data we
         ## are acting on
         self._count = 0
-        self._md5_hexdigest = None
+        self._hexdigest = None
 
         ## might not have any output parts
         self._o_chunk_fh = None
 
         ## might not have any input parts
         self._i_chunk_fh = None
+        ## close only inputs that we opened, not a caller's file_obj
+        self._own_input = file_obj is None
+
+        ## staged reader for encrypted paths, see ChunkPipeline
+        self.pipeline = None
+
+        ## reads `path` ahead of us, see prefetch_bytes
+        self.read_ahead = None
+        if prefetch_bytes is True:
+            prefetch_bytes = PREFETCH_BYTES
 
         ## open an existing file from path, or create it
         if path is not None:
@@ -224,32 +504,26 @@ class BaseChunk(object):
                     exc = IOError('mode=%r would overwrite existing %s' % (mode, path))
                     exc.errno = errno.EEXIST
                     raise exc
-                if path.endswith('.xz'):
-                    if xz is None:
-                        if mode != 'rb':
-                            raise Exception('backports.lzma is not installed and mode=%r but only "rb" is allowed without backports.lzma' % mode)
-                        ## launch xz child
-                        xz_child = subprocess.Popen(
-                            ['xzcat', path],
-                            stdout=subprocess.PIPE,
-                            stderr=subprocess.PIPE)
-                        file_obj = xz_child.stdout
-                        ## what to do with stderr
+                codec = codec_for_path(path)
+                if path.endswith('.gpg'):
+                    assert mode == 'rb', 'mode=%r for .gpg' % mode
+                    ## decrypt and decompress on their own threads
+                    file_obj = self.pipeline = ChunkPipeline.open(
+                        path, gpg=gpg, fh=self._open_input(path, prefetch_bytes))
+                elif codec is not None:
+                    if mode == 'rb':
+                        file_obj = _open_reader(
+                            self._open_input(path, prefetch_bytes), codec)
+                        if isinstance(file_obj, ChunkPipeline):
+                            self.pipeline = file_obj
                     else:
-                        file_obj = xz.open(path, mode)
-
-                elif path.endswith('.gz'):
-                    assert mode == 'rb', 'mode=%r for .gz' % mode
-                    file_obj  = gz.open(path)
-                elif path.endswith('.xz.gpg'):
-                    assert mode == 'rb', 'mode=%r for .xz' % mode
-                    ## launch xz child
-                    xz_child = subprocess.Popen(
-                        ['gpg -d %s | xz --decompress' % path],
-                        stdout=subprocess.PIPE, shell=True)
-                        #stderr=subprocess.PIPE)
-                    file_obj = xz_child.stdout
-                    ## what to do with stderr?
+                        ## a new stream after the end of the existing one
+                        file_obj = _open_writer(path, mode, background_compression,
+                                                compression_level)
+                elif use_mmap and mode == 'rb':
+                    file_obj = mmap_file(open(path, mode), self.digest_name)
+                elif mode == 'rb':
+                    file_obj = self._open_input(path, prefetch_bytes)
                 else:
                     file_obj = open(path, mode)
             else:
@@ -261,14 +535,8 @@ class BaseChunk(object):
                 dirname = os.path.dirname(path)
                 if dirname and not os.path.exists(dirname):
                     os.makedirs(dirname)
-                if path.endswith('.gz'):
-                    file_obj = gz.open(path, mode)
-                elif path.endswith('.xz'):
-                    if xz is None:
-                        raise Exception('file extension is .xz but backports.lzma is not installed')
-                    file_obj = xz.open(path, mode)
-                else:
-                    file_obj = open(path, mode)
+                file_obj = _open_writer(path, mode, background_compression,
+                                        compression_level)
 
         ## if created without any arguments, then prepare to add
         ## messages to an in-memory file object
@@ -284,6 +552,13 @@ class BaseChunk(object):
             if mode == 'rb':
                 file_obj = StringIO(data)
                 file_obj.seek(0)
+                codec = detect_codec(data)
+                if codec is not None:
+                    ## no serialized message starts with any of the
+                    ## magic byte strings
+                    file_obj = _open_reader(file_obj, codec)
+                    if isinstance(file_obj, ChunkPipeline):
+                        self.pipeline = file_obj
             elif mode == 'ab':
                 file_obj = StringIO()
                 file_obj.write(data)
@@ -304,18 +579,24 @@ class BaseChunk(object):
             ## happens, i.e. in streaming mode.
 
         if mode in ['ab', 'wb']:
-            if inline_md5:
-                self._o_chunk_fh = md5_file( file_obj )
+            if self.digest_name:
+                self._o_chunk_fh = md5_file( file_obj, self.digest_name )
             else:
                 self._o_chunk_fh = file_obj
 
         else:
             assert mode == 'rb', mode
-            if inline_md5:
-                self._i_chunk_fh = md5_file( file_obj )
+            if self.digest_name and not isinstance(file_obj, mmap_file):
+                self._i_chunk_fh = md5_file( file_obj, self.digest_name )
             else:
                 self._i_chunk_fh = file_obj
 
+    def _open_input(self, path, prefetch_bytes):
+        fh = open(path, 'rb')
+        if prefetch_bytes:
+            fh = self.read_ahead = ReadAhead(fh, prefetch_bytes)
+        return fh
+
     def __enter__(self):
         return self
 
@@ -340,30 +621,58 @@ class BaseChunk(object):
 
     def close(self):
         '''
-        Close any chunk file that we might have had open for writing.
+        Close any chunk file that we might have had open for writing,
+        and any that we opened for reading, stopping the pipeline and
+        its child processes if reading stopped early.  The hexdigest
+        of a reader then covers what was read before closing.
         '''
+        if self.pipeline is not None:
+            self.pipeline.close()
+            self.pipeline = None
+        if self._i_chunk_fh is not None and self._own_input:
+            if isinstance(self._i_chunk_fh, md5_file):
+                self._hexdigest = self._i_chunk_fh.hexdigest
+            elif isinstance(self._i_chunk_fh, mmap_file):
+                ## computed only if it was asked for already
+                self._hexdigest = self._i_chunk_fh._hexdigest
+            if hasattr(self._i_chunk_fh, 'close'):
+                self._i_chunk_fh.close()
+            self._i_chunk_fh = None
+        if self.read_ahead is not None:
+            logger.debug('ReadAhead of %s: %r', self.path, self.read_ahead.stats())
+            self.read_ahead.close()
+            self.read_ahead = None
         if self._o_chunk_fh is not None:
             self._o_chunk_fh.close()
             ## make this method idempotent
             if isinstance(self._o_chunk_fh, md5_file):
-                self._md5_hexdigest = self._o_chunk_fh.md5_hexdigest
+                self._hexdigest = self._o_chunk_fh.hexdigest
             self._o_chunk_fh = None
 
     @property
-    def md5_hexdigest(self):
-        if self._md5_hexdigest:
+    def hexdigest(self):
+        '''hex digest, named by `digest_name`, of the uncompressed bytes
+        read or written so far
+        '''
+        if self._hexdigest:
             ## only set if closed already
-            return self._md5_hexdigest
-        if self._o_chunk_fh and hasattr(self._o_chunk_fh, 'md5_hexdigest'):
+            return self._hexdigest
+        if self._o_chunk_fh and hasattr(self._o_chunk_fh, 'hexdigest'):
             ## get it directly from the output chunk
-            return self._o_chunk_fh.md5_hexdigest
-        elif self._i_chunk_fh and hasattr(self._i_chunk_fh, 'md5_hexdigest'):
+            return self._o_chunk_fh.hexdigest
+        elif self._i_chunk_fh and hasattr(self._i_chunk_fh, 'hexdigest'):
             ## get it directly from the input chunk
-            return self._i_chunk_fh.md5_hexdigest
+            return self._i_chunk_fh.hexdigest
         else:
             ## maybe return raise?
             return None
 
+    @property
+    def md5_hexdigest(self):
+        if self.digest_name == 'md5':
+            return self.hexdigest
+        return None
+
     def __str__(self):
         raise exceptions.NotImplementedError
 
@@ -392,10 +701,82 @@ class BaseChunk(object):
         raise NotImplementedError()
 
 
+class _OutputBuffer(TTransport.TTransportBase, TTransport.CReadableTransport):
+    '''
+    Write-only transport that, unlike TBufferedTransport, passes its
+    buffer on to `fh` whenever it holds `size` bytes instead of only
+    on flush, so that a BackgroundWriter can compress early parts of
+    a chunk while later messages are serialized.  It derives from
+    CReadableTransport only because the accelerated protocol insists.
+    '''
+    def __init__(self, fh, size=WRITE_BUFFER_SIZE):
+        self._fh = fh
+        self._size = size
+        self._buf = StringIO()
+
+    def isOpen(self):
+        return True
+
+    def write(self, buf):
+        self._buf.write(buf)
+        if self._buf.tell() >= self._size:
+            self.drain()
+
+    def drain(self):
+        'write out the buffer, without flushing the file'
+        if self._buf.tell():
+            data = self._buf.getvalue()
+            self._buf = StringIO()
+            self._fh.write(data)
+
+    def flush(self):
+        self.drain()
+        if hasattr(self._fh, 'flush'):
+            self._fh.flush()
+
 class Chunk(BaseChunk):
     '''Chunk, the default Chunk, is a Thrift Chunk.
-    See also PickleChunk, JsonChunk, and CborChunk'''
+    See also PickleChunk, JsonChunk, and CborChunk
+
+    In addition to the parameters of BaseChunk, Chunk accepts:
+
+    :param index: if True and the chunk is opened for writing at a
+    `path`, then write a sidecar index (`path` + ".idx") of the byte
+    offset and length of each message when the chunk is closed.  See
+    :meth:`get` and :meth:`seek_to`.
+
+    :param bloom: if True and the chunk is opened for writing at a
+    `path`, then write a BloomFilter of the stream_ids and doc_ids of
+    its messages when the chunk is closed, to a sidecar (`path` +
+    ".bloom"), or for a BlockChunk into its footer.  See
+    :meth:`might_contain`.
+
+    :param fields: list of field names, possibly dotted like
+    'body.clean_visible', to decode when reading.  All other fields
+    are skipped by the protocol without constructing objects, and keep
+    their default values.  None (the default) decodes everything.
+
+    :param intern: if True, then share one copy of each of the strings
+    that repeat across tokens, such as pos, lemma, and annotator_id,
+    among the messages read, to shrink the heap of decoded tagged
+    chunks; or an InternTable to share between chunks.  See
+    intern_strings.
+
+    Paths ending in ".scb" are opened as a BlockChunk.
+    '''
+    def __new__(cls, *args, **kwargs):
+        ## Chunk(path) opens a block chunk as a BlockChunk
+        path = kwargs.get('path', args and args[0] or None)
+        if cls is Chunk and isinstance(path, basestring) and path.endswith('.scb'):
+            from ._block_chunk import BlockChunk
+            cls = BlockChunk
+        return super(Chunk, cls).__new__(cls)
+
     def __init__(self, *args, **kwargs):
+        write_index = kwargs.pop('index', False)
+        write_bloom = kwargs.pop('bloom', False)
+        fields = kwargs.pop('fields', None)
+        intern = kwargs.pop('intern', False)
         super(Chunk, self).__init__(*args, **kwargs)
         if not fastbinary_import_failure:
             #logger.debug('using TBinaryProtocolAccelerated (fastbinary)')
@@ -407,21 +788,179 @@ class Chunk(BaseChunk):
         self._o_transport = None
         self._o_protocol = None
 
+        ## index sidecar being written, and the one used for reading
+        self._o_index = None
+        self._i_index = None
+        ## byte offset at which the next iteration starts, see seek_to
+        self._i_start = 0
+
+        ## keys for the bloom filter being written, and the filter
+        ## used for reading
+        self._o_bloom_keys = None
+        self._i_bloom = None
+
+        ## thrift_spec that decodes only the requested fields
+        self._i_spec = None
+        if fields is not None:
+            self._i_spec = project_spec(self.message, fields)
+
+        ## strings shared among the messages read
+        if intern is True:
+            intern = InternTable()
+        elif intern is False:
+            intern = None
+        self._i_intern = intern
+
+        if write_index and self.mode in ['wb', 'ab']:
+            if self.path is None:
+                raise ValueError('index=True requires a path to write the index next to')
+            if self.mode == 'ab':
+                self._o_index = self._load_or_build_index()
+            else:
+                self._o_index = ChunkIndex()
+
+        if write_bloom and self.mode in ['wb', 'ab']:
+            if self.path is None:
+                raise ValueError('bloom=True requires a path to write the filter next to')
+            self._o_bloom_keys = []
+            if self.mode == 'ab' and os.path.exists(self.path) and os.path.getsize(self.path):
+                ## a filter cannot grow, so gather the keys of the
+                ## existing messages for a new one
+                logger.info('reading ids of existing messages in %s', self.path)
+                for blob in Chunk(path=self.path, mode='rb', message=self.message).iter_raw():
+                    self._add_bloom_keys(self._decode_ids(blob))
+
+    def _load_or_build_index(self):
+        '''get the index for the messages already in the chunk at
+        self.path, so that appending can continue it
+        '''
+        index = ChunkIndex.load_path(index_path_for(self.path))
+        if index is None:
+            logger.info('building index of existing messages in %s', self.path)
+            i_chunk = Chunk(path=self.path, mode='rb', message=self.message)
+            index = ChunkIndex.build(i_chunk._i_chunk_fh, self.message, protocol)
+        return index
+
     def _otp(self):
         if self._o_protocol is None:
-            self._o_transport = TTransport.TBufferedTransport(self._o_chunk_fh)
+            self._o_transport = _OutputBuffer(self._o_chunk_fh)
             self._o_protocol = protocol(self._o_transport)
         return self._o_protocol
 
+    def _check_type(self, msg):
+        if not (isinstance(msg, self.message) or (type(msg) == self.message)):
+            raise VersionMismatchError(
+                'mismatched type: %s != %s' % (type(msg), self.message))
+
     def write_msg_impl(self, msg):
         'add message instance to chunk'
         o_protocol = self._otp()
         assert o_protocol, 'cannot add to a Chunk instantiated with data'
         assert self._o_chunk_fh is not None, 'cannot Chunk.add after Chunk.close'
-        if not (isinstance(msg, self.message) or (type(msg) == self.message)):
-            raise VersionMismatchError(
-                'mismatched type: %s != %s' % (type(msg), self.message))
-        msg.write(o_protocol)
+        self._check_type(msg)
+        if self._o_index is None:
+            msg.write(o_protocol)
+            self._add_bloom_keys(msg)
+        else:
+            ## serialize separately to learn the length of the message
+            self._write_blob(serialize(msg), msg)
+
+    def add_many(self, msgs):
+        '''Add every message in the iterable `msgs`, as if by calling add
+        on each.  Messages are serialized in batches of up to
+        ADD_MANY_BYTES, and each batch is joined into one buffer that
+        is hashed and written to the file in a single write.
+
+        Returns the number of messages added.
+        '''
+        assert self._o_chunk_fh is not None, 'cannot Chunk.add_many after Chunk.close'
+        write_wrapper = self.write_wrapper
+        count = 0
+        blobs = []
+        batch = []
+        batch_len = 0
+        for msg in msgs:
+            if write_wrapper is not None:
+                msg = write_wrapper(msg)
+            self._check_type(msg)
+            blob = serialize(msg)
+            blobs.append(blob)
+            batch.append(msg)
+            batch_len += len(blob)
+            if batch_len >= ADD_MANY_BYTES:
+                self._write_blobs(blobs, batch)
+                count += len(blobs)
+                blobs = []
+                batch = []
+                batch_len = 0
+        if blobs:
+            self._write_blobs(blobs, batch)
+            count += len(blobs)
+        return count
+
+    def add_raw(self, blob):
+        '''Append `blob`, the bytes of one serialized message such as
+        those from iter_raw, to the chunk verbatim without decoding it.
+        write_wrapper is not applied, and the type and version of the
+        message are not checked.
+        '''
+        assert self._o_chunk_fh is not None, 'cannot Chunk.add_raw after Chunk.close'
+        self._write_blob(blob)
+        self._count += 1
+
+    def _decode_ids(self, blob):
+        '''decode just the identifiers that go in an index from `blob`
+        '''
+        msg = self.message()
+        read_projected(msg, protocol(TTransport.TMemoryBuffer(blob)),
+                       id_spec(self.message))
+        return msg
+
+    def _add_bloom_keys(self, msg):
+        if self._o_bloom_keys is not None:
+            for key in (getattr(msg, 'stream_id', None), getattr(msg, 'doc_id', None)):
+                if key:
+                    self._o_bloom_keys.append(key)
+
+    def _build_bloom(self):
+        bloom = BloomFilter(max(1, len(self._o_bloom_keys)), CHUNK_ERROR_RATE)
+        for key in self._o_bloom_keys:
+            bloom.add(key)
+        self._o_bloom_keys = None
+        return bloom
+
+    def _write_blob(self, blob, msg=None):
+        '''write one serialized message; `msg` is the message it came
+        from, if known, for the index
+        '''
+        self._otp()
+        self._o_transport.write(blob)
+        if msg is None and (self._o_index is not None or self._o_bloom_keys is not None):
+            msg = self._decode_ids(blob)
+        self._add_bloom_keys(msg)
+        if self._o_index is not None:
+            self._o_index.add(self._o_index.end, len(blob),
+                              getattr(msg, 'stream_id', None),
+                              getattr(msg, 'doc_id', None),
+                              getattr(msg, 'abs_url', None))
+
+    def _write_blobs(self, blobs, msgs):
+        '''write a batch of serialized messages, and the messages they
+        came from, with one write to the file
+        '''
+        self._otp()
+        ## keep the order of messages written by add
+        self._o_transport.drain()
+        for msg in msgs:
+            self._add_bloom_keys(msg)
+        if self._o_index is not None:
+            for blob, msg in zip(blobs, msgs):
+                self._o_index.add(self._o_index.end, len(blob),
+                                  getattr(msg, 'stream_id', None),
+                                  getattr(msg, 'doc_id', None),
+                                  getattr(msg, 'abs_url', None))
+        self._o_chunk_fh.write(''.join(blobs))
+        self._count += len(blobs)
 
     def flush(self):
         if self._o_transport is not None:
@@ -433,45 +972,178 @@ class Chunk(BaseChunk):
             self._o_transport.flush()
             self._o_transport = None
         super(Chunk, self).close()
+        if self._o_index is not None:
+            ## written after the chunk is closed, so the index is never
+            ## newer than the data it describes
+            self._o_index.save(index_path_for(self.path))
+            self._o_index = None
+        if self._o_bloom_keys is not None:
+            self._build_bloom().save(bloom_path_for(self.path))
 
-    def read_msg_impl(self):
+    @property
+    def index(self):
+        '''ChunkIndex loaded from the sidecar next to this chunk, or None
+        if there is no usable sidecar
         '''
-        Iterator over messages in the chunk
+        if self._i_index is None and self.path is not None:
+            index_path = index_path_for(self.path)
+            if os.path.exists(index_path):
+                if os.path.getmtime(index_path) < os.path.getmtime(self.path):
+                    logger.warn('ignoring %s, which is older than its chunk', index_path)
+                else:
+                    self._i_index = ChunkIndex.load_path(index_path)
+        return self._i_index
+
+    @property
+    def bloom(self):
+        '''BloomFilter of the stream_ids and doc_ids of the messages in
+        this chunk, from its sidecar, or None if there is no usable
+        sidecar
         '''
-        assert self._i_chunk_fh, 'cannot iterate over a Chunk open for writing'
+        if self._i_bloom is None and self.path is not None:
+            self._i_bloom = load_bloom_sidecar(self.path)
+        return self._i_bloom
+
+    def might_contain(self, stream_id=None, doc_id=None):
+        '''False if the chunk's BloomFilter shows that it holds no
+        message with `stream_id` or `doc_id`, without reading any
+        messages; True if it might, or if it has no filter
+        '''
+        assert stream_id is not None or doc_id is not None, \
+            'might_contain needs a stream_id or doc_id'
+        bloom = self.bloom
+        if bloom is None:
+            return True
+        return any(key in bloom for key in (stream_id, doc_id) if key is not None)
+
+    def _read_msg(self, i_protocol):
+        '''read one message from `i_protocol`, decoding only the
+        requested fields, and check its version
+        '''
+        msg = self.message()
+        if self._i_spec is None:
+            msg.read(i_protocol)
+        else:
+            read_projected(msg, i_protocol, self._i_spec)
+        self._check_version(msg)
+        if self._i_intern is not None:
+            intern_strings(msg, self._i_intern)
+        return msg
+
+    def _check_version(self, msg):
+        if hasattr(msg, 'version'):
+            ## compare the read version to the default version
+            ## value on the identified message
+            if not (msg.version == self.message().version):
+                raise VersionMismatchError(
+                    'read msg.version = %d != %d = message().version):' % \
+                        (msg.version, self.message().version))
+
+    def _read_at(self, entry):
+        '''read the single message described by the IndexEntry `entry`
+        '''
+        assert self._i_chunk_fh, 'cannot read from a Chunk open for writing'
+        self._i_chunk_fh.seek(entry.offset)
+        data = self._i_chunk_fh.read(entry.length)
+        if len(data) != entry.length:
+            raise IOError('%s is shorter than its index: %d < %d bytes at %d' % (
+                self.path, len(data), entry.length, entry.offset))
+        msg = self._read_msg(protocol(TTransport.TMemoryBuffer(data)))
+        if self.read_wrapper is not None:
+            msg = self.read_wrapper(msg)
+        return msg
+
+    def get(self, stream_id=None, doc_id=None, abs_url=None):
+        '''Returns the first message that matches any of the given
+        identifiers, or None.  If the chunk has an index sidecar, this
+        costs one seek and one decode; otherwise, it scans the chunk.
+
+        Seeking invalidates md5_hexdigest for the input.
+        '''
+        index = self.index
+        if index is not None and hasattr(self._i_chunk_fh, 'seek'):
+            positions = index.find(stream_id=stream_id, doc_id=doc_id, abs_url=abs_url)
+            if not positions:
+                return None
+            try:
+                return self._read_at(index[positions[0]])
+            except IOError, exc:
+                if exc.errno != errno.ESPIPE:
+                    raise
+                logger.info('cannot seek in %s, scanning it instead', self.path)
+
+        for msg in self.read_msg_impl():
+            if (stream_id is not None and getattr(msg, 'stream_id', None) == stream_id) or \
+               (doc_id is not None and getattr(msg, 'doc_id', None) == doc_id) or \
+               (abs_url is not None and getattr(msg, 'abs_url', None) == abs_url):
+                if self.read_wrapper is not None:
+                    msg = self.read_wrapper(msg)
+                return msg
+        return None
+
+    def seek_to(self, n):
+        '''Start the next iteration over this chunk at the n-th message,
+        using the index sidecar to find it.
+
+        Seeking invalidates md5_hexdigest for the input.
+        '''
+        index = self.index
+        if index is None:
+            raise ValueError('%s has no index sidecar' % self.path)
+        if n == len(index):
+            self._i_start = index.end
+        else:
+            self._i_start = index[n].offset
 
+    def _seek_start(self):
         ## attempt to seek to the start, so can iterate multiple times
         ## over the chunk
         if hasattr(self._i_chunk_fh, 'seek'):
             try:
-                self._i_chunk_fh.seek(0)
+                self._i_chunk_fh.seek(self._i_start)
             except IOError:
                 pass
                 ## just assume that it is a pipe like stdin that need
                 ## not be seeked to start
 
-        ## wrap the file handle in buffered transport
-        i_transport = TTransport.TBufferedTransport(self._i_chunk_fh)
+    def iter_raw(self):
+        '''
+        Iterator over the serialized bytes of each message in the
+        chunk, without decoding them.  Much faster than __iter__ for
+        copying and counting; see add_raw.  Like __iter__, this
+        updates len() and md5_hexdigest.
+        '''
+        assert self._i_chunk_fh, 'cannot iterate over a Chunk open for writing'
+        self._seek_start()
+        for blob in iter_raw_messages(self._i_chunk_fh):
+            self._count += 1
+            yield blob
+
+    def read_msg_impl(self):
+        '''
+        Iterator over messages in the chunk
+        '''
+        assert self._i_chunk_fh, 'cannot iterate over a Chunk open for writing'
+        self._seek_start()
+
+        if isinstance(self._i_chunk_fh, mmap_file):
+            ## decode directly from the mapped pages
+            i_transport = TTransport.TMemoryBuffer(self._i_chunk_fh.map)
+            i_transport._buffer.seek(self._i_start)
+        else:
+            ## wrap the file handle in buffered transport, reading
+            ## large enough pieces that digesting them is cheap
+            i_transport = TTransport.TBufferedTransport(
+                self._i_chunk_fh, READ_BUFFER_SIZE)
         ## use the Thrift Binary Protocol
         i_protocol = protocol(i_transport)
 
         ## read message instances until input buffer is exhausted
         while 1:
 
-            ## instantiate a message  instance
-            msg = self.message()
-
             try:
-                ## read it from the thrift protocol instance
-                msg.read(i_protocol)
-
-                if hasattr(msg, 'version'):
-                    ## compare the read version to the default version
-                    ## value on the identified message
-                    if not (msg.version == self.message().version):
-                        raise VersionMismatchError(
-                            'read msg.version = %d != %d = message().version):' % \
-                                (msg.version, self.message().version))
+                ## read a message instance from the thrift protocol
+                msg = self._read_msg(i_protocol)
                 yield msg
 
             except EOFError:
@@ -519,10 +1191,17 @@ class PickleChunk(BaseChunk):
                 return
 
 def decrypt_and_uncompress(data, gpg_private=None, tmp_dir=None,
-                           compression='xz', detect_compression=True):
+                           compression='xz', detect_compression=True,
+                           gpg=None):
     '''Given a data buffer of bytes, if gpg_key_path is provided, decrypt
     data using gnupg, and uncompress using `compression` scheme, which
-    defaults to "xz" and can also be "gz", "sz", or "".
+    defaults to "xz" and can be the name of any of the `codecs`, e.g.
+    "gz", "sz", "zst", or "lz4", or "" for none.  If
+    `detect_compression`, data that starts with the magic bytes of a
+    codec is decompressed with that codec instead.
+
+    To decrypt many buffers, pass a GpgContext as `gpg` instead of
+    gpg_private, so that the key is imported only once.
 
     :returns: a tuple of (logs, data), where `logs` is an array of
       strings and data is a binary string
@@ -532,89 +1211,48 @@ def decrypt_and_uncompress(data, gpg_private=None, tmp_dir=None,
         logger.error('decrypt_and_uncompress starting with empty data')
         return ['no data'], None
     _errors = []
-    if gpg_private is not None:
-        ### setup gpg for decryption
-        gpg_dir = os.tempnam(tmp_dir, 'tmp-compress-and-encrypt-')
-        os.makedirs(gpg_dir)
+    if gpg is None and gpg_private is not None:
+        ## a one-off context, which pays for importing the key
         try:
-            gpg_child = subprocess.Popen(
-                ['gpg', '--no-permission-warning', '--homedir', gpg_dir,
-                 '--import', gpg_private],
-                stderr=subprocess.PIPE)
-            s_out, errors = gpg_child.communicate()
-            if errors:
-                _errors.append('gpg logs to stderr, read carefully:\n\n%s' %
-                               errors)
-
-            ## decrypt it, and free memory
-            ## encrypt using the fingerprint for our trec-kba-rsa key pair
-            gpg_child = subprocess.Popen(
-                ## setup gpg to decrypt with trec-kba private key
-                ## (i.e. make it the recipient), with zero compression,
-                ## ascii armoring is off by default, and --output - must
-                ## appear before --decrypt -
-                ['gpg',   '--no-permission-warning', '--homedir', gpg_dir,
-                 '--trust-model', 'always', '--output', '-', '--decrypt', '-'],
-                stdin =subprocess.PIPE,
-                stdout=subprocess.PIPE,
-                stderr=subprocess.PIPE)
-            ## communicate with child via its stdin
-            data, errors = gpg_child.communicate(data)
-            if errors:
-                _errors.append(errors)
-
-        finally:
-            ## remove the gpg_dir
-            shutil.rmtree(gpg_dir, ignore_errors=True)
-
+            gpg = GpgContext(gpg_private=gpg_private, tmp_dir=tmp_dir)
+        except RuntimeError, exc:
+            ## a bad key is reported in the logs, not raised
+            logger.error('importing gpg_private failed: %s', exc)
+            return [str(exc), 'gpg -> no data'], None
+        with gpg:
+            return decrypt_and_uncompress(
+                data, tmp_dir=tmp_dir, compression=compression,
+                detect_compression=detect_compression, gpg=gpg)
+    if gpg is not None:
+        _errors.extend(gpg.errors)
+        errors, data = gpg.decrypt(data)
+        _errors.extend(errors)
         if not data:
             logger.error('empty data after gpg decrypt')
             _errors.append('gpg -> no data')
             return _errors, None
 
     # First check if the data matches any magic strings
-    did_decompress = False
+    codec = None
     if detect_compression:
-        if data[1:5] == '7zXZ':
-            data = xz_decompress(data)
-            did_decompress = True
-        elif data[4:10] == 'sNaPpY':
-            data = snappy_decompress(data)
-            did_decompress = True
-        elif data[0:3] == '\x1f\x8b\x08':  # gzip+deflate section header bytes
-            data = gzip_decompress(data)
-            did_decompress = True
-        # else fall through and use a named decompression or raw data
-    # Next do decompression based on compression config
-    if did_decompress:
-        pass
-    elif compression == 'xz':
-        data = xz_decompress(data)
-    elif compression == 'sz':
-        data = snappy_decompress(data)
-    elif compression == 'gz':
-        data = gzip_decompress(data)
-    elif compression == "" or compression is None:
-        ## data is not compressed
-        pass
+        codec = detect_codec(data)
+    # else fall through and use a named decompression or raw data
+    if codec is None and isinstance(compression, Codec):
+        codec = compression
+    elif codec is None:
+        codec = codecs.get(compression)
+    if codec is not None:
+        data = codec.decompress(data)
 
     return _errors, data
 
 
 def snappy_decompress(data):
-    if sz is None:
-        raise RuntimeError('Snappy decompression is not available')
-    ## sz.decompress is broken per https://github.com/andrix/python-snappy/issues/28
-    fh = StringIO()
-    sz.stream_decompress(StringIO(data), fh)
-    return fh.getvalue()
+    return codecs['sz'].decompress(data)
 
 
 def gzip_decompress(data):
-    fh = StringIO(data)
-    gz_fh = gz.GzipFile(fileobj=fh, mode='r')
-    data = gz_fh.read(data)
-    return data
+    return codecs['gz'].decompress(data)
 
 
 def xz_decompress(data):
@@ -622,140 +1260,72 @@ def xz_decompress(data):
     available then the commandline `xz --decompress` tool
 
     '''
-    if xz is not None:
-        try:
-            bigdata = xz.decompress(data)
-            data = bigdata
-        except:
-            logger.error('decompress of %s bytes failed', len(data))
-            raise
-
-    else:
-        ## launch xz child
-        xz_child = subprocess.Popen(
-            ['xz', '--decompress'],
-            stdin=subprocess.PIPE,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE)
-        ## use communicate to pass the data incrementally to the child
-        ## while reading the output, to avoid blocking
-        data, errors = xz_child.communicate(data)
-        assert not errors, errors
-
-    return data
+    return codecs['xz'].decompress(data)
 
 
 def xz_compress(data):
-    '''decompress xz `data` using backports.lzma, or if that's not
-    available then the commandline `xz --decompress` tool
+    '''compress `data` with xz using backports.lzma, or if that's not
+    available then the commandline `xz --compress` tool
 
     '''
-    if xz is not None:
-        try:
-            data = xz.compress(data)
-        except:
-            logger.error('decompress of %s bytes failed', len(data))
-            raise
-
-    else:
-        ## launch xz child
-        xz_child = subprocess.Popen(
-            ['xz', '--compress'],
-            stdin=subprocess.PIPE,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE)
-        ## use communicate to pass the data incrementally to the child
-        ## while reading the output, to avoid blocking
-        data, errors = xz_child.communicate(data)
-
-        assert not errors, errors
-
-    return data
+    return codecs['xz'].compress(data)
 
 
 def compress_and_encrypt(data, gpg_public=None, gpg_recipient='trec-kba',
-                         tmp_dir=None, compression='xz'):
+                         tmp_dir=None, compression='xz', gpg=None,
+                         compression_level=None):
     '''Given a data buffer of bytes compress it using the `compression`
     scheme, if gpg_public is provided, encrypt data using gnupg.
-    Compression can be "xz", "sz", "gz", or ""
+    Compression can be the name of any of the `codecs`, e.g. "xz",
+    "sz", "gz", "zst", or "lz4", or "" for none, or a Codec such as a
+    ZstdCodec with a trained dictionary, and `compression_level` a
+    level in the codec's range.
+
+    To encrypt many buffers, pass a GpgContext holding the public key
+    as `gpg` instead of gpg_public, so that the key is imported only
+    once.
+
+    :returns: a tuple of (logs, data), where data is None if
+      gpg_public could not be imported
 
     '''
     _errors = []
 
-    known_compression_schemes = set(['xz', 'gz', ''])
-    if sz is not None:
-        known_compression_schemes.add('sz')
-    if compression not in known_compression_schemes:
-        raise ValueError('Unrecognized compression scheme %s (known: %r)' %
-                         (compression, known_compression_schemes))
-
-    if compression == 'xz':
-        data = xz_compress(data)
-    elif compression == 'sz':
-        if sz is None:
-            raise RuntimeError('Snappy compression is not available')
-        ## sz.compress is broken per https://github.com/andrix/python-snappy/issues/28
-        fh = StringIO()
-        sz.stream_compress(StringIO(data), fh)
-        data = fh.getvalue()
-    elif compression == 'gz':
-        fh = StringIO()
-        gz_fh = gz.GzipFile(fileobj=fh, mode='w')
-        gz_fh.write(data)
-        gz_fh.close()
-        data = fh.getvalue()
-    elif compression == "" or compression is None:
-        pass
-
-    if gpg_public is not None:
-        ### setup gpg for encryption.
-        gpg_dir = os.tempnam(tmp_dir, 'tmp-compress-and-encrypt-')
-        os.makedirs(gpg_dir)
-        try:
+    codec = get_codec(compression)
+    if codec is not None:
+        data = codec.compress(data, compression_level)
 
-            ## Load public key.  Could do this just once, but performance
-            ## hit is minor and code simpler to do it everytime
-            gpg_child = subprocess.Popen(
-                ['gpg', '--no-permission-warning', '--homedir', gpg_dir,
-                 '--import', gpg_public],
-                stderr=subprocess.PIPE)
-            s_out, errors = gpg_child.communicate()
-            if errors:
-                _errors.append('gpg logs to stderr, read carefully:\n\n%s' %
-                               errors)
-
-            ## encrypt using the fingerprint for our trec-kba-rsa key pair
-            gpg_child = subprocess.Popen(
-                ## setup gpg to decrypt with trec-kba private key
-                ## (i.e. make it the recipient), with zero compression,
-                ## ascii armoring is off by default, and --output - must
-                ## appear before --encrypt -
-                ['gpg',  '--no-permission-warning', '--homedir', gpg_dir,
-                 '-r', gpg_recipient, '-z', '0', '--trust-model', 'always',
-                 '--output', '-', '--encrypt', '-'],
-                stdin =subprocess.PIPE,
-                stdout=subprocess.PIPE,
-                stderr=subprocess.PIPE)
-            ## communicate with child via its stdin
-            data, errors = gpg_child.communicate(data)
-            if errors:
-                _errors.append(errors)
-
-        finally:
-            shutil.rmtree(gpg_dir, ignore_errors=True)
+    if gpg is None and gpg_public is not None:
+        ## a one-off context, which pays for importing the key
+        try:
+            gpg = GpgContext(gpg_public=gpg_public, tmp_dir=tmp_dir)
+        except RuntimeError, exc:
+            ## a bad key is reported in the logs, not raised
+            logger.error('importing gpg_public failed: %s', exc)
+            return [str(exc)], None
+        with gpg:
+            _errors.extend(gpg.errors)
+            errors, data = gpg.encrypt(data, gpg_recipient)
+            _errors.extend(errors)
+    elif gpg is not None:
+        errors, data = gpg.encrypt(data, gpg_recipient)
+        _errors.extend(errors)
 
     return _errors, data
 
 
-known_compression_schemes = set(['xz', 'gz', 'sz', '', None])
-file_extensions_re = re.compile('.*?(\.(?P<type>(fc|sc)))?(\.(?P<compression>(xz|gz|sz)))?(\.(?P<encryption>gpg))?$')
+file_extensions_re = re.compile(
+    '.*?(\.(?P<type>(fc|sc|scb)))?(\.(?P<compression>(%s)))?(\.(?P<encryption>gpg))?$'
+    % '|'.join(sorted(codecs)))
 
 def parse_file_extensions(path):
     '''accepts a `path` string (can be just a filename) and parses the
     extensions at the end of the file for up to three different
     components:  type.compression.encryption
 
-      <name>.<type=(fc|sc)>.<compression=(xz|gz|sz)>.<encryption=gpg>
+      <name>.<type=(fc|sc|scb)>.<compression=(xz|gz|sz|zst|lz4)>.<encryption=gpg>
+
+    where the compression is the name of any of the `codecs`.
 
     '''
     m = file_extensions_re.match(path)
@@ -767,12 +1337,17 @@ def parse_file_extensions(path):
 
 def compress_and_encrypt_path(path, gpg_public=None, gpg_recipient='trec-kba',
                               compression='xz',
-                              tmp_dir='/tmp'):
+                              tmp_dir='/tmp', gpg=None, compression_level=None):
     '''Given a path in the local file system, compress it using
     `compression`, which defaults to "xz", if gpg_public is provided,
-    encrypt data using gnupg.
+    encrypt data using gnupg.  As for compress_and_encrypt, `gpg` can
+    be a GpgContext holding the public key.
 
-    :param compression: can be either "xz", "sz", or ""
+    :param compression: the name of any of the `codecs`, e.g. "xz",
+    "sz", "zst", or "lz4", or "" for none
+
+    :param compression_level: level in the codec's range, or None for
+    its default
 
     :returns: path to file to a new file containing the of encrypted,
     compressed data
@@ -783,63 +1358,49 @@ def compress_and_encrypt_path(path, gpg_public=None, gpg_recipient='trec-kba',
     _errors = []
     assert os.path.exists(path), path
 
-    if compression is None:
-        compression = ''
-
-    commands = {
-        'xz': 'xz --compress < ' + path,
-        'sz': 'python -m snappy -c < ' + path,
-        'gz': 'gzip -c < ' + path,
-        '': 'cat ' + path,
-        }
-    command = commands.get(compression)
+    stages = []
+    if get_codec(compression) is not None:
+        stages.append(compress_stage(compression, compression_level))
 
     tmp_path = os.path.join(tmp_dir, 'tmp-compress-and-encrypt-path-' + uuid.uuid4().hex)
     if not os.path.exists(tmp_path):
         os.makedirs(tmp_path)
 
-    if gpg_public is not None:
-        ### setup gpg for encryption.
-        gpg_dir = os.path.join(tmp_path, 'gpg_dir')
-        os.makedirs(gpg_dir)
-
-        ## Load public key.  Could do this just once, but performance
-        ## hit is minor and code simpler to do it everytime
-        gpg_child = subprocess.Popen(
-            ['gpg', '--quiet', '--no-permission-warning', '--homedir', gpg_dir,
-             '--import', gpg_public],
-            stderr=subprocess.PIPE)
-        s_out, errors = gpg_child.communicate()
-        if gpg_child.returncode != 0:
-            _errors.append('gpg setup exited with status {0}\n'.format(gpg_child.returncode))
-            _errors.append('gpg logs to stderr, read carefully:\n\n' + errors)
-
-        ## setup gpg to decrypt with provided private key (i.e. make
-        ## it the recipient), with zero compression, ascii armoring is
-        ## off by default, and --output - must come before --encrypt -
-        command += '| gpg --quiet --no-permission-warning --homedir ' + gpg_dir \
-                 + ' -r ' + gpg_recipient \
-                 + ' -z 0 --trust-model always --output - --encrypt - '
+    ## a one-off context, which pays for importing the key
+    gpg_context = None
+    if gpg is None and gpg_public is not None:
+        try:
+            gpg = gpg_context = GpgContext(gpg_public=gpg_public, tmp_dir=tmp_path)
+        except RuntimeError, exc:
+            _errors.append(str(exc))
+            return _errors, None
+        _errors.extend(gpg.errors)
+
+    if gpg is not None:
+        stages.append(encrypt_stage(gpg, gpg_recipient))
 
     ## we want to capture any errors, so do all the work before
     ## returning.  Store the intermediate result in this temp file:
     o_path = os.path.join(tmp_path, 'o_path')
-    e_path = os.path.join(tmp_path, 'e_path')
-
-    command += ' 1> ' + o_path
-
-    logger.debug('compress_and_encrypt_path command %r', command)
-    p = subprocess.Popen(command, shell=True, stderr=subprocess.PIPE)
-    p_stdout, p_stderr = p.communicate()
-    # p_stdout should be empty because we're redirecting to o_path
-    if p.returncode != 0:
-        _errors.append('command return code {0}'.format(p.returncode))
-        _errors.append(p_stderr)
-    elif p_stderr:
-        # sometimes returncode is zero on failures
-        _errors.append(p_stderr)
-
-    if gpg_public is not None:
-        shutil.rmtree(gpg_dir, ignore_errors=True)
+
+    pipeline = ChunkPipeline(open(path, 'rb'), stages)
+    try:
+        with open(o_path, 'wb') as o_fh:
+            while True:
+                block = pipeline.read(2**20)
+                if not block:
+                    break
+                o_fh.write(block)
+        logger.debug('compress_and_encrypt_path %s', pipeline.format_stats())
+        for stage in pipeline.stages:
+            # sometimes returncode is zero on failures
+            if getattr(stage, 'stderr', None):
+                _errors.append(stage.stderr)
+    except IOError, exc:
+        _errors.append(str(exc))
+    finally:
+        pipeline.close()
+        if gpg_context is not None:
+            gpg_context.close()
 
     return _errors, o_path
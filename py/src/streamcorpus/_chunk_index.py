@@ -0,0 +1,245 @@
+#!/usr/bin/env python
+'''
+Provides a sidecar index for flat files of Thrift messages, so that a
+single message can be read from a chunk by seeking directly to it
+instead of deserializing every message that precedes it.
+
+The index is a small text file stored next to the chunk, e.g.
+`foo.sc.idx` for `foo.sc`.  Each line records the byte offset and
+length of one message in the *uncompressed* stream of messages, along
+with its stream_id, doc_id, and abs_url.
+
+This software is released under an MIT/X11 open source license.
+
+Copyright 2012-2015 Diffeo, Inc.
+'''
+from __future__ import absolute_import
+
+import collections
+import logging
+import os
+from cStringIO import StringIO
+
+from thrift.transport import TTransport
+
+from ._projection import project_spec, read_projected
+
+logger = logging.getLogger('streamcorpus')
+
+INDEX_EXTENSION = '.idx'
+
+_HEADER = '#streamcorpus-chunk-index v1\n'
+
+IndexEntry = collections.namedtuple(
+    'IndexEntry', ['offset', 'length', 'stream_id', 'doc_id', 'abs_url'])
+
+
+def index_path_for(path):
+    '''returns the path of the sidecar index for the chunk at `path`
+    '''
+    return path + INDEX_EXTENSION
+
+
+def id_spec(message):
+    '''returns a thrift_spec for `message` that decodes only the
+    identifiers that go in an index
+    '''
+    return project_spec(message, [
+        name for name in ('stream_id', 'doc_id', 'abs_url')
+        if name in message.__slots__])
+
+
+def _escape(val):
+    if val is None:
+        return ''
+    if isinstance(val, unicode):
+        val = val.encode('utf8')
+    return val.encode('string_escape')
+
+
+def _unescape(val):
+    if not val:
+        return None
+    return val.decode('string_escape')
+
+
+class ChunkIndex(object):
+    '''
+    In-memory form of a chunk index sidecar.  Entries are kept in the
+    order of the messages in the chunk, so `index[n]` is the n-th
+    message.
+    '''
+    def __init__(self, entries=None):
+        self.entries = []
+        self._by_stream_id = {}
+        self._by_doc_id = {}
+        self._by_abs_url = {}
+        for entry in entries or []:
+            self.add(*entry)
+
+    def add(self, offset, length, stream_id=None, doc_id=None, abs_url=None):
+        'record the position of the next message in the chunk'
+        entry = IndexEntry(offset, length, stream_id, doc_id, abs_url)
+        pos = len(self.entries)
+        self.entries.append(entry)
+        if stream_id is not None:
+            self._by_stream_id.setdefault(stream_id, pos)
+        if doc_id is not None:
+            self._by_doc_id.setdefault(doc_id, []).append(pos)
+        if abs_url is not None:
+            self._by_abs_url.setdefault(abs_url, []).append(pos)
+        return entry
+
+    @property
+    def end(self):
+        '''byte offset just past the last indexed message, i.e. where
+        the next message will be written
+        '''
+        if not self.entries:
+            return 0
+        last = self.entries[-1]
+        return last.offset + last.length
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __getitem__(self, n):
+        return self.entries[n]
+
+    def __iter__(self):
+        return iter(self.entries)
+
+    def find(self, stream_id=None, doc_id=None, abs_url=None):
+        '''returns a list of positions of messages matching any of the
+        given identifiers, in chunk order
+        '''
+        positions = set()
+        if stream_id is not None and stream_id in self._by_stream_id:
+            positions.add(self._by_stream_id[stream_id])
+        if doc_id is not None:
+            positions.update(self._by_doc_id.get(doc_id, []))
+        if abs_url is not None:
+            positions.update(self._by_abs_url.get(abs_url, []))
+        return sorted(positions)
+
+    def dump(self, fh):
+        'write the index to the file handle `fh`'
+        fh.write(_HEADER)
+        for entry in self.entries:
+            fh.write('%d\t%d\t%s\t%s\t%s\n' % (
+                entry.offset, entry.length, _escape(entry.stream_id),
+                _escape(entry.doc_id), _escape(entry.abs_url)))
+
+    def save(self, path):
+        '''write the index to `path` via a temp file, so that readers
+        never see a partially written index
+        '''
+        t_path = path + '.tmp'
+        with open(t_path, 'wb') as fh:
+            self.dump(fh)
+        os.rename(t_path, path)
+
+    @classmethod
+    def load(cls, fh):
+        'construct an index from the file handle `fh`'
+        header = fh.readline()
+        if header != _HEADER:
+            raise ValueError('not a streamcorpus chunk index: %r' % header)
+        index = cls()
+        for line in fh:
+            offset, length, stream_id, doc_id, abs_url = \
+                line.rstrip('\n').split('\t')
+            index.add(int(offset), int(length), _unescape(stream_id),
+                      _unescape(doc_id), _unescape(abs_url))
+        return index
+
+    @classmethod
+    def load_path(cls, path):
+        '''construct an index from the file at `path`, or return None if
+        there is no such file
+        '''
+        if not os.path.exists(path):
+            return None
+        with open(path, 'rb') as fh:
+            return cls.load(fh)
+
+    @classmethod
+    def build(cls, i_chunk_fh, message, protocol):
+        '''construct an index by scanning every message in an already
+        open chunk file handle.  This is what a writer does when it
+        appends to a chunk that has no sidecar yet.
+        '''
+        index = cls()
+        i_transport = OffsetTransport(i_chunk_fh)
+        i_protocol = protocol(i_transport)
+        spec = id_spec(message)
+        while 1:
+            offset = i_transport.tell()
+            msg = message()
+            try:
+                read_projected(msg, i_protocol, spec)
+            except EOFError:
+                break
+            index.add(offset, i_transport.tell() - offset,
+                      getattr(msg, 'stream_id', None),
+                      getattr(msg, 'doc_id', None),
+                      getattr(msg, 'abs_url', None))
+        return index
+
+
+class OffsetTransport(TTransport.TTransportBase, TTransport.CReadableTransport):
+    '''
+    Read-only buffered transport, equivalent to TBufferedTransport,
+    that also knows how many bytes the protocol has consumed, so that
+    callers can record where each message starts and ends.
+    '''
+    DEFAULT_BUFFER = 64 * 1024
+
+    def __init__(self, fh, rbuf_size=DEFAULT_BUFFER):
+        self._fh = fh
+        self._rbuf = StringIO('')
+        self._rbuf_len = 0
+        ## number of bytes of the stream that precede self._rbuf
+        self._base = 0
+        self._rbuf_size = rbuf_size
+
+    def tell(self):
+        return self._base + self._rbuf.tell()
+
+    def _reset(self, data, consumed):
+        self._base += consumed
+        self._rbuf = StringIO(data)
+        self._rbuf_len = len(data)
+
+    def read(self, sz):
+        ret = self._rbuf.read(sz)
+        if len(ret) != 0:
+            return ret
+        self._reset(self._fh.read(max(sz, self._rbuf_size)), self._rbuf_len)
+        return self._rbuf.read(sz)
+
+    def readAll(self, sz):
+        buff = ''
+        while len(buff) < sz:
+            chunk = self.read(sz - len(buff))
+            if len(chunk) == 0:
+                raise EOFError()
+            buff += chunk
+        return buff
+
+    ## Implement the CReadableTransport interface.
+    @property
+    def cstringio_buf(self):
+        return self._rbuf
+
+    def cstringio_refill(self, partialread, reqlen):
+        retstring = partialread
+        if reqlen < self._rbuf_size:
+            retstring += self._fh.read(self._rbuf_size)
+        while len(retstring) < reqlen:
+            chunk = self._fh.read(reqlen - len(retstring))
+            if not chunk:
+                raise EOFError()
+            retstring += chunk
+        self._reset(retstring, self._rbuf_len - len(partialread))
+        return self._rbuf
@@ -0,0 +1,711 @@
+#!/usr/bin/env python
+'''
+Registry of the compression codecs for chunk files.
+
+Each Codec is named like the file extension it is used for, e.g. xz
+for foo.sc.xz, and knows its magic bytes, how to compress and
+decompress incrementally with its python library, and the command
+line tool to use instead when that library is not installed.  Chunk,
+decrypt_and_uncompress, compress_and_encrypt,
+compress_and_encrypt_path, parse_file_extensions, and BlockChunk all
+look codecs up here, so a codec added with register_codec is
+available to all of them.
+
+Built in are xz, gz, sz (snappy framing), zst (zstandard), and lz4
+(lz4 frames).  zst reads several times faster than xz at a similar
+ratio.
+
+zstandard can also compress with a dictionary trained on sample
+messages, see train_dictionary and ZstdCodec, which is what makes
+small chunks and single messages compress well.
+
+This software is released under an MIT/X11 open source license.
+
+Copyright 2012-2015 Diffeo, Inc.
+'''
+from __future__ import absolute_import
+
+from distutils.spawn import find_executable
+import logging
+import os
+import subprocess
+import threading
+import zlib
+
+try:
+    from backports import lzma as xz
+except ImportError:
+    xz = None
+
+from ._snappy import STREAM_IDENTIFIER, FrameCompressor, FrameDecompressor, sz
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import lz4.frame as lz4_frame
+except ImportError:
+    lz4_frame = None
+
+logger = logging.getLogger('streamcorpus')
+
+XZ_MAGIC = '\xfd7zXZ\x00'
+
+
+class Codec(object):
+    '''
+    A compression scheme for chunk files.  Subclasses set `name`,
+    which is also the file extension, `magic`, the bytes that start
+    compressed data, and `library`, the module that implements it or
+    None if it is not installed, and say how to make incremental
+    compressors and decompressors and the equivalent commands.
+
+    `level` is a compression level in the codec's own range, or None
+    for its default.
+    '''
+    name = None
+    magic = None
+    library = None
+
+    def new_compressor(self, level=None):
+        '''returns an object with compress(data) and flush() methods,
+        like zlib.compressobj
+        '''
+        raise NotImplementedError()
+
+    def new_decompressor(self):
+        '''returns an object with a decompress(data) method, and
+        `unused_data` and `eof` if it can tell where a stream ends
+        '''
+        raise NotImplementedError()
+
+    def compress_command(self, level=None, threads=False):
+        '''returns the command line that compresses stdin to stdout,
+        using all cores if `threads` and the tool can
+        '''
+        raise NotImplementedError()
+
+    def decompress_command(self):
+        'returns the command line that decompresses stdin to stdout'
+        raise NotImplementedError()
+
+    @property
+    def has_command(self):
+        'whether the command line tool is installed'
+        return find_executable(self.decompress_command()[0]) is not None
+
+    @property
+    def available(self):
+        'whether this codec can be used at all, in process or not'
+        return self.library is not None or self.has_command
+
+    def compressor(self, level=None):
+        '''returns a function that compresses each block passed to it,
+        and returns the end of the compressed stream when passed None,
+        as for a FuncStage
+        '''
+        compressor = self.new_compressor(level)
+        def compress(block):
+            if block is None:
+                return compressor.flush()
+            return compressor.compress(block)
+        return compress
+
+    def decompressor(self):
+        '''returns a function that decompresses each block passed to it,
+        and checks that the input was complete when passed None, as
+        for a FuncStage.  Concatenated streams are decompressed one
+        after another.
+        '''
+        return _Decompressor(self)
+
+    def compress(self, data, level=None):
+        'compress the bytes `data`'
+        if self.library is None:
+            return self._run(self.compress_command(level), data)
+        compressor = self.compressor(level)
+        return compressor(data) + compressor(None)
+
+    def decompress(self, data):
+        'decompress the bytes `data`'
+        if self.library is None:
+            return self._run(self.decompress_command(), data)
+        decompressor = self.decompressor()
+        return decompressor(data) + decompressor(None)
+
+    def _run(self, command, data):
+        if not self.has_command:
+            raise RuntimeError('%s compression is not available: neither its '
+                               'library nor %s is installed' % (self.name, command[0]))
+        child = subprocess.Popen(command, stdin=subprocess.PIPE,
+                                 stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                                 close_fds=True)
+        ## communicate feeds stdin while reading stdout, so neither blocks
+        data, errors = child.communicate(data)
+        if child.returncode != 0:
+            raise IOError('%s exited with status %d:\n%s' % (
+                ' '.join(command), child.returncode, errors))
+        return data
+
+    def __repr__(self):
+        return '<%s %s>' % (self.__class__.__name__, self.name)
+
+
+class _Decompressor(object):
+    'see Codec.decompressor'
+    def __init__(self, codec, new_decompressor=None):
+        self._codec = codec
+        self._new = new_decompressor or codec.new_decompressor
+        self._decompressor = self._new()
+
+    def _finished(self):
+        eof = getattr(self._decompressor, 'eof', None)
+        if eof is None:
+            ## python 2 zlib only tells by having bytes left over
+            return bool(getattr(self._decompressor, 'unused_data', ''))
+        return eof
+
+    def __call__(self, block):
+        if block is None:
+            if getattr(self._decompressor, 'eof', True) is False:
+                raise EOFError('%s input ended before the end of the stream'
+                               % self._codec.name)
+            if hasattr(self._decompressor, 'flush'):
+                ## zstandard's returns None
+                return self._decompressor.flush() or ''
+            return ''
+        out = []
+        while block:
+            if self._finished():
+                ## the next of several concatenated streams
+                self._decompressor = self._new()
+            out.append(self._decompressor.decompress(block))
+            block = getattr(self._decompressor, 'unused_data', '')
+        return ''.join(out)
+
+
+class XzCodec(Codec):
+    name = 'xz'
+    magic = XZ_MAGIC
+    library = xz
+
+    def new_compressor(self, level=None):
+        if level is None:
+            return xz.LZMACompressor()
+        return xz.LZMACompressor(preset=level)
+
+    def new_decompressor(self):
+        return xz.LZMADecompressor()
+
+    def compress_command(self, level=None, threads=False):
+        command = ['xz', '--compress', '--stdout']
+        if level is not None:
+            command.append('-%d' % level)
+        if threads:
+            command.append('--threads=0')
+        return command
+
+    def decompress_command(self):
+        return ['xz', '--decompress', '--stdout']
+
+
+class GzipCodec(Codec):
+    name = 'gz'
+    ## gzip header with the deflate method
+    magic = '\x1f\x8b\x08'
+    library = zlib
+
+    ## makes zlib read and write gzip headers
+    WBITS = 16 + zlib.MAX_WBITS
+
+    def new_compressor(self, level=None):
+        if level is None:
+            level = zlib.Z_DEFAULT_COMPRESSION
+        return zlib.compressobj(level, zlib.DEFLATED, self.WBITS)
+
+    def new_decompressor(self):
+        return zlib.decompressobj(self.WBITS)
+
+    def compress_command(self, level=None, threads=False):
+        command = ['gzip', '--stdout']
+        if level is not None:
+            command.append('-%d' % level)
+        return command
+
+    def decompress_command(self):
+        return ['gzip', '--decompress', '--stdout']
+
+
+class SnappyCodec(Codec):
+    '''
+    snappy framing format, see FrameCompressor and FrameDecompressor
+    '''
+    name = 'sz'
+    magic = STREAM_IDENTIFIER
+    library = sz
+
+    def new_compressor(self, level=None):
+        return FrameCompressor()
+
+    def new_decompressor(self):
+        return FrameDecompressor()
+
+    def decompress(self, data):
+        '''decompress the bytes `data` in process, since
+        FrameDecompressor needs python-snappy only for compressed
+        frames
+        '''
+        decompressor = self.decompressor()
+        return decompressor(data) + decompressor(None)
+
+    @property
+    def has_command(self):
+        ## python -m snappy needs the same library
+        return self.library is not None
+
+    def compress_command(self, level=None, threads=False):
+        return ['python', '-m', 'snappy', '-c']
+
+    def decompress_command(self):
+        return ['python', '-m', 'snappy', '-d']
+
+
+## dict_id --> ZstdCompressionDict, see register_dictionary
+zstd_dictionaries = {}
+
+## bytes in a trained dictionary, the zstd command's default
+DICTIONARY_SIZE = 112640
+
+## zstandard (de)compressors are not thread safe, so each thread keeps
+## its own for reuse
+_local = threading.local()
+
+def _zstd_decompressor(dict_id):
+    '''returns this thread's ZstdDecompressor for the dictionary
+    `dict_id`, which is costly to load for every small message
+    '''
+    cache = _local.__dict__.setdefault('decompressors', {})
+    if dict_id not in cache:
+        if dict_id:
+            cache[dict_id] = zstandard.ZstdDecompressor(
+                dict_data=zstd_dictionaries[dict_id])
+        else:
+            cache[dict_id] = zstandard.ZstdDecompressor()
+    return cache[dict_id]
+
+
+def register_dictionary(dictionary):
+    '''make the zstandard `dictionary`, a ZstdCompressionDict or the
+    bytes of one, available for decompressing the frames that name
+    its id, and return it as a ZstdCompressionDict
+    '''
+    if zstandard is None:
+        raise RuntimeError('zstd dictionaries require zstandard')
+    if not isinstance(dictionary, zstandard.ZstdCompressionDict):
+        dictionary = zstandard.ZstdCompressionDict(dictionary)
+    if not dictionary.dict_id():
+        raise ValueError('a dictionary without an id cannot be found again '
+                         'from the frames compressed with it')
+    zstd_dictionaries[dictionary.dict_id()] = dictionary
+    return dictionary
+
+
+def load_dictionary(path):
+    '''register the zstandard dictionary in the file at `path`, as
+    written by streamcorpus_zstd_dictionary or `zstd --train`, and
+    return it
+    '''
+    with open(path, 'rb') as fh:
+        return register_dictionary(fh.read())
+
+
+def train_dictionary(samples, size=DICTIONARY_SIZE, level=None):
+    '''train a zstandard dictionary of at most `size` bytes on the byte
+    strings in `samples`, such as serialized messages, tuned for
+    compressing at `level`.  The dictionary is registered and
+    returned; its as_bytes() can be saved for load_dictionary.
+    '''
+    if zstandard is None:
+        raise RuntimeError('training a dictionary requires zstandard')
+    dictionary = zstandard.train_dictionary(size, list(samples), level=level or 0)
+    return register_dictionary(dictionary)
+
+
+class _ZstdFrame(object):
+    '''
+    Decompresses one zstandard frame, with the registered dictionary
+    that its header names, if any.  Walking the headers of the frame
+    and its blocks also gives the `eof` and `unused_data` that
+    versions of zstandard before 0.15 lack, without which a second
+    frame, such as one appended by mode='ab', could not be read.
+
+    If `reuse`, this thread's decompressors are used, which is only
+    safe if the frame is decompressed before another one starts.
+    '''
+    def __init__(self, reuse=False):
+        self._reuse = reuse
+        self._obj = None
+        ## frame bytes read before self._obj could be made
+        self._pending = []
+        self.eof = False
+        self.unused_data = ''
+        ## bytes of the next header, how many it has, and what it is
+        self._header = ''
+        self._header_len = 5
+        self._state = 'magic'
+        self._dict_id_len = 0
+        self._window_len = 0
+        self._checksum_len = 0
+        self._last = False
+        ## bytes to pass over before the next header
+        self._skip = 0
+
+    def _start(self, dict_id):
+        if dict_id and dict_id not in zstd_dictionaries:
+            raise IOError('zstd frame needs dictionary %d, which is not '
+                          'registered, see load_dictionary' % dict_id)
+        if self._reuse:
+            self._obj = _zstd_decompressor(dict_id).decompressobj()
+        elif dict_id:
+            self._obj = zstandard.ZstdDecompressor(
+                dict_data=zstd_dictionaries[dict_id]).decompressobj()
+        else:
+            self._obj = zstandard.ZstdDecompressor().decompressobj()
+
+    def _parse(self, header):
+        if self._state == 'magic':
+            if header[:4] != ZstdCodec.magic:
+                raise IOError('not a zstd frame: %r' % header[:4])
+            fhd = ord(header[4])
+            single_segment = (fhd >> 5) & 1
+            if fhd & 4:
+                self._checksum_len = 4
+            self._window_len = 1 - single_segment
+            self._dict_id_len = (0, 1, 2, 4)[fhd & 3]
+            ## always at least one byte, of window or content size
+            self._header_len = (self._window_len + self._dict_id_len
+                                + (single_segment, 2, 4, 8)[fhd >> 6])
+            self._state = 'frame'
+            return
+        if self._state == 'frame':
+            dict_id = 0
+            for i in reversed(range(self._dict_id_len)):
+                dict_id = dict_id << 8 | ord(header[self._window_len + i])
+            self._start(dict_id)
+            self._header_len = 3
+            self._state = 'block'
+            return
+        block = ord(header[0]) | ord(header[1]) << 8 | ord(header[2]) << 16
+        if (block >> 1) & 3 == 1:
+            ## an RLE block stores its one byte
+            self._skip = 1
+        else:
+            self._skip = block >> 3
+        if block & 1:
+            self._last = True
+            self._skip += self._checksum_len
+            if not self._skip:
+                self.eof = True
+
+    def decompress(self, data):
+        pos = 0
+        while pos < len(data) and not self.eof:
+            if self._skip:
+                step = min(self._skip, len(data) - pos)
+                pos += step
+                self._skip -= step
+                if self._last and not self._skip:
+                    self.eof = True
+                continue
+            need = self._header_len - len(self._header)
+            self._header += data[pos:pos + need]
+            pos += min(need, len(data) - pos)
+            if len(self._header) == self._header_len:
+                header, self._header = self._header, ''
+                self._parse(header)
+        self.unused_data += data[pos:]
+        frame = data[:pos]
+        if self._obj is None:
+            self._pending.append(frame)
+            return ''
+        if self._pending:
+            frame = ''.join(self._pending) + frame
+            self._pending = []
+        return self._obj.decompress(frame) if frame else ''
+
+    def flush(self):
+        return ''
+
+
+class ZstdCodec(Codec):
+    '''
+    zstandard, optionally with a trained `dictionary`, which makes
+    small chunks and single serialized messages compress far better.
+    Each frame names the id of its dictionary, and any registered
+    dictionary is found by that id when decompressing, so a codec with
+    a dictionary is only needed for compressing.
+    '''
+    name = 'zst'
+    magic = '\x28\xb5\x2f\xfd'
+    library = zstandard
+
+    def __init__(self, dictionary=None):
+        if dictionary is not None:
+            dictionary = register_dictionary(dictionary)
+        self.dictionary = dictionary
+        self._local = threading.local()
+
+    def _zstd_compressor(self, level):
+        kwargs = {}
+        if level is not None:
+            kwargs['level'] = level
+        if self.dictionary is not None:
+            kwargs['dict_data'] = self.dictionary
+        return zstandard.ZstdCompressor(**kwargs)
+
+    def new_compressor(self, level=None):
+        return self._zstd_compressor(level).compressobj()
+
+    def new_decompressor(self):
+        return _ZstdFrame()
+
+    def compress(self, data, level=None):
+        if self.library is None:
+            return super(ZstdCodec, self).compress(data, level)
+        ## reuse this thread's compressor, which matters for small
+        ## messages and a dictionary
+        cache = self._local.__dict__.setdefault('compressors', {})
+        if level not in cache:
+            cache[level] = self._zstd_compressor(level)
+        return cache[level].compress(data)
+
+    def decompress(self, data):
+        if self.library is None:
+            return super(ZstdCodec, self).decompress(data)
+        ## each frame is done within this call, so decompressors can
+        ## be reused
+        decompressor = _Decompressor(self, lambda: _ZstdFrame(reuse=True))
+        return decompressor(data) + decompressor(None)
+
+    def compress_command(self, level=None, threads=False):
+        if self.dictionary is not None:
+            raise RuntimeError('compressing with a dictionary requires zstandard')
+        command = ['zstd', '--quiet', '--stdout']
+        if level is not None:
+            if level > 19:
+                command.append('--ultra')
+            command.append('-%d' % level)
+        if threads:
+            command.append('-T0')
+        return command
+
+    def decompress_command(self):
+        return ['zstd', '--decompress', '--quiet', '--stdout']
+
+    def __repr__(self):
+        if self.dictionary is not None:
+            return '<ZstdCodec zst dictionary=%d>' % self.dictionary.dict_id()
+        return super(ZstdCodec, self).__repr__()
+
+
+class _Lz4Compressor(object):
+    def __init__(self, level):
+        self._compressor = lz4_frame.LZ4FrameCompressor(compression_level=level)
+        self._header = self._compressor.begin()
+
+    def compress(self, data):
+        header, self._header = self._header, ''
+        return header + self._compressor.compress(data)
+
+    def flush(self):
+        header, self._header = self._header, ''
+        return header + self._compressor.flush()
+
+
+class Lz4Codec(Codec):
+    name = 'lz4'
+    magic = '\x04\x22\x4d\x18'
+    library = lz4_frame
+
+    def new_compressor(self, level=None):
+        return _Lz4Compressor(level or 0)
+
+    def new_decompressor(self):
+        return lz4_frame.LZ4FrameDecompressor()
+
+    def compress_command(self, level=None, threads=False):
+        command = ['lz4', '-q', '-c']
+        if level is not None:
+            command.append('-%d' % level)
+        return command
+
+    def decompress_command(self):
+        return ['lz4', '-d', '-q', '-c']
+
+
+## name --> Codec
+codecs = {}
+
+## values accepted as `compression`, where '' and None mean none
+known_compression_schemes = set(['', None])
+
+def register_codec(codec):
+    '''make `codec`, a Codec instance, available by its name and file
+    extension, replacing any codec of the same name
+    '''
+    codecs[codec.name] = codec
+    known_compression_schemes.add(codec.name)
+
+for _codec in (XzCodec(), GzipCodec(), SnappyCodec(), ZstdCodec(), Lz4Codec()):
+    register_codec(_codec)
+
+def get_codec(name):
+    '''returns the Codec called `name`, or None for no compression,
+    i.e. '' or None.  A Codec instance, such as a ZstdCodec with a
+    dictionary, is returned as is.
+
+    :raises ValueError: for an unknown name
+    '''
+    if isinstance(name, Codec):
+        return name
+    if name in ('', None):
+        return None
+    try:
+        return codecs[name]
+    except KeyError:
+        raise ValueError('Unrecognized compression scheme %s (known: %r)' %
+                         (name, sorted(known_compression_schemes)))
+
+def detect_codec(data):
+    '''returns the Codec whose magic bytes start `data`, or None'''
+    for name in sorted(codecs):
+        codec = codecs[name]
+        if codec.magic and data.startswith(codec.magic):
+            return codec
+    return None
+
+def codec_for_path(path):
+    '''returns the Codec for the file extension of `path`, e.g. xz for
+    foo.sc.xz, or None
+    '''
+    return codecs.get(os.path.splitext(path)[1][1:])
+
+
+class codec_stream(object):
+    '''
+    Read-only file-like object that decompresses the data read from
+    `fh` with `codec` incrementally, `block_size` compressed bytes at
+    a time, so that neither the compressed nor the decompressed chunk
+    is ever held in memory as a whole.  Concatenated streams are read
+    one after another, like `xzcat` does.
+
+    Like LZMAFile, seeking is emulated: seeking forward decompresses
+    and discards data, and seeking backward starts over from the
+    beginning of `fh`.
+    '''
+    def __init__(self, fh, codec, block_size=64 * 1024):
+        if codec.library is None:
+            raise RuntimeError('streaming %s decompression requires its library'
+                               % codec.name)
+        self._fh = fh
+        self.codec = codec
+        self.mode = 'rb'
+        self.block_size = block_size
+        self._rewind()
+
+    def _rewind(self):
+        self._decompressor = self.codec.decompressor()
+        ## decompressed bytes not yet read, starting at self._pos
+        self._buf = ''
+        self._pos = 0
+        self._eof = False
+        ## number of decompressed bytes read so far
+        self._offset = 0
+
+    def _fill(self):
+        '''decompress more data into self._buf, returns False at the end
+        of the input
+        '''
+        while not self._eof:
+            block = self._fh.read(self.block_size)
+            if block:
+                data = self._decompressor(block)
+            else:
+                data = self._decompressor(None)
+                self._eof = True
+            if data:
+                self._buf = self._buf[self._pos:] + data
+                self._pos = 0
+                return True
+        return False
+
+    def read(self, size=-1):
+        if size < 0:
+            parts = [self._buf[self._pos:]]
+            self._buf = ''
+            self._pos = 0
+            while self._fill():
+                parts.append(self._buf)
+                self._buf = ''
+            data = ''.join(parts)
+            self._offset += len(data)
+            return data
+        if self._pos >= len(self._buf):
+            self._buf = ''
+            self._pos = 0
+            if not self._fill():
+                return ''
+        data = self._buf[self._pos:self._pos + size]
+        self._pos += len(data)
+        self._offset += len(data)
+        return data
+
+    def tell(self):
+        return self._offset
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        if whence == os.SEEK_CUR:
+            offset += self._offset
+        elif whence != os.SEEK_SET:
+            raise ValueError('%s cannot seek relative to the end'
+                             % self.__class__.__name__)
+        if offset < self._offset:
+            self._fh.seek(0)
+            self._rewind()
+        while self._offset < offset:
+            if not self.read(min(offset - self._offset, self.block_size)):
+                break
+
+    def close(self):
+        self._buf = ''
+        self._fh.close()
+
+
+class codec_writer(object):
+    '''
+    Write-only file-like object that compresses what is written to it
+    with `codec` at `level`, and writes the result to `fh`.  close
+    ends the compressed stream and closes `fh`.
+    '''
+    def __init__(self, fh, codec, level=None):
+        self._fh = fh
+        self.codec = codec
+        self.mode = getattr(fh, 'mode', 'wb')
+        self._compressor = codec.compressor(level)
+
+    def write(self, data):
+        data = self._compressor(data)
+        if data:
+            self._fh.write(data)
+
+    def flush(self):
+        self._fh.flush()
+
+    def close(self):
+        if self._compressor is None:
+            return
+        self._fh.write(self._compressor(None))
+        self._compressor = None
+        self._fh.close()
@@ -0,0 +1,140 @@
+#!/usr/bin/env python
+'''
+Reusable gpg keyring for encrypting and decrypting many chunks.
+
+A GpgContext imports its keys into a private --homedir once, and then
+runs one gpg child per encrypted or decrypted stream against that warm
+homedir, instead of creating a new homedir and importing the key for
+every buffer.  Data flows through the child's pipes in blocks, as a
+ProcessStage of a ChunkPipeline, so a chunk is never held in memory
+just to hand it to gpg.
+
+This software is released under an MIT/X11 open source license.
+
+Copyright 2012-2015 Diffeo, Inc.
+'''
+from __future__ import absolute_import
+
+import logging
+import os
+import shutil
+import subprocess
+import tempfile
+from cStringIO import StringIO
+
+from ._pipeline import ChunkPipeline, decrypt_stage, encrypt_stage
+
+logger = logging.getLogger('streamcorpus')
+
+
+class GpgContext(object):
+    '''
+    A private gpg homedir with keys imported once, for encrypting and
+    decrypting any number of chunks.  Pass it as `gpg` to Chunk,
+    decrypt_and_uncompress, compress_and_encrypt, or
+    compress_and_encrypt_path.  Use it as a context manager, or call
+    close, to remove the homedir.
+
+    :param gpg_private: path to a private key, for decrypting
+
+    :param gpg_public: path to a public key, for encrypting
+
+    :param gpg_recipient: default recipient when encrypting
+
+    :param tmp_dir: directory in which to make the homedir
+
+    `errors` collects what gpg logged while importing the keys.
+    Raises RuntimeError if a key cannot be imported; the one-off
+    contexts of decrypt_and_uncompress and compress_and_encrypt
+    report that in their logs instead.
+    '''
+    def __init__(self, gpg_private=None, gpg_public=None,
+                 gpg_recipient='trec-kba', tmp_dir=None, gpg_command='gpg'):
+        self.gpg_recipient = gpg_recipient
+        self.gpg_command = gpg_command
+        self.errors = []
+        ## mkdtemp makes the directory readable only by us, as gpg wants
+        self.homedir = tempfile.mkdtemp(prefix='tmp-gpg-context-', dir=tmp_dir)
+        try:
+            for key_path in (gpg_public, gpg_private):
+                if key_path is not None:
+                    self.import_key(key_path)
+        except:
+            self.close()
+            raise
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+    def command(self, *args):
+        'returns the gpg command line for `args` in this homedir'
+        return [self.gpg_command, '--batch', '--quiet', '--no-permission-warning',
+                '--homedir', self.homedir, '--trust-model', 'always'] + list(args)
+
+    def import_key(self, key_path):
+        'import the key in the file at `key_path` into this context'
+        gpg_child = subprocess.Popen(
+            self.command('--import', key_path),
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE, close_fds=True)
+        s_out, errors = gpg_child.communicate()
+        if gpg_child.returncode != 0:
+            raise RuntimeError('gpg --import %s exited with status %d:\n%s' % (
+                key_path, gpg_child.returncode, errors))
+        if errors:
+            self.errors.append('gpg logs to stderr, read carefully:\n\n%s' % errors)
+
+    def decrypt_stream(self, fh):
+        '''returns a ChunkPipeline of the decryption of the file-like
+        `fh`, which it closes when done reading
+        '''
+        return ChunkPipeline(fh, [decrypt_stage(self)])
+
+    def encrypt_stream(self, fh, gpg_recipient=None):
+        '''returns a ChunkPipeline of the encryption of the file-like `fh`
+        for `gpg_recipient`, see encrypt_stage
+        '''
+        return ChunkPipeline(fh, [encrypt_stage(self, gpg_recipient)])
+
+    def _read_all(self, pipeline):
+        try:
+            data = pipeline.read()
+        except IOError, exc:
+            return [str(exc)], None
+        finally:
+            pipeline.close()
+        ## what gpg logged, even when it succeeded
+        errors = [stage.stderr for stage in pipeline.stages
+                  if getattr(stage, 'stderr', None)]
+        return errors, data
+
+    def decrypt(self, data):
+        '''decrypt the bytes `data`
+
+        :returns: a tuple of (logs, data), like decrypt_and_uncompress
+        '''
+        return self._read_all(self.decrypt_stream(StringIO(data)))
+
+    def encrypt(self, data, gpg_recipient=None):
+        '''encrypt the bytes `data`
+
+        :returns: a tuple of (logs, data), like compress_and_encrypt
+        '''
+        return self._read_all(self.encrypt_stream(StringIO(data), gpg_recipient))
+
+    def close(self):
+        'stop any gpg-agent for the homedir, and remove it'
+        if self.homedir is None:
+            return
+        try:
+            with open(os.devnull, 'w') as devnull:
+                subprocess.call(['gpgconf', '--homedir', self.homedir,
+                                 '--kill', 'gpg-agent'],
+                                stdout=devnull, stderr=devnull)
+        except OSError:
+            ## gpg 1.x has no agent to stop
+            pass
+        shutil.rmtree(self.homedir, ignore_errors=True)
+        self.homedir = None
@@ -0,0 +1,128 @@
+#!/usr/bin/env python
+'''
+Interning of the strings that repeat across the tokens of tagged
+StreamItems, such as pos, lemma, token, Offset.content_form, and
+annotator_ids, so that a decoded chunk holds one copy of each instead
+of one per token.
+
+Chunk(intern=True) passes every message it reads through
+intern_strings with a table of its own; pass one InternTable to many
+chunks to share the copies between them.  entity_type and the other
+enums need nothing, as python already shares small ints.
+
+This software is released under an MIT/X11 open source license.
+
+Copyright 2012-2015 Diffeo, Inc.
+'''
+from __future__ import absolute_import
+import sys
+
+
+class InternTable(object):
+    '''
+    Bounded table of canonical copies of strings.  Strings that were
+    not used recently are forgotten, so the table stays under
+    `max_size` entries however many distinct strings pass through.
+
+    Eviction is approximately least recently used: strings go into a
+    young generation, and when it reaches half of `max_size`, the old
+    generation is dropped and the young one becomes old.  A string
+    found in the old generation moves back to the young one.  This
+    costs two dict lookups per string, much less than keeping an exact
+    order in an OrderedDict for millions of tokens.
+    '''
+    def __init__(self, max_size=100000):
+        assert max_size > 1, max_size
+        self.max_size = max_size
+        self._young = {}
+        self._old = {}
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._young) + len(self._old)
+
+    def __call__(self, s):
+        '''returns the canonical copy of `s`, which becomes `s` itself if
+        there is none yet
+        '''
+        young = self._young
+        canon = young.get(s)
+        if canon is not None:
+            self.hits += 1
+            return canon
+        canon = self._old.get(s)
+        if canon is None:
+            self.misses += 1
+            canon = s
+        else:
+            self.hits += 1
+        if len(young) >= self.max_size // 2:
+            self._old = young
+            self._young = young = {}
+        young[s] = canon
+        return canon
+
+    intern = __call__
+
+
+def _intern_labels(labels_map, table):
+    for labels in labels_map.itervalues():
+        for label in labels:
+            annotator = label.annotator
+            if annotator is not None and annotator.annotator_id is not None:
+                annotator.annotator_id = table(annotator.annotator_id)
+            for offset in (label.offsets or {}).itervalues():
+                if offset.content_form is not None:
+                    offset.content_form = table(offset.content_form)
+
+
+def _intern_content_item(ci, table):
+    for sentences in (ci.sentences or {}).itervalues():
+        for sentence in sentences:
+            for tok in sentence.tokens:
+                if tok.token is not None:
+                    tok.token = table(tok.token)
+                if tok.lemma is not None:
+                    tok.lemma = table(tok.lemma)
+                if tok.pos is not None:
+                    tok.pos = table(tok.pos)
+                for offset in (tok.offsets or {}).itervalues():
+                    if offset.content_form is not None:
+                        offset.content_form = table(offset.content_form)
+                if tok.labels:
+                    _intern_labels(tok.labels, table)
+            if sentence.labels:
+                _intern_labels(sentence.labels, table)
+    if ci.labels:
+        _intern_labels(ci.labels, table)
+
+
+def intern_strings(si, table):
+    '''replace the repetitive strings in the tokens and labels of the
+    StreamItem `si` with their copies in `table`, an InternTable or any
+    function from a string to an equal one
+    '''
+    if getattr(si, 'body', None) is not None:
+        _intern_content_item(si.body, table)
+    for ci in (getattr(si, 'other_content', None) or {}).itervalues():
+        _intern_content_item(ci, table)
+    for ratings in (getattr(si, 'ratings', None) or {}).itervalues():
+        for rating in ratings:
+            if rating.annotator is not None and rating.annotator.annotator_id is not None:
+                rating.annotator.annotator_id = table(rating.annotator.annotator_id)
+    return si
+
+
+def string_bytes(sis):
+    '''returns the bytes used by the strings that intern_strings
+    touches in the StreamItems `sis`, counting each distinct string
+    object once, to measure what interning saves
+    '''
+    seen = {}
+    def count(s):
+        seen[id(s)] = sys.getsizeof(s)
+        return s
+    for si in sis:
+        intern_strings(si, count)
+    return sum(seen.itervalues())
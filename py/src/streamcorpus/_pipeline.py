@@ -0,0 +1,714 @@
+#!/usr/bin/env python
+'''
+Staged pipelines for reading and writing encrypted and compressed
+chunks.
+
+A ChunkPipeline reads a file in blocks and passes them through a
+sequence of stages, e.g. decrypt then decompress, each running on its
+own thread with a bounded queue of blocks in between.  External tools
+such as gpg run as child processes fed through pipes, never through a
+shell.  The end of the pipeline is a read-only file-like object, which
+Chunk decodes from on the calling thread.
+
+Errors in any stage, including a child process exiting with a non-zero
+status, are raised as IOError from read() along with the stage name
+and what the child wrote to stderr.  `stats()` reports how many bytes
+each stage consumed and produced and how long it was busy, which shows
+which stage is the bottleneck on a given host.
+
+For reading from slow or network file systems, ReadAhead keeps reads
+of the underlying file in flight on a thread, ahead of the decoder.
+
+For writing, BackgroundWriter moves compression off the thread that
+serializes messages, and CompressorProcess runs it in a child such as
+a multi-threaded `xz -T0`.
+
+This software is released under an MIT/X11 open source license.
+
+Copyright 2012-2015 Diffeo, Inc.
+'''
+from __future__ import absolute_import
+
+import collections
+import errno
+import logging
+import os
+import Queue
+import subprocess
+import sys
+import threading
+import time
+
+from ._codecs import codec_for_path, get_codec
+
+logger = logging.getLogger('streamcorpus')
+
+## marks the end of the blocks in a queue
+_END = object()
+
+## default bytes for ReadAhead to read ahead of the caller
+PREFETCH_BYTES = 64 * 2**20
+
+
+class _Closed(Exception):
+    'the pipeline was closed before a stage finished'
+    pass
+
+
+class Stage(object):
+    '''
+    One step of a ChunkPipeline.  `run` consumes an iterator of input
+    blocks and calls `emit` with each output block.
+
+    `bytes_in` and `bytes_out` count the bytes that went through the
+    stage, and `seconds` the time it was busy, not counting waits for
+    its neighbors.
+    '''
+    def __init__(self, name):
+        self.name = name
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.seconds = 0.0
+
+    def run(self, blocks, emit):
+        raise NotImplementedError()
+
+    def close(self):
+        'stop work early, when the pipeline is closed before the end'
+        pass
+
+    def stats(self):
+        rate = self.seconds and self.bytes_in / self.seconds
+        return dict(name=self.name, bytes_in=self.bytes_in,
+                    bytes_out=self.bytes_out, seconds=self.seconds,
+                    bytes_per_second=rate)
+
+
+class FuncStage(Stage):
+    '''
+    Stage that runs `func(block)` on each block in its thread.  `func`
+    returns the output for the block, possibly '', and `func(None)`
+    is called once at the end to flush any remaining output.
+    '''
+    def __init__(self, name, func):
+        super(FuncStage, self).__init__(name)
+        self.func = func
+
+    def run(self, blocks, emit):
+        for block in blocks:
+            self.bytes_in += len(block)
+            start = time.time()
+            out = self.func(block)
+            self.seconds += time.time() - start
+            if out:
+                self.bytes_out += len(out)
+                emit(out)
+        start = time.time()
+        out = self.func(None)
+        self.seconds += time.time() - start
+        if out:
+            self.bytes_out += len(out)
+            emit(out)
+
+
+class ProcessStage(Stage):
+    '''
+    Stage that pipes blocks through the child process `command`, an
+    argument list that is run without a shell.  A second thread feeds
+    the child's stdin while this stage's thread reads its stdout.
+
+    `seconds` is the CPU time of the child, and `returncode` and
+    `stderr` are set when it exits.
+    '''
+    def __init__(self, name, command, block_size=2**20):
+        super(ProcessStage, self).__init__(name)
+        self.command = command
+        self.block_size = block_size
+        self.returncode = None
+        self.stderr = ''
+        self._child = None
+        self._feed_error = None
+
+    def _feed(self, blocks):
+        try:
+            for block in blocks:
+                self.bytes_in += len(block)
+                self._child.stdin.write(block)
+        except IOError, exc:
+            ## EPIPE means the child quit early, and its stderr says why
+            if exc.errno != errno.EPIPE:
+                self._feed_error = exc
+        except _Closed:
+            pass
+        except Exception, exc:
+            self._feed_error = exc
+        finally:
+            try:
+                self._child.stdin.close()
+            except IOError:
+                pass
+
+    def _drain_stderr(self, parts):
+        parts.append(self._child.stderr.read())
+
+    def run(self, blocks, emit):
+        self._child = subprocess.Popen(
+            self.command, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE, close_fds=True)
+        stderr = []
+        threads = [threading.Thread(target=self._feed, args=(blocks,)),
+                   threading.Thread(target=self._drain_stderr, args=(stderr,))]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        try:
+            while True:
+                ## os.read returns as soon as any output is available
+                out = os.read(self._child.stdout.fileno(), self.block_size)
+                if not out:
+                    break
+                self.bytes_out += len(out)
+                emit(out)
+        except:
+            self.close()
+            raise
+        finally:
+            for thread in threads:
+                thread.join()
+            self._wait()
+            self.stderr = ''.join(stderr)
+        if self._feed_error is not None:
+            raise self._feed_error
+        if self.returncode != 0:
+            raise IOError('%s exited with status %d:\n%s' % (
+                ' '.join(self.command), self.returncode, self.stderr))
+
+    def _wait(self):
+        ## wait4 also reports how much CPU the child used
+        pid, status, rusage = os.wait4(self._child.pid, 0)
+        self.seconds = rusage.ru_utime + rusage.ru_stime
+        if os.WIFSIGNALED(status):
+            self.returncode = -os.WTERMSIG(status)
+        else:
+            self.returncode = os.WEXITSTATUS(status)
+        ## so that Popen does not try to reap it again
+        self._child.returncode = self.returncode
+
+    def close(self):
+        if self._child is not None and self._child.returncode is None:
+            try:
+                self._child.kill()
+            except OSError:
+                pass
+
+
+def decompress_stage(compression):
+    '''returns a Stage that decompresses the codec named `compression`,
+    in this process if its library is available, or else with its
+    command line tool
+    '''
+    codec = get_codec(compression)
+    if codec is None:
+        raise ValueError('no decompress stage for %r' % compression)
+    if codec.library is not None:
+        return FuncStage('decompress', codec.decompressor())
+    return ProcessStage('decompress', codec.decompress_command())
+
+
+def compress_stage(compression, level=None):
+    '''returns a Stage that compresses with the codec named
+    `compression` at `level`, like decompress_stage
+    '''
+    codec = get_codec(compression)
+    if codec is None:
+        raise ValueError('no compress stage for %r' % compression)
+    if codec.library is not None:
+        return FuncStage('compress', codec.compressor(level))
+    return ProcessStage('compress', codec.compress_command(level))
+
+
+def decrypt_stage(gpg=None):
+    '''returns a Stage that decrypts with the keys in the GpgContext
+    `gpg`, or with the default keyring if `gpg` is None
+    '''
+    args = ['--output', '-', '--decrypt', '-']
+    if gpg is not None:
+        command = gpg.command(*args)
+    else:
+        command = ['gpg', '--batch', '--quiet', '--no-permission-warning'] + args
+    return ProcessStage('decrypt', command)
+
+
+def encrypt_stage(gpg, gpg_recipient=None):
+    '''returns a Stage that encrypts with the public key of
+    `gpg_recipient`, by default that of the GpgContext `gpg`, with
+    zero compression since chunks are compressed already
+    '''
+    ## ascii armoring is off by default, and --output - must come
+    ## before --encrypt -
+    return ProcessStage('encrypt', gpg.command(
+        '-r', gpg_recipient or gpg.gpg_recipient, '-z', '0',
+        '--output', '-', '--encrypt', '-'))
+
+
+class ChunkPipeline(object):
+    '''
+    Read-only file-like object over the output of `stages` applied to
+    the file-like `fh`, which is read `block_size` bytes at a time by
+    a "read" stage.  At most `max_blocks` blocks wait between any two
+    stages, which bounds the memory of the pipeline.
+
+    Use `ChunkPipeline.open(path)` to build the stages from the file
+    extensions of `path`.
+    '''
+    def __init__(self, fh, stages, block_size=2**20, max_blocks=4):
+        self.mode = 'rb'
+        self._fh = fh
+        self.block_size = block_size
+        self.stages = [Stage('read')] + list(stages)
+        self._error = None
+        self._closed = False
+        self._buf = ''
+        self._pos = 0
+        self._eof = False
+
+        self._queues = [Queue.Queue(max_blocks) for _ in self.stages]
+        self._threads = []
+        for i, stage in enumerate(self.stages):
+            if i == 0:
+                target = self._read
+            else:
+                target = self._run_stage
+            thread = threading.Thread(target=target, args=(i,),
+                                      name='ChunkPipeline-%s' % stage.name)
+            thread.daemon = True
+            self._threads.append(thread)
+        for thread in self._threads:
+            thread.start()
+
+    @classmethod
+    def open(cls, path, gpg=None, fh=None, **kwargs):
+        '''make a pipeline that decrypts and decompresses the file at
+        `path` according to its extensions, e.g. foo.sc.xz.gpg, read
+        from `fh` if it is already open, e.g. as a ReadAhead
+        '''
+        stages = []
+        name = path
+        if name.endswith('.gpg'):
+            stages.append(decrypt_stage(gpg))
+            name = name[:-len('.gpg')]
+        codec = codec_for_path(name)
+        if codec is not None:
+            stages.append(decompress_stage(codec.name))
+        if fh is None:
+            fh = open(path, 'rb')
+        return cls(fh, stages, **kwargs)
+
+    def _put(self, i, item):
+        '''put `item` on the output queue of stage `i`, giving up if the
+        pipeline is closed
+        '''
+        while True:
+            if self._closed:
+                raise _Closed()
+            try:
+                self._queues[i].put(item, timeout=0.1)
+                return
+            except Queue.Full:
+                pass
+
+    def _blocks(self, i):
+        'iterate over the input blocks of stage `i`'
+        while True:
+            if self._closed:
+                raise _Closed()
+            try:
+                block = self._queues[i - 1].get(timeout=0.1)
+            except Queue.Empty:
+                continue
+            if block is _END:
+                return
+            yield block
+
+    def _fail(self, i):
+        if self._error is None:
+            self._error = (self.stages[i], sys.exc_info()[1])
+        ## stop the other stages
+        self._closed = True
+
+    def _read(self, i):
+        stage = self.stages[i]
+        try:
+            while True:
+                start = time.time()
+                block = self._fh.read(self.block_size)
+                stage.seconds += time.time() - start
+                if not block:
+                    break
+                stage.bytes_in += len(block)
+                stage.bytes_out += len(block)
+                self._put(i, block)
+            self._put(i, _END)
+        except _Closed:
+            pass
+        except Exception:
+            self._fail(i)
+        finally:
+            self._fh.close()
+
+    def _run_stage(self, i):
+        stage = self.stages[i]
+        try:
+            stage.run(self._blocks(i), lambda block: self._put(i, block))
+            self._put(i, _END)
+        except _Closed:
+            stage.close()
+        except Exception:
+            stage.close()
+            self._fail(i)
+
+    def _check(self):
+        if self._error is not None:
+            stage, exc = self._error
+            raise IOError('%s stage of ChunkPipeline failed: %s' % (stage.name, exc))
+
+    def _next_block(self):
+        '''returns the next output block, or None at the end'''
+        while not self._eof:
+            self._check()
+            try:
+                block = self._queues[-1].get(timeout=0.1)
+            except Queue.Empty:
+                continue
+            if block is _END:
+                self._eof = True
+                for thread in self._threads:
+                    thread.join()
+                self._check()
+                logger.debug('ChunkPipeline %s', self.format_stats())
+                return None
+            return block
+        return None
+
+    def read(self, size=-1):
+        if size < 0:
+            parts = [self._buf[self._pos:]]
+            self._buf = ''
+            self._pos = 0
+            while True:
+                block = self._next_block()
+                if block is None:
+                    return ''.join(parts)
+                parts.append(block)
+        parts = []
+        have = 0
+        while have < size:
+            if self._pos >= len(self._buf):
+                self._buf = self._next_block()
+                self._pos = 0
+                if self._buf is None:
+                    self._buf = ''
+                    break
+            part = self._buf[self._pos:self._pos + size - have]
+            self._pos += len(part)
+            have += len(part)
+            parts.append(part)
+        return ''.join(parts)
+
+    def stats(self):
+        '''returns a list of dicts, one per stage in order, with the
+        name, bytes_in, bytes_out, busy seconds, and bytes_per_second of
+        input of each stage
+        '''
+        return [stage.stats() for stage in self.stages]
+
+    def format_stats(self):
+        'stats as one line of text for logging'
+        return ', '.join(
+            '%(name)s: %(bytes_in)d bytes in %(seconds).3fs '
+            '(%(bytes_per_second).0f B/s)' % stats
+            for stats in self.stats())
+
+    def close(self):
+        '''stop all stages, killing any child processes'''
+        self._closed = True
+        for stage in self.stages:
+            stage.close()
+        for thread in self._threads:
+            thread.join()
+
+
+class ReadAhead(object):
+    '''
+    Read-only file-like object that reads `fh` on a thread,
+    `block_size` bytes at a time, holding up to `prefetch_bytes` that
+    the caller has not read yet.  On NFS or FUSE mounts this keeps a
+    read in flight while the caller decodes, instead of paying a round
+    trip each time a small buffer runs dry.
+
+    seek restarts the thread at the new position, and raises IOError
+    if `fh` cannot seek.  An error in the thread is raised by read
+    once the blocks before it are consumed.
+
+    `stats()` reports `bytes` read by the caller, the number of
+    `stalls` in which the caller found nothing read ahead, the
+    `wait_seconds` it spent blocked on them, and the `read_seconds`
+    the thread spent in fh.read.  Many stalls with read_seconds close
+    to the total time mean the file system, not the decoder, is the
+    bottleneck, and a larger prefetch_bytes will not help; stalls
+    with little read time mean it is too small.
+    '''
+    def __init__(self, fh, prefetch_bytes=PREFETCH_BYTES, block_size=2**20):
+        self.mode = 'rb'
+        self._fh = fh
+        self.block_size = block_size
+        self.prefetch_bytes = max(prefetch_bytes, block_size)
+        self.bytes = 0
+        self.stalls = 0
+        self.wait_seconds = 0.0
+        self.read_seconds = 0.0
+        self._cond = threading.Condition()
+        self._pos = 0
+        self._start()
+
+    def _start(self):
+        self._blocks = collections.deque()
+        self._buffered = 0
+        self._buf = ''
+        self._buf_pos = 0
+        self._eof = False
+        self._error = None
+        self._halted = False
+        self._thread = threading.Thread(target=self._run, name='ReadAhead')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _run(self):
+        try:
+            while True:
+                with self._cond:
+                    while self._buffered >= self.prefetch_bytes and not self._halted:
+                        self._cond.wait()
+                    if self._halted:
+                        return
+                start = time.time()
+                block = self._fh.read(self.block_size)
+                self.read_seconds += time.time() - start
+                with self._cond:
+                    if block:
+                        self._blocks.append(block)
+                        self._buffered += len(block)
+                    else:
+                        self._eof = True
+                    self._cond.notify_all()
+                if not block:
+                    return
+        except Exception:
+            with self._cond:
+                self._error = sys.exc_info()
+                self._eof = True
+                self._cond.notify_all()
+
+    def _halt(self):
+        with self._cond:
+            self._halted = True
+            self._cond.notify_all()
+        self._thread.join()
+
+    def _next_block(self):
+        '''returns the next block read ahead, or None at the end'''
+        with self._cond:
+            if not self._blocks and not self._eof and not self._halted:
+                self.stalls += 1
+                start = time.time()
+                while not self._blocks and not self._eof and not self._halted:
+                    self._cond.wait()
+                self.wait_seconds += time.time() - start
+            if self._blocks:
+                block = self._blocks.popleft()
+                self._buffered -= len(block)
+                self._cond.notify_all()
+                return block
+            if self._error is not None:
+                exc_type, exc, tb = self._error
+                raise exc_type, exc, tb
+            return None
+
+    def read(self, size=-1):
+        parts = [self._buf[self._buf_pos:self._buf_pos + size]
+                 if size >= 0 else self._buf[self._buf_pos:]]
+        have = len(parts[0])
+        self._buf_pos += have
+        while size < 0 or have < size:
+            block = self._next_block()
+            if block is None:
+                break
+            if size >= 0 and have + len(block) > size:
+                self._buf = block
+                self._buf_pos = size - have
+                block = block[:self._buf_pos]
+            parts.append(block)
+            have += len(block)
+        self._pos += have
+        self.bytes += have
+        return ''.join(parts)
+
+    def tell(self):
+        return self._pos
+
+    def seek(self, offset, whence=0):
+        if whence == 1:
+            offset += self._pos
+        elif whence != 0:
+            raise IOError(errno.EINVAL, 'ReadAhead cannot seek from the end')
+        if offset == self._pos:
+            return
+        if not hasattr(self._fh, 'seek'):
+            raise IOError(errno.ESPIPE, 'cannot seek in %r' % (self._fh,))
+        self._halt()
+        self._fh.seek(offset)
+        self._pos = offset
+        self._start()
+
+    def stats(self):
+        '''returns a dict of bytes, stalls, wait_seconds, and
+        read_seconds, see ReadAhead
+        '''
+        return dict(bytes=self.bytes, stalls=self.stalls,
+                    wait_seconds=self.wait_seconds,
+                    read_seconds=self.read_seconds)
+
+    def close(self):
+        self._halt()
+        self._fh.close()
+
+
+class BackgroundWriter(object):
+    '''
+    Write-only file-like object that hands each write to a thread,
+    which writes it on to `fh`, e.g. an xz or gzip file, so that the
+    cost of compressing is paid off the calling thread.  Both xz and
+    zlib release the GIL while compressing.  At most `max_blocks`
+    writes wait in the queue, after which write blocks.
+
+    flush and close wait for the queue to drain.  An error in the
+    thread is raised by every later write, flush, or close, and
+    nothing after the failed write reaches `fh`.
+
+    `seconds` is the time the thread spent in fh.write, and
+    `wait_seconds` the time callers spent blocked on a full queue.
+    '''
+    def __init__(self, fh, max_blocks=4):
+        self._fh = fh
+        self.mode = getattr(fh, 'mode', 'wb')
+        self.seconds = 0.0
+        self.wait_seconds = 0.0
+        self.bytes = 0
+        self._error = None
+        self._closed = False
+        self._queue = Queue.Queue(max_blocks)
+        self._thread = threading.Thread(target=self._run,
+                                        name='BackgroundWriter')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            data = self._queue.get()
+            try:
+                if data is _END:
+                    return
+                if self._error is None:
+                    start = time.time()
+                    self._fh.write(data)
+                    self.seconds += time.time() - start
+                    self.bytes += len(data)
+            except Exception:
+                ## keep draining, so that writers never block forever
+                self._error = sys.exc_info()
+            finally:
+                self._queue.task_done()
+
+    def _check(self):
+        if self._error is not None:
+            ## sticky, since later writes are dropped
+            exc_type, exc, tb = self._error
+            raise exc_type, exc, tb
+
+    def write(self, data):
+        self._check()
+        if not data:
+            return
+        start = time.time()
+        self._queue.put(data)
+        self.wait_seconds += time.time() - start
+
+    def flush(self):
+        self._queue.join()
+        self._check()
+        if hasattr(self._fh, 'flush'):
+            self._fh.flush()
+
+    def close(self):
+        if self._closed:
+            self._check()
+            return
+        self._closed = True
+        self._queue.put(_END)
+        self._thread.join()
+        try:
+            self._check()
+        finally:
+            self._fh.close()
+
+
+class CompressorProcess(object):
+    '''
+    Write-only file-like object that pipes what is written to it
+    through the child process `command`, such as `xz --compress -T0`,
+    whose output goes to the open file `fh`.  close waits for the
+    child, closes `fh`, and raises IOError if the child failed.
+    '''
+    def __init__(self, command, fh):
+        self.command = command
+        self.mode = 'wb'
+        self._fh = fh
+        self._child = subprocess.Popen(
+            command, stdin=subprocess.PIPE, stdout=fh,
+            stderr=subprocess.PIPE, close_fds=True)
+        self._stderr = []
+        self._thread = threading.Thread(
+            target=lambda: self._stderr.append(self._child.stderr.read()))
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _finish(self):
+        '''wait for the child and close `fh`, returning the IOError to
+        raise if the child failed, or None
+        '''
+        try:
+            self._child.stdin.close()
+            self._thread.join()
+            returncode = self._child.wait()
+        finally:
+            self._fh.close()
+        if returncode != 0:
+            return IOError('%s exited with status %d:\n%s' % (
+                ' '.join(self.command), returncode, ''.join(self._stderr)))
+        return None
+
+    def write(self, data):
+        try:
+            self._child.stdin.write(data)
+        except IOError, exc:
+            if exc.errno != errno.EPIPE:
+                raise
+            raise self._finish() or exc
+
+    def flush(self):
+        self._child.stdin.flush()
+
+    def close(self):
+        error = self._finish()
+        if error is not None:
+            raise error
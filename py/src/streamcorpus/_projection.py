@@ -0,0 +1,164 @@
+#!/usr/bin/env python
+'''
+Decode only some fields of Thrift messages.
+
+`project_spec(StreamItem, ['stream_id', 'body.clean_visible'])` builds
+a copy of StreamItem.thrift_spec in which every field that was not
+requested is None.  Decoding with such a spec skips the unrequested
+fields at the protocol level, so their bytes are never turned into
+Python objects, and they keep their default values on the decoded
+message.  Dotted names select fields inside nested structs, including
+structs inside lists, sets and map values, e.g.
+'other_content.clean_visible'.
+
+This software is released under an MIT/X11 open source license.
+
+Copyright 2012-2015 Diffeo, Inc.
+'''
+from __future__ import absolute_import
+
+from thrift.Thrift import TType
+from thrift.transport import TTransport
+from thrift.protocol.TBinaryProtocol import TBinaryProtocolAccelerated
+try:
+    from thrift.protocol import fastbinary
+except ImportError:
+    fastbinary = None
+
+
+def _field_tree(fields):
+    '''turn ['a', 'b.c', 'b.d'] into {'a': None, 'b': {'c': None, 'd': None}},
+    where None means the whole field
+    '''
+    tree = {}
+    for field in fields:
+        parts = field.lstrip('.').split('.')
+        node = tree
+        for part in parts[:-1]:
+            if part in node and node[part] is None:
+                ## the whole field was already requested
+                break
+            node = node.setdefault(part, {})
+        else:
+            node[parts[-1]] = None
+    return tree
+
+
+def _project_type_args(ttype, type_args, tree, name):
+    '''project the type arguments of a field of type `ttype` onto the
+    sub-fields in `tree`
+    '''
+    if ttype == TType.STRUCT:
+        cls, spec = type_args
+        return (cls, _project(cls, spec, tree))
+    elif ttype in (TType.LIST, TType.SET):
+        etype, eargs = type_args
+        return (etype, _project_type_args(etype, eargs, tree, name))
+    elif ttype == TType.MAP:
+        ktype, kargs, vtype, vargs = type_args
+        return (ktype, kargs, vtype, _project_type_args(vtype, vargs, tree, name))
+    else:
+        raise ValueError('%s has no sub-fields: %r' % (name, tree.keys()))
+
+
+def _project(cls, spec, tree):
+    by_name = dict((field[2], field) for field in spec if field is not None)
+    unknown = set(tree) - set(by_name)
+    if unknown:
+        raise ValueError('%s has no fields named %s' % (
+            cls.__name__, ', '.join(sorted(unknown))))
+    projected = []
+    for field in spec:
+        if field is None or field[2] not in tree:
+            projected.append(None)
+        elif tree[field[2]] is None:
+            projected.append(field)
+        else:
+            fid, ttype, name, type_args, default = field
+            projected.append((fid, ttype, name, _project_type_args(
+                ttype, type_args, tree[name], name), default))
+    return tuple(projected)
+
+
+def project_spec(message, fields):
+    '''returns a thrift_spec for `message` that decodes only `fields`,
+    a list of possibly dotted field names.  The message's version
+    field, if it has one, is always decoded, so that readers can still
+    check it.
+    '''
+    tree = _field_tree(fields)
+    if 'version' in message.__slots__:
+        tree['version'] = None
+    return _project(message, message.thrift_spec, tree)
+
+
+def read_projected(msg, iprot, spec):
+    '''read `msg` from `iprot`, decoding only the fields in `spec`, which
+    is usually made by project_spec
+    '''
+    if iprot.__class__ == TBinaryProtocolAccelerated and \
+       isinstance(iprot.trans, TTransport.CReadableTransport) and \
+       fastbinary is not None:
+        fastbinary.decode_binary(msg, iprot.trans, (msg.__class__, spec))
+    else:
+        _read_struct(msg, iprot, spec)
+
+
+## readers for the pure python protocol, following the thrift_spec
+## the same way that fastbinary does
+_SCALAR_READERS = {
+    TType.BOOL: 'readBool',
+    TType.BYTE: 'readByte',
+    TType.I16: 'readI16',
+    TType.I32: 'readI32',
+    TType.I64: 'readI64',
+    TType.DOUBLE: 'readDouble',
+    TType.STRING: 'readString',
+}
+
+
+def _read_value(iprot, ttype, type_args):
+    if ttype in _SCALAR_READERS:
+        return getattr(iprot, _SCALAR_READERS[ttype])()
+    elif ttype == TType.STRUCT:
+        cls, spec = type_args
+        obj = cls()
+        _read_struct(obj, iprot, spec)
+        return obj
+    elif ttype == TType.LIST:
+        etype, size = iprot.readListBegin()
+        val = [_read_value(iprot, etype, type_args[1]) for _ in xrange(size)]
+        iprot.readListEnd()
+        return val
+    elif ttype == TType.SET:
+        etype, size = iprot.readSetBegin()
+        val = set(_read_value(iprot, etype, type_args[1]) for _ in xrange(size))
+        iprot.readSetEnd()
+        return val
+    elif ttype == TType.MAP:
+        ktype, vtype, size = iprot.readMapBegin()
+        val = {}
+        for _ in xrange(size):
+            key = _read_value(iprot, ktype, type_args[1])
+            val[key] = _read_value(iprot, vtype, type_args[3])
+        iprot.readMapEnd()
+        return val
+    else:
+        raise TypeError('unknown thrift type %r' % ttype)
+
+
+def _read_struct(obj, iprot, spec):
+    iprot.readStructBegin()
+    while True:
+        (fname, ftype, fid) = iprot.readFieldBegin()
+        if ftype == TType.STOP:
+            break
+        field = None
+        if 0 <= fid < len(spec):
+            field = spec[fid]
+        if field is None or field[1] != ftype:
+            iprot.skip(ftype)
+        else:
+            setattr(obj, field[2], _read_value(iprot, ftype, field[3]))
+        iprot.readFieldEnd()
+    iprot.readStructEnd()
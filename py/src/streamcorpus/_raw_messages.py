@@ -0,0 +1,182 @@
+#!/usr/bin/env python
+'''
+Find the boundaries of serialized Thrift messages without decoding
+them.
+
+`iter_raw_messages(file_obj)` walks the TBinaryProtocol encoding of
+each top-level message just far enough to know where it ends, and
+turns nothing into Python objects.  With fastbinary, this decodes each
+message with an empty thrift_spec, so the C extension skips every
+field; without it, a pure python walker skips strings and containers
+of fixed-size values by their lengths.  This is what copying,
+counting, and splitting chunks need, and it runs much closer to the
+speed of the disk or decompressor than decoding does.
+
+This software is released under an MIT/X11 open source license.
+
+Copyright 2012-2015 Diffeo, Inc.
+'''
+from __future__ import absolute_import
+
+import logging
+import struct
+
+from cStringIO import StringIO
+
+from thrift.Thrift import TType
+from thrift.transport import TTransport
+try:
+    from thrift.protocol import fastbinary
+except ImportError:
+    fastbinary = None
+
+logger = logging.getLogger('streamcorpus')
+
+_FIXED_SIZES = {
+    TType.BOOL: 1,
+    TType.BYTE: 1,
+    TType.I16: 2,
+    TType.I32: 4,
+    TType.I64: 8,
+    TType.DOUBLE: 8,
+}
+
+_I32 = struct.Struct('!i')
+
+
+class _Incomplete(Exception):
+    'the buffer ends before the message does'
+    pass
+
+
+def _length(buf, pos):
+    length = _I32.unpack_from(buf, pos)[0]
+    if length < 0:
+        raise ValueError('corrupt message: negative length at %d' % pos)
+    return length
+
+
+def _skip(buf, pos, ttype):
+    '''returns the position just past the value of type `ttype` that
+    starts at `pos` in `buf`.  May return a position beyond the end of
+    `buf`, or raise IndexError or struct.error, if the value is not
+    all in `buf`.
+    '''
+    size = _FIXED_SIZES.get(ttype)
+    if size is not None:
+        return pos + size
+    elif ttype == TType.STRING:
+        return pos + 4 + _length(buf, pos)
+    elif ttype == TType.STRUCT:
+        return _skip_struct(buf, pos)
+    elif ttype in (TType.LIST, TType.SET):
+        etype = ord(buf[pos])
+        count = _length(buf, pos + 1)
+        pos += 5
+        size = _FIXED_SIZES.get(etype)
+        if size is not None:
+            return pos + count * size
+        for _ in xrange(count):
+            pos = _skip(buf, pos, etype)
+            if pos > len(buf):
+                raise _Incomplete()
+        return pos
+    elif ttype == TType.MAP:
+        ktype = ord(buf[pos])
+        vtype = ord(buf[pos + 1])
+        count = _length(buf, pos + 2)
+        pos += 6
+        ksize = _FIXED_SIZES.get(ktype)
+        vsize = _FIXED_SIZES.get(vtype)
+        if ksize is not None and vsize is not None:
+            return pos + count * (ksize + vsize)
+        for _ in xrange(count):
+            pos = _skip(buf, pos, ktype)
+            pos = _skip(buf, pos, vtype)
+            if pos > len(buf):
+                raise _Incomplete()
+        return pos
+    else:
+        raise TypeError('unknown thrift type %r at %d' % (ttype, pos))
+
+
+def _skip_struct(buf, pos):
+    while True:
+        ftype = ord(buf[pos])
+        pos += 1
+        if ftype == TType.STOP:
+            return pos
+        ## skip the field id, then the value
+        pos = _skip(buf, pos + 2, ftype)
+        if pos > len(buf):
+            raise _Incomplete()
+
+
+class _Skipped(object):
+    'placeholder that fastbinary decodes a message into'
+    pass
+
+
+class _BufferTransport(TTransport.CReadableTransport):
+    '''lets fastbinary read from `buf` starting at `start`, and signals
+    the end of `buf` with _Incomplete instead of reading more
+    '''
+    def __init__(self, buf, start):
+        self._buf = StringIO(buf)
+        self._buf.seek(start)
+
+    @property
+    def cstringio_buf(self):
+        return self._buf
+
+    def cstringio_refill(self, partialread, reqlen):
+        raise _Incomplete()
+
+
+def _fast_skip_struct(buf, pos):
+    transport = _BufferTransport(buf, pos)
+    ## with an empty spec, every field is skipped in C
+    fastbinary.decode_binary(_Skipped(), transport, (_Skipped, ()))
+    return transport.cstringio_buf.tell()
+
+
+def iter_raw_messages(file_obj, block_size=2**20):
+    '''Iterate over the serialized bytes of each top-level message in
+    `file_obj`, which can be any object with a .read(size) method.
+    Each yielded string can be written out verbatim, e.g. with
+    Chunk.add_raw, or decoded later with deserialize.
+
+    A truncated message at the end of `file_obj` is logged and
+    dropped, just as Chunk stops reading at a truncated message.
+    '''
+    if fastbinary is not None:
+        skip_struct = _fast_skip_struct
+    else:
+        skip_struct = _skip_struct
+    buf = ''
+    start = 0
+    while True:
+        try:
+            end = skip_struct(buf, start)
+        except (_Incomplete, IndexError, struct.error):
+            ## read at least as much again as the partial message, so
+            ## that a huge message is rescanned only a few times
+            more = file_obj.read(max(block_size, len(buf) - start))
+            if not more:
+                if start < len(buf):
+                    logger.warn('dropping truncated message of %d bytes at end of input',
+                                len(buf) - start)
+                return
+            buf = buf[start:] + more
+            start = 0
+            continue
+        yield buf[start:end]
+        start = end
+
+
+def count_raw_messages(file_obj):
+    'returns the number of messages in `file_obj` without decoding them'
+    count = 0
+    for _ in iter_raw_messages(file_obj):
+        count += 1
+    return count
@@ -0,0 +1,189 @@
+#!/usr/bin/env python
+'''
+The snappy framing format, used for .sz chunks.
+
+Only the raw block functions of python-snappy are used, and the chunk
+loop of the framing format is implemented here over the caller's bytes
+directly, so that no payload is copied through StringIO buffers as
+with the library's stream_compress and stream_decompress.  Checksums
+are masked CRC-32C, computed by the `crc32c` package if it is
+installed, or else in pure python, which is much slower.
+
+See https://github.com/google/snappy/blob/master/framing_format.txt
+
+This software is released under an MIT/X11 open source license.
+
+Copyright 2012-2015 Diffeo, Inc.
+'''
+from __future__ import absolute_import
+
+import struct
+
+try:
+    import snappy as sz
+except ImportError:
+    sz = None
+
+try:
+    from crc32c import crc32c
+except ImportError:
+    crc32c = None
+
+## starts every stream, and may be repeated between streams
+STREAM_IDENTIFIER = '\xff\x06\x00\x00sNaPpY'
+
+## most uncompressed bytes in one chunk, from the format
+CHUNK_SIZE = 65536
+
+COMPRESSED = 0x00
+UNCOMPRESSED = 0x01
+PADDING = 0xfe
+IDENTIFIER = 0xff
+
+def _crc32c_table():
+    table = []
+    for i in range(256):
+        crc = i
+        for _ in range(8):
+            if crc & 1:
+                crc = (crc >> 1) ^ 0x82f63b78
+            else:
+                crc >>= 1
+        table.append(crc)
+    return table
+
+_CRC_TABLE = _crc32c_table()
+
+def crc32c_python(data):
+    'CRC-32C of `data`, the slow way'
+    crc = 0xffffffff
+    for byte in bytearray(data):
+        crc = _CRC_TABLE[(crc ^ byte) & 0xff] ^ (crc >> 8)
+    return crc ^ 0xffffffff
+
+if crc32c is None:
+    crc32c = crc32c_python
+
+
+def _piece(data, start, size):
+    '''zero-copy slice of the bytes or memoryview `data`'''
+    if isinstance(data, memoryview):
+        return data[start:start + size]
+    return buffer(data, start, size)
+
+
+def masked_crc32c(data):
+    'the CRC-32C of `data`, masked as the framing format requires'
+    crc = crc32c(data)
+    return (((crc >> 15) | (crc << 17)) + 0xa282ead8) & 0xffffffff
+
+
+class FrameCompressor(object):
+    '''
+    Incremental compressor to the snappy framing format, with
+    compress(data) and flush() like zlib.compressobj.  Each call to
+    compress emits whole chunks of at most CHUNK_SIZE bytes of `data`,
+    bytes or a memoryview, stored uncompressed where snappy does not
+    save at least an eighth.
+    '''
+    def __init__(self):
+        if sz is None:
+            raise RuntimeError('snappy compression requires python-snappy')
+        self._started = False
+
+    def _start(self, parts):
+        if not self._started:
+            parts.append(STREAM_IDENTIFIER)
+            self._started = True
+
+    def compress(self, data):
+        parts = []
+        self._start(parts)
+        for start in range(0, len(data), CHUNK_SIZE):
+            piece = _piece(data, start, CHUNK_SIZE)
+            crc = masked_crc32c(piece)
+            if isinstance(piece, memoryview):
+                ## python-snappy only takes old-style buffers
+                piece = piece.tobytes()
+            compressed = sz.compress(piece)
+            if len(compressed) <= len(piece) - len(piece) // 8:
+                chunk_type, body = COMPRESSED, compressed
+            else:
+                chunk_type, body = UNCOMPRESSED, piece
+            ## type, then the 24-bit length of the checksum and body
+            parts.append(struct.pack('<I', chunk_type | (len(body) + 4) << 8))
+            parts.append(struct.pack('<I', crc))
+            parts.append(body)
+        ## joining copies each body once, into the output
+        return ''.join(parts)
+
+    def flush(self):
+        parts = []
+        ## so that even an empty stream is recognizable
+        self._start(parts)
+        return ''.join(parts)
+
+
+class FrameDecompressor(object):
+    '''
+    Incremental decompressor from the snappy framing format, with
+    decompress(data) like zlib.decompressobj, where `data` is bytes or
+    a memoryview, which is copied once.  Checksums are verified,
+    padding and reserved skippable chunks are skipped, and repeated
+    stream identifiers, as found between concatenated streams, are
+    accepted.  Only compressed chunks need python-snappy.
+
+    flush() raises EOFError if the input ended inside a chunk.
+    '''
+    def __init__(self):
+        ## bytes of an incomplete chunk from the previous call
+        self._tail = ''
+        self._seen_identifier = False
+
+    def decompress(self, data):
+        if isinstance(data, memoryview):
+            data = data.tobytes()
+        if self._tail:
+            data = self._tail + data
+            self._tail = ''
+        parts = []
+        pos = 0
+        end = len(data)
+        while pos + 4 <= end:
+            header, = struct.unpack_from('<I', data, pos)
+            chunk_type = header & 0xff
+            length = header >> 8
+            if pos + 4 + length > end:
+                break
+            body = pos + 4
+            pos = body + length
+            if chunk_type == IDENTIFIER:
+                if data[body:pos] != STREAM_IDENTIFIER[4:]:
+                    raise IOError('bad snappy stream identifier')
+                self._seen_identifier = True
+                continue
+            if not self._seen_identifier:
+                raise IOError('snappy stream does not start with the stream identifier')
+            if chunk_type == COMPRESSED:
+                if sz is None:
+                    raise RuntimeError('snappy decompression requires python-snappy')
+                out = sz.uncompress(buffer(data, body + 4, length - 4))
+            elif chunk_type == UNCOMPRESSED:
+                out = data[body + 4:pos]
+            elif chunk_type == PADDING or chunk_type >= 0x80:
+                ## padding and reserved skippable chunks
+                continue
+            else:
+                raise IOError('reserved unskippable snappy chunk type 0x%02x' % chunk_type)
+            crc, = struct.unpack_from('<I', data, body)
+            if masked_crc32c(out) != crc:
+                raise IOError('snappy chunk checksum mismatch')
+            parts.append(out)
+        if pos < end:
+            self._tail = data[pos:]
+        return ''.join(parts)
+
+    def flush(self):
+        if self._tail:
+            raise EOFError('snappy input ended inside a chunk')
+        return ''
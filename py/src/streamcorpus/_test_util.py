@@ -0,0 +1,39 @@
+#!/usr/bin/env python
+'''
+Helpers shared by the tests of the chunk readers and writers.
+
+This software is released under an MIT/X11 open source license.
+
+Copyright 2012-2015 Diffeo, Inc.
+'''
+from __future__ import absolute_import
+
+from streamcorpus._chunk import Chunk
+from streamcorpus.ttypes import ContentItem
+from streamcorpus.package_globals import make_stream_item
+
+
+def make_si(i, grow=False, source=None, raw=None, url=None,
+            clean_visible=None):
+    '''returns a StreamItem for `url`, by default http://example.com/`i`,
+    at epoch `i`, from `source`, whose body.raw is `raw`, by default
+    'hello `i`!', repeated `i` + 1 times if `grow`, so that messages
+    differ in size
+    '''
+    if url is None:
+        url = 'http://example.com/%d' % i
+    si = make_stream_item(i, url)
+    si.source = source
+    if raw is None:
+        raw = 'hello %d!' % i
+        if grow:
+            raw = (raw + ' ') * (i + 1)
+    si.body = ContentItem(raw=raw, clean_visible=clean_visible)
+    return si
+
+
+def write_chunk(path, sis):
+    'writes the StreamItems `sis` to a new chunk at `path`, and returns `path`'
+    with Chunk(path=path, mode='wb') as ch:
+        ch.add_many(sis)
+    return path
@@ -0,0 +1,213 @@
+'''Persistent catalog of many chunk files, for finding the chunks that
+might hold a stream_id or abs_url, or that cover an hour, without
+opening the others.
+
+For each chunk, a Catalog records in an SQLite database its path,
+size and mtime, the md5 and count of its messages, the least and
+greatest stream_time.epoch_ticks, its sources, and a BloomFilter of
+its stream_ids and abs_urls.  Catalog.update only reads chunks that
+are new or changed since they were last recorded, decoding just those
+fields, see project_spec.
+
+.. This software is released under an MIT/X11 open source license.
+   Copyright 2012-2015 Diffeo, Inc.
+'''
+from __future__ import absolute_import
+from calendar import timegm
+import logging
+import multiprocessing
+import os
+import sqlite3
+import time
+
+from thrift.transport import TTransport
+
+from streamcorpus.ttypes import StreamItem
+from streamcorpus._bloom import BloomFilter
+from streamcorpus._chunk import Chunk, protocol
+from streamcorpus._projection import project_spec, read_projected
+
+logger = logging.getLogger(__name__)
+
+## false positive rate of the BloomFilter of each chunk
+ERROR_RATE = 0.01
+
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS chunks (
+    path TEXT PRIMARY KEY,
+    size INTEGER,
+    mtime REAL,
+    md5 TEXT,
+    count INTEGER,
+    min_epoch REAL,
+    max_epoch REAL,
+    bloom BLOB
+);
+CREATE INDEX IF NOT EXISTS chunks_epoch ON chunks (min_epoch, max_epoch);
+CREATE TABLE IF NOT EXISTS sources (
+    path TEXT,
+    source TEXT
+);
+CREATE INDEX IF NOT EXISTS sources_source ON sources (source);
+CREATE INDEX IF NOT EXISTS sources_path ON sources (path);
+'''
+
+_spec = project_spec(StreamItem, ['stream_id', 'abs_url', 'source',
+                                  'stream_time.epoch_ticks'])
+
+
+def scan_chunk(path):
+    '''returns the catalog row of the chunk at `path`, as a tuple of
+    path, size, mtime, md5, count, min_epoch, max_epoch, and bloom,
+    and its set of sources
+    '''
+    stat = os.stat(path)
+    keys = []
+    sources = set()
+    epochs = []
+    chunk = Chunk(path=path, mode='rb')
+    for blob in chunk.iter_raw():
+        si = StreamItem()
+        read_projected(si, protocol(TTransport.TMemoryBuffer(blob)), _spec)
+        keys.extend(key for key in (si.stream_id, si.abs_url) if key)
+        if si.source:
+            sources.add(si.source)
+        if si.stream_time is not None and si.stream_time.epoch_ticks is not None:
+            epochs.append(si.stream_time.epoch_ticks)
+    bloom = BloomFilter(max(1, len(keys)), ERROR_RATE)
+    for key in keys:
+        bloom.add(key)
+    row = (path, stat.st_size, stat.st_mtime, chunk.md5_hexdigest, len(chunk),
+           min(epochs) if epochs else None, max(epochs) if epochs else None,
+           bloom.to_string())
+    return row, sources
+
+
+def hour_range(date_hour):
+    '''returns the epoch_ticks of the start and end of `date_hour`,
+    such as '2000-01-01-12' from get_date_hour
+    '''
+    start = timegm(time.strptime(date_hour, '%Y-%m-%d-%H'))
+    return start, start + 3600
+
+
+class Catalog(object):
+    '''
+    Catalog of chunk files in the SQLite database at `path`, which is
+    created if it does not exist.
+    '''
+    def __init__(self, path):
+        self.path = path
+        self.db = sqlite3.connect(path)
+        self.db.text_factory = str
+        self.db.executescript(_SCHEMA)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+    def __len__(self):
+        return self.db.execute('SELECT COUNT(*) FROM chunks').fetchone()[0]
+
+    def _stale(self, path):
+        row = self.db.execute('SELECT size, mtime FROM chunks WHERE path = ?',
+                              (path,)).fetchone()
+        if row is None:
+            return True
+        stat = os.stat(path)
+        return row != (stat.st_size, stat.st_mtime)
+
+    def update(self, paths, workers=1):
+        '''record the chunks at `paths` that are not recorded yet or have
+        changed since, scanning them in `workers` processes
+
+        :returns: number of chunks scanned
+        '''
+        paths = [os.path.abspath(path) for path in paths]
+        stale = [path for path in paths if self._stale(path)]
+        if workers == 1:
+            scans = (scan_chunk(path) for path in stale)
+            pool = None
+        else:
+            pool = multiprocessing.Pool(workers)
+            scans = pool.imap(scan_chunk, stale)
+        try:
+            with self.db:
+                for row, sources in scans:
+                    self._remove(row[0])
+                    self.db.execute('INSERT INTO chunks VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                                    row[:-1] + (buffer(row[-1]),))
+                    self.db.executemany('INSERT INTO sources VALUES (?, ?)',
+                                        [(row[0], source) for source in sorted(sources)])
+        finally:
+            if pool is not None:
+                pool.terminate()
+                pool.join()
+        logger.info('catalog %s: scanned %d of %d chunks', self.path, len(stale), len(paths))
+        return len(stale)
+
+    def _remove(self, path):
+        self.db.execute('DELETE FROM chunks WHERE path = ?', (path,))
+        self.db.execute('DELETE FROM sources WHERE path = ?', (path,))
+
+    def prune(self):
+        '''forget the chunks whose files no longer exist
+
+        :returns: the paths forgotten
+        '''
+        gone = [path for path, in self.db.execute('SELECT path FROM chunks')
+                if not os.path.exists(path)]
+        with self.db:
+            for path in gone:
+                self._remove(path)
+        return gone
+
+    def get(self, path):
+        '''returns a dict of what is recorded about the chunk at `path`,
+        or None
+        '''
+        cursor = self.db.execute(
+            'SELECT path, md5, count, min_epoch, max_epoch FROM chunks WHERE path = ?',
+            (os.path.abspath(path),))
+        row = cursor.fetchone()
+        if row is None:
+            return None
+        info = dict(zip([col[0] for col in cursor.description], row))
+        info['sources'] = [source for source, in self.db.execute(
+            'SELECT source FROM sources WHERE path = ? ORDER BY source', (row[0],))]
+        return info
+
+    def find(self, stream_id=None, abs_url=None):
+        '''returns the paths of the chunks that might hold a message with
+        `stream_id` or `abs_url`, by their BloomFilters alone.  The
+        epoch_ticks in a stream_id need not match the stream_time of its
+        message, and some messages have none, so time ranges are not
+        used to rule chunks out.
+        '''
+        keys = [key for key in (stream_id, abs_url) if key]
+        paths = []
+        for path, bloom in self.db.execute(
+                'SELECT path, bloom FROM chunks ORDER BY path'):
+            bloom = BloomFilter.from_string(str(bloom))
+            if any(key in bloom for key in keys):
+                paths.append(path)
+        return paths
+
+    def covering(self, date_hour):
+        '''returns the paths of the chunks with messages in `date_hour`,
+        such as '2000-01-01-12', judged by their time ranges
+        '''
+        start, end = hour_range(date_hour)
+        return [path for path, in self.db.execute(
+            'SELECT path FROM chunks WHERE min_epoch < ? AND ? <= max_epoch '
+            'ORDER BY path', (end, start))]
+
+    def with_source(self, source):
+        'returns the paths of the chunks with messages from `source`'
+        return [path for path, in self.db.execute(
+            'SELECT path FROM sources WHERE source = ? ORDER BY path', (source,))]
+
+    def close(self):
+        self.db.close()
@@ -1,51 +1,81 @@
 '''Utility class for spooling a stream of items to files on disk.
 Initially, files flow into a temp file, which gets moved to a
 permanent name when it reaches the `chunk_max` size or the stream
-ends.
+ends.  PartitionedChunkWriter does the same for each partition of a
+stream, such as each hour of stream_time.
 
 .. Your use of this software is governed by your license agreement.
    Unpublished Work Copyright 2015 Diffeo, Inc.
 '''
 from __future__ import absolute_import
+from collections import OrderedDict
 import logging
 import os
 import random
+import uuid
 
 from streamcorpus.ttypes import StreamItem
-from streamcorpus._chunk import Chunk
+from streamcorpus._chunk import Chunk, _digest_name
+from streamcorpus._bloom import bloom_path_for
+from streamcorpus._chunk_index import index_path_for
 from streamcorpus._cbor_chunk import CborChunk
 
 logger = logging.getLogger(__name__)
 
 class ChunkRoller(object):
 
-    def __init__(self, chunk_dir, chunk_max=500, message=StreamItem):
+    def __init__(self, chunk_dir, chunk_max=500, message=StreamItem,
+                 index=False, digest='md5', bloom=False):
         self.chunk_dir = chunk_dir
         self.chunk_max = chunk_max
+        ## write an index sidecar next to each Chunk
+        self.index = index
+        ## write a bloom filter sidecar next to each Chunk
+        self.bloom = bloom
+        ## digest that names each chunk, see streamcorpus._chunk.digests;
+        ## chunks named with anything but md5 get the digest's name
+        ## in their file name too, e.g. 10-xxh64-<hexdigest>.sc.xz;
+        ## without a digest, chunks get a random unique name
+        self.digest = _digest_name(digest)
         self.t_path = os.path.join(chunk_dir, 'tmp-%d.sc.xz'  % random.randint(0, 10**8))
         self.o_chunk = None
         self.message = message
 
-    def add(self, si_or_fc):
-        '''puts `si_or_fc` into the currently open chunk, which it creates if
-        necessary.  If this item causes the chunk to cross chunk_max,
-        then the chunk closed after adding.
-
-        '''
+    def _open(self):
         if self.o_chunk is None:
             if os.path.exists(self.t_path):
                 os.remove(self.t_path)
             if self.message == StreamItem:
-                self.o_chunk = Chunk(self.t_path, mode='wb')
+                self.o_chunk = Chunk(self.t_path, mode='wb', index=self.index,
+                                     bloom=self.bloom, inline_md5=self.digest)
             else:
                 logger.info('Assuming CborChunk for message=%r', type(self.message))
-                self.o_chunk = CborChunk(self.t_path, mode='wb')
+                self.o_chunk = CborChunk(self.t_path, mode='wb',
+                                         inline_md5=self.digest)
+        return self.o_chunk
 
-        self.o_chunk.add(si_or_fc)
+    def _added(self):
         logger.debug('added %d-th item to chunk', len(self.o_chunk))
         if len(self.o_chunk) == self.chunk_max:
             self.close()
 
+    def add(self, si_or_fc):
+        '''puts `si_or_fc` into the currently open chunk, which it creates if
+        necessary.  If this item causes the chunk to cross chunk_max,
+        then the chunk closed after adding.
+
+        '''
+        self._open().add(si_or_fc)
+        self._added()
+
+    def add_raw(self, blob):
+        '''like add, but for the bytes of a serialized StreamItem, such as
+        those from Chunk.iter_raw, which are copied without decoding.
+
+        '''
+        self._open().add_raw(blob)
+        self._added()
+
     def close(self):
         if self.o_chunk:
             self.o_chunk.close()
@@ -54,11 +84,94 @@ class ChunkRoller(object):
             else: 
                 logger.warn('assuming file extension ".cbor"')
                 extension = 'cbor'
+            if self.digest is None:
+                name = uuid.uuid4().hex
+            elif self.digest == 'md5':
+                name = self.o_chunk.hexdigest
+            else:
+                name = '%s-%s' % (self.digest, self.o_chunk.hexdigest)
             o_path = os.path.join(
                 self.chunk_dir, 
-                '%d-%s.%s.xz' % (len(self.o_chunk), self.o_chunk.md5_hexdigest, extension)
+                '%d-%s.%s.xz' % (len(self.o_chunk), name, extension)
             )
             os.rename(self.t_path, o_path)
+            if os.path.exists(index_path_for(self.t_path)):
+                os.rename(index_path_for(self.t_path), index_path_for(o_path))
+            if os.path.exists(bloom_path_for(self.t_path)):
+                os.rename(bloom_path_for(self.t_path), bloom_path_for(o_path))
             self.o_chunk = None
             logger.info('rolled chunk to %s', o_path)
 
+
+
+class PartitionedChunkWriter(object):
+    '''
+    Spools a stream of items into a directory of chunks per partition,
+    `root_dir`/<partition>/, rolled at `chunk_max` items like
+    ChunkRoller, so that one pass over a stream mixing many hours
+    writes the KBA layout of one directory per date_hour.
+
+    :param key: function from an item to the name of its partition,
+    defaults to get_date_hour
+
+    :param max_open: most partitions with a chunk open at once.  Adding
+    to another partition closes the least recently used one, which
+    rolls its chunk even if it is short of chunk_max; `evictions`
+    counts how often that happened, and should stay small next to
+    the number of chunks written.
+
+    Other arguments are as for ChunkRoller.  Call close at the end, or
+    use the writer as a context manager.
+    '''
+    def __init__(self, root_dir, key=None, chunk_max=500, max_open=64,
+                 message=StreamItem, index=False, digest='md5', bloom=False):
+        if key is None:
+            ## imported here because package_globals imports this module
+            from streamcorpus.package_globals import get_date_hour
+            key = get_date_hour
+        self.root_dir = root_dir
+        self.key = key
+        self.chunk_max = chunk_max
+        self.max_open = max_open
+        self.message = message
+        self.index = index
+        self.digest = digest
+        self.bloom = bloom
+        self.evictions = 0
+        ## most recently used last
+        self._rollers = OrderedDict()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+    def _roller(self, partition):
+        roller = self._rollers.pop(partition, None)
+        if roller is None:
+            if len(self._rollers) >= self.max_open:
+                evicted, oldest = self._rollers.popitem(last=False)
+                logger.debug('closing partition %s to open %s', evicted, partition)
+                oldest.close()
+                self.evictions += 1
+            chunk_dir = os.path.join(self.root_dir, partition)
+            if not os.path.exists(chunk_dir):
+                os.makedirs(chunk_dir)
+            roller = ChunkRoller(chunk_dir, chunk_max=self.chunk_max,
+                                 message=self.message, index=self.index,
+                                 digest=self.digest, bloom=self.bloom)
+        self._rollers[partition] = roller
+        return roller
+
+    def add(self, si_or_fc):
+        '''puts `si_or_fc` into the open chunk of its partition, rolling
+        that chunk if it reaches chunk_max
+        '''
+        self._roller(self.key(si_or_fc)).add(si_or_fc)
+
+    def close(self):
+        '''roll the open chunk of every partition'''
+        while self._rollers:
+            _, roller = self._rollers.popitem(last=False)
+            roller.close()
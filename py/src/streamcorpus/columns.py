@@ -0,0 +1,213 @@
+'''Export scalar fields of the StreamItems in many chunks to one
+columnar file, for analytics that scan a few columns instead of
+decoding whole chunks again.
+
+Only the fields behind COLUMNS are decoded, see project_spec, one
+chunk per worker process.  The output is Parquet if its path ends in
+.parquet, which needs pyarrow, with each chunk as a row group and
+dictionary-encoded strings; or else a numpy .npz file, in which each
+string column is stored as int32 `codes` into a `<name>.dictionary`
+array of its distinct values.  read_columns reads either back into
+numpy arrays.
+
+.. This software is released under an MIT/X11 open source license.
+   Copyright 2012-2015 Diffeo, Inc.
+'''
+from __future__ import absolute_import
+import logging
+import multiprocessing
+
+from thrift.transport import TTransport
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+from streamcorpus.ttypes import StreamItem
+from streamcorpus._chunk import Chunk, protocol
+from streamcorpus._projection import project_spec, read_projected
+
+logger = logging.getLogger(__name__)
+
+
+def _body(name):
+    def get(si):
+        return si.body and getattr(si.body, name)
+    return get
+
+def _length(get):
+    def length(si):
+        val = get(si)
+        return len(val) if val is not None else 0
+    return length
+
+def _epoch_ticks(si):
+    if si.stream_time is None or si.stream_time.epoch_ticks is None:
+        return float('nan')
+    return si.stream_time.epoch_ticks
+
+def _language_code(si):
+    return si.body and si.body.language and si.body.language.code
+
+def _num_ratings(si):
+    return sum(len(ratings) for ratings in (si.ratings or {}).values())
+
+## name, kind, function of a StreamItem, and the fields it decodes.
+## Kinds are 'string' for dictionary-encoded strings, where None
+## becomes '', 'float', and 'int'.
+COLUMNS = [
+    ('stream_id', 'string', lambda si: si.stream_id, ['stream_id']),
+    ('doc_id', 'string', lambda si: si.doc_id, ['doc_id']),
+    ('abs_url', 'string', lambda si: si.abs_url, ['abs_url']),
+    ('source', 'string', lambda si: si.source, ['source']),
+    ('epoch_ticks', 'float', _epoch_ticks, ['stream_time.epoch_ticks']),
+    ('media_type', 'string', _body('media_type'), ['body.media_type']),
+    ('language', 'string', _language_code, ['body.language.code']),
+    ('raw_length', 'int', _length(_body('raw')), ['body.raw']),
+    ('clean_visible_length', 'int', _length(_body('clean_visible')),
+     ['body.clean_visible']),
+    ('num_ratings', 'int', _num_ratings, ['ratings']),
+]
+
+_spec = project_spec(StreamItem, [field for column in COLUMNS for field in column[3]])
+
+
+def extract_columns(path):
+    '''returns a dict from the name of each of COLUMNS to a list of its
+    values for the messages of the chunk at `path`
+    '''
+    columns = dict((name, []) for name, _, _, _ in COLUMNS)
+    getters = [(columns[name], kind, get) for name, kind, get, _ in COLUMNS]
+    for blob in Chunk(path=path, mode='rb').iter_raw():
+        si = StreamItem()
+        read_projected(si, protocol(TTransport.TMemoryBuffer(blob)), _spec)
+        for values, kind, get in getters:
+            val = get(si)
+            if kind == 'string' and val is None:
+                val = ''
+            values.append(val)
+    return columns
+
+
+def _iter_columns(paths, workers):
+    if workers == 1:
+        for path in paths:
+            yield path, extract_columns(path)
+        return
+    pool = multiprocessing.Pool(workers)
+    try:
+        for path, columns in zip(paths, pool.imap(extract_columns, paths)):
+            yield path, columns
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def _parquet_schema():
+    ## binary, since urls and ids in StreamItems need not be UTF-8
+    types = {'string': pyarrow.binary(), 'float': pyarrow.float64(),
+             'int': pyarrow.int64()}
+    return pyarrow.schema([pyarrow.field('path', pyarrow.binary())] +
+                          [pyarrow.field(name, types[kind])
+                           for name, kind, _, _ in COLUMNS])
+
+
+def _write_parquet(out_path, chunks):
+    if pyarrow is None:
+        raise RuntimeError('writing %s requires pyarrow' % out_path)
+    schema = _parquet_schema()
+    writer = pyarrow.parquet.ParquetWriter(out_path, schema, use_dictionary=True)
+    rows = 0
+    try:
+        for path, columns in chunks:
+            num = len(columns['stream_id'])
+            if not num:
+                continue
+            arrays = [pyarrow.array([path] * num, pyarrow.binary())]
+            arrays.extend(pyarrow.array(columns[field.name], field.type)
+                          for field in list(schema)[1:])
+            writer.write_table(pyarrow.Table.from_arrays(arrays, schema=schema))
+            rows += num
+    finally:
+        writer.close()
+    return rows
+
+
+def _encode(values):
+    '''returns the int32 codes of the strings `values` into a sorted
+    array of their distinct values
+    '''
+    dictionary, codes = np.unique(np.array(values, dtype=str), return_inverse=True)
+    return codes.astype(np.int32), dictionary
+
+
+def _write_npz(out_path, chunks):
+    if np is None:
+        raise RuntimeError('writing %s requires numpy' % out_path)
+    columns = dict((name, []) for name, _, _, _ in COLUMNS)
+    paths = []
+    for path, chunk_columns in chunks:
+        paths.extend([path] * len(chunk_columns['stream_id']))
+        for name, values in chunk_columns.iteritems():
+            columns[name].extend(values)
+    arrays = {}
+    for name, kind, _, _ in [('path', 'string', None, None)] + COLUMNS:
+        values = paths if name == 'path' else columns[name]
+        if kind == 'string':
+            arrays[name], arrays[name + '.dictionary'] = _encode(values)
+        else:
+            arrays[name] = np.array(values, dtype={'float': np.float64,
+                                                   'int': np.int64}[kind])
+    with open(out_path, 'wb') as fh:
+        np.savez(fh, **arrays)
+    return len(paths)
+
+
+def export_columns(paths, out_path, workers=None):
+    '''write COLUMNS of every message in the chunks at `paths` to the
+    columnar file at `out_path`, with a `path` column naming the chunk
+    of each row.  Chunks are decoded in `workers` processes, by
+    default one per CPU.  An .npz file is built in memory; Parquet is
+    written one chunk at a time.
+
+    :returns: number of rows written
+    '''
+    if workers is None:
+        workers = multiprocessing.cpu_count()
+    chunks = _iter_columns(list(paths), workers)
+    if out_path.endswith('.parquet'):
+        rows = _write_parquet(out_path, chunks)
+    else:
+        rows = _write_npz(out_path, chunks)
+    logger.info('exported %d rows to %s', rows, out_path)
+    return rows
+
+
+def read_columns(path, columns=None):
+    '''returns a dict from column name to a numpy array of its values,
+    with strings decoded, for the columns named in `columns`, or all of
+    them, of a file written by export_columns
+    '''
+    if path.endswith('.parquet'):
+        table = pyarrow.parquet.read_table(path, columns=columns)
+        return dict((name, np.array(table.column(name).to_pylist()))
+                    for name in table.schema.names)
+    out = {}
+    with np.load(path) as arrays:
+        for name in arrays.files:
+            if name.endswith('.dictionary') or \
+               (columns is not None and name not in columns):
+                continue
+            values = arrays[name]
+            if name + '.dictionary' in arrays.files:
+                values = arrays[name + '.dictionary'][values]
+            out[name] = values
+    return out
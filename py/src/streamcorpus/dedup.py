@@ -0,0 +1,206 @@
+'''Drop duplicate messages from streams of chunks.
+
+Duplicates are messages with the same key: the `doc_id`, which
+make_stream_item derives from the abs_url, or a `content` hash of
+body.raw, or any function of a StreamItem.  Keys already seen are
+remembered in one of:
+
+  * a python set, the default, exact but in memory
+  * SqliteKeys, exact and on disk, for more keys than fit in memory
+  * BloomFilter, in fixed memory, which wrongly drops about
+    `error_rate` of the unique messages
+
+dedup filters an iterator of messages, keeping the first of each key.
+dedup_paths filters the serialized messages of chunk files, decoding
+only the fields the key needs, and can instead keep the latest of each
+key by stream_time, which takes a second pass over the files.
+
+.. This software is released under an MIT/X11 open source license.
+   Copyright 2012-2015 Diffeo, Inc.
+'''
+from __future__ import absolute_import
+import hashlib
+import logging
+import sqlite3
+
+from thrift.transport import TTransport
+
+from streamcorpus.ttypes import StreamItem
+from streamcorpus._chunk import Chunk, protocol
+from streamcorpus._projection import project_spec, read_projected
+
+logger = logging.getLogger(__name__)
+
+POLICIES = ('first', 'latest')
+
+
+def doc_id_key(si):
+    return si.doc_id
+
+
+def content_key(si):
+    'md5 of body.raw, or None if there is no body'
+    if si.body is None or si.body.raw is None:
+        return None
+    return hashlib.md5(si.body.raw).digest()
+
+## fields that each named key decodes
+KEYS = {
+    'doc_id': (doc_id_key, ['doc_id']),
+    'content': (content_key, ['body.raw']),
+}
+
+
+def _key_func(key):
+    '''returns the function and the fields to decode for `key`, a name
+    in KEYS or a function of a whole StreamItem
+    '''
+    if callable(key):
+        return key, None
+    if key not in KEYS:
+        raise ValueError('key=%r is not one of %r or a function' % (key, sorted(KEYS)))
+    return KEYS[key]
+
+
+class SqliteKeys(object):
+    '''
+    Set of keys in an SQLite database, for dedup and dedup_paths when
+    there are too many keys for memory.  The default `path`, '', is a
+    temporary database that is removed when closed.  A named `path`
+    keeps its keys, so a later run skips the keys seen before; writes
+    are committed every `commit_every` keys and on close, so a run
+    that dies loses at most that many.
+    '''
+    def __init__(self, path='', commit_every=10000):
+        self.db = sqlite3.connect(path)
+        self.commit_every = commit_every
+        self._uncommitted = 0
+        self.db.execute('CREATE TABLE IF NOT EXISTS keys '
+                        '(key BLOB PRIMARY KEY, epoch REAL, position INTEGER)')
+        self.db.commit()
+
+    def _wrote(self):
+        self._uncommitted += 1
+        if self._uncommitted >= self.commit_every:
+            self.db.commit()
+            self._uncommitted = 0
+
+    def add(self, key):
+        'add `key`, returning True if it was not there before'
+        cursor = self.db.execute('INSERT OR IGNORE INTO keys (key) VALUES (?)',
+                                 (buffer(key),))
+        self._wrote()
+        return cursor.rowcount == 1
+
+    def update(self, key, epoch, position):
+        '''record the message at `position` as the latest of `key` if its
+        `epoch` is later than that of any before it
+        '''
+        key = buffer(key)
+        self.db.execute('INSERT OR IGNORE INTO keys VALUES (?, ?, ?)',
+                        (key, epoch, position))
+        self.db.execute('UPDATE keys SET epoch = ?, position = ? '
+                        'WHERE key = ? AND epoch < ?', (epoch, position, key, epoch))
+        self._wrote()
+
+    def latest(self, key):
+        'position of the latest message of `key`'
+        row = self.db.execute('SELECT position FROM keys WHERE key = ?',
+                              (buffer(key),)).fetchone()
+        return row and row[0]
+
+    def close(self):
+        self.db.commit()
+        self.db.close()
+
+
+class _MemoryLatest(object):
+    'in-memory positions of the latest message of each key'
+    def __init__(self):
+        self._latest = {}
+
+    def update(self, key, epoch, position):
+        if key not in self._latest or self._latest[key][0] < epoch:
+            self._latest[key] = (epoch, position)
+
+    def latest(self, key):
+        return self._latest[key][1]
+
+
+def dedup(items, key='doc_id', seen=None):
+    '''yields the items of `items` whose key was not seen before.
+    Items whose key is None are always kept.
+
+    :param key: 'doc_id', 'content', or a function of an item
+
+    :param seen: where to remember keys, anything with add(key)
+    returning True for a new key, such as a BloomFilter or
+    SqliteKeys; defaults to a set in memory
+    '''
+    key, _ = _key_func(key)
+    if seen is None:
+        seen = set()
+    for item in items:
+        k = key(item)
+        if k is None:
+            yield item
+        elif isinstance(seen, set):
+            if k not in seen:
+                seen.add(k)
+                yield item
+        elif seen.add(k):
+            yield item
+
+
+def _keyed_blobs(paths, key, fields, epoch=False):
+    '''yields (key, epoch_ticks, blob) for the messages of the chunks at
+    `paths`, decoding only `fields`, or whole messages if None
+    '''
+    spec = None
+    if fields is not None:
+        if epoch:
+            fields = fields + ['stream_time.epoch_ticks']
+        spec = project_spec(StreamItem, fields)
+    for path in paths:
+        for blob in Chunk(path=path, mode='rb').iter_raw():
+            si = StreamItem()
+            iprot = protocol(TTransport.TMemoryBuffer(blob))
+            if spec is None:
+                si.read(iprot)
+            else:
+                read_projected(si, iprot, spec)
+            ticks = None
+            if si.stream_time is not None:
+                ticks = si.stream_time.epoch_ticks
+            yield key(si), ticks, blob
+
+
+def dedup_paths(paths, key='doc_id', policy='first', seen=None):
+    '''yields the serialized messages, as from Chunk.iter_raw, of the
+    chunks at `paths` with duplicates removed, see dedup.
+
+    :param policy: 'first' keeps the first message of each key in the
+    order of `paths`.  'latest' keeps the one with the latest
+    stream_time, the first of those if there is a tie, in a second pass
+    over `paths`; `seen` must then be SqliteKeys or None.
+    '''
+    if policy not in POLICIES:
+        raise ValueError('policy=%r not in %r' % (policy, POLICIES))
+    key, fields = _key_func(key)
+    if policy == 'first':
+        blobs = ((k, blob) for k, _, blob in _keyed_blobs(paths, key, fields))
+        for _, blob in dedup(blobs, key=lambda pair: pair[0], seen=seen):
+            yield blob
+        return
+
+    latest = seen
+    if latest is None:
+        latest = _MemoryLatest()
+    elif not hasattr(latest, 'update'):
+        raise ValueError("policy='latest' cannot use %r" % type(latest).__name__)
+    for position, (k, ticks, _) in enumerate(_keyed_blobs(paths, key, fields, epoch=True)):
+        if k is not None:
+            latest.update(k, ticks if ticks is not None else float('-inf'), position)
+    for position, (k, _, blob) in enumerate(_keyed_blobs(paths, key, fields)):
+        if k is None or latest.latest(k) == position:
+            yield blob
@@ -23,6 +23,13 @@ from operator import itemgetter
 
 from streamcorpus._chunk import Chunk as _Chunk
 from streamcorpus._cbor_chunk import CborChunk
+from streamcorpus.chunk_roller import ChunkRoller
+from streamcorpus.merge import merge
+from streamcorpus.dedup import KEYS, POLICIES, SqliteKeys, dedup_paths
+from streamcorpus._bloom import BloomFilter
+from streamcorpus.catalog import Catalog
+from streamcorpus.columns import export_columns
+from streamcorpus._projection import project_spec
 from streamcorpus.ttypes import OffsetType, Token, EntityType, MentionType
 
 from streamcorpus.ttypes import StreamItem as StreamItem_v0_3_0
@@ -139,6 +146,15 @@ def _dump(fpath, args):
     if args.stats:
         stats = {}
 
+    if args.count and not args.labels_only:
+        ## counting needs no decoding
+        for num, blob in enumerate(Chunk(path=fpath, mode='rb').iter_raw()):
+            if args.limit and num >= args.limit:
+                break
+            num_stream_items += 1
+        print '%d\t%d\t%s' % (num_stream_items, len(num_labeled_stream_items), fpath)
+        return
+
     for num, si in enumerate(Chunk(path=fpath, mode='rb')):
         if args.limit and num >= args.limit:
             break
@@ -378,10 +394,31 @@ num_valid_label_offsets: %d
 ''' % (num_valid_byte_offsets, num_valid_line_offsets, num_valid_label_offsets)
 
 
-def _find(fpaths, stream_id=None, abs_url=None, dump_binary_stream_item=False):
+def _find_candidates(fpath, stream_id=None, abs_url=None):
+    '''
+    Iterate over the StreamItems in the chunk at fpath that might
+    match; if the chunk has an index sidecar, this reads only the
+    matching StreamItem instead of the whole chunk, and if its bloom
+    filter rules out stream_id, nothing.
+    '''
+    ichunk = Chunk(path=fpath, mode='rb')
+    if stream_id and not ichunk.might_contain(stream_id=stream_id):
+        return []
+    if ichunk.index is None:
+        return ichunk
+    si = ichunk.get(stream_id=stream_id, abs_url=abs_url)
+    if si is None:
+        return []
+    return [si]
+
+
+def _find(fpaths, stream_id=None, abs_url=None, dump_binary_stream_item=False,
+          catalog=None):
     '''
     Read in a streamcorpus.Chunk file and if any of its stream_ids
-    match stream_id, then print stream_item.body.raw to stdout
+    match stream_id, then print stream_item.body.raw to stdout.  With
+    a Catalog, only the chunks that it says might match are read, out
+    of `fpaths` or, if that is empty, of the whole catalog.
     '''
     offsets = None
     if stream_id:
@@ -390,8 +427,17 @@ def _find(fpaths, stream_id=None, abs_url=None, dump_binary_stream_item=False):
             stream_id, offsets = stream_id.split('#')
     if abs_url:
         sys.stderr.write('hunting for abs_url=%r\n' % abs_url)
+    if catalog is not None:
+        candidates = catalog.find(stream_id=stream_id, abs_url=abs_url)
+        if fpaths:
+            candidates = set(candidates)
+            fpaths = [fpath for fpath in fpaths
+                      if os.path.abspath(fpath) in candidates]
+        else:
+            fpaths = candidates
+        sys.stderr.write('catalog has %d candidate chunks\n' % len(fpaths))
     for fpath in fpaths:
-        for si in Chunk(path=fpath, mode='rb'):
+        for si in _find_candidates(fpath, stream_id=stream_id, abs_url=abs_url):
             if (stream_id and stream_id == si.stream_id) or \
                (abs_url and abs_url == si.abs_url):
                 if dump_binary_stream_item:
@@ -429,8 +475,15 @@ def _show_fields(fpaths, fields, len_fields):
     '''
     streamcorpus.Chunk files and display each field specified in 'fields'
     '''
+    ## decode only the fields that will be displayed
+    try:
+        project_spec(message_class, fields + len_fields)
+        projection = fields + len_fields
+    except ValueError:
+        ## let unknown fields display as missing, like before
+        projection = None
     for fpath in fpaths:
-        for si in Chunk(path=fpath, mode='rb'):
+        for si in Chunk(path=fpath, mode='rb', fields=projection):
             output = []
             for field in fields:
                 prop = si
@@ -576,9 +629,10 @@ def _copy(args):
     ochunk = Chunk(file_obj=sys.stdout, mode='wb')
     for fpath in args.input_path:
         ichunk = Chunk(path=fpath, mode='rb')
-        for si in ichunk:
+        ## copy the serialized StreamItems verbatim, without decoding
+        for blob in ichunk.iter_raw():
             count += 1
-            ochunk.add(si)
+            ochunk.add_raw(blob)
             if (args.limit is not None) and (count >= args.limit):
                 break
         ichunk.close()
@@ -588,6 +642,33 @@ def _copy(args):
     sys.stderr.write('wrote {0} items\n'.format(count))
 
 
+def _merge(args):
+    if not os.path.exists(args.merge_to):
+        os.makedirs(args.merge_to)
+    roller = ChunkRoller(args.merge_to, chunk_max=args.chunk_max, bloom=args.bloom)
+    count = merge(args.input_path, roller, presorted=not args.sort)
+    roller.close()
+    sys.stderr.write('merged {0} items into {1}\n'.format(count, args.merge_to))
+
+
+def _dedup(args):
+    seen = None
+    if args.dedup_bloom:
+        seen = BloomFilter(args.dedup_bloom)
+    elif args.dedup_db:
+        seen = SqliteKeys(args.dedup_db)
+    count = 0
+    ochunk = Chunk(file_obj=sys.stdout, mode='wb')
+    for blob in dedup_paths(args.input_path, key=args.dedup,
+                            policy=args.dedup_policy, seen=seen):
+        ochunk.add_raw(blob)
+        count += 1
+    ochunk.close()
+    if isinstance(seen, SqliteKeys):
+        seen.close()
+    sys.stderr.write('wrote {0} unique items\n'.format(count))
+
+
 def _slots_to_kv(ob):
     for sn in ob.__slots__:
         v = getattr(ob, sn)
@@ -724,6 +805,28 @@ def main():
                         default=False, dest='print_url')
     parser.add_argument('--html', action='store_true')
     parser.add_argument('--copy', action='store_true', default=False, help='copy items to stdout, useful with --limit')
+    parser.add_argument('--merge-to', metavar='DIR', default=None,
+                        help='merge the inputs, each in stream_time order, into chunks in DIR in stream_time order')
+    parser.add_argument('--sort', action='store_true', default=False,
+                        help='with --merge-to, sort inputs that are not in stream_time order, spilling to temporary files')
+    parser.add_argument('--chunk-max', type=int, default=500,
+                        help='with --merge-to, number of items per output chunk')
+    parser.add_argument('--bloom', action='store_true', default=False,
+                        help='with --merge-to, write a bloom filter of stream_ids and doc_ids next to each output chunk, for --find-stream-id')
+    parser.add_argument('--dedup', choices=sorted(KEYS), default=None,
+                        help='copy items to stdout, dropping those with the same doc_id or body.raw as another')
+    parser.add_argument('--dedup-policy', choices=POLICIES, default='first',
+                        help='with --dedup, keep the first item of each key, or the one with the latest stream_time')
+    parser.add_argument('--dedup-bloom', type=int, metavar='CAPACITY', default=None,
+                        help='with --dedup, remember keys in a Bloom filter sized for CAPACITY keys, which drops a few unique items')
+    parser.add_argument('--dedup-db', metavar='PATH', default=None,
+                        help='with --dedup, remember keys in an SQLite database at PATH instead of in memory')
+    parser.add_argument('--export-columns', metavar='OUT', default=None,
+                        help='write ids, source, stream_time, media type, language, text lengths and rating counts of every item to OUT, a .parquet or .npz file')
+    parser.add_argument('--catalog', metavar='PATH', default=None,
+                        help='SQLite catalog of chunks, which --find-stream-id and --find-abs-url use to read only the chunks that might match')
+    parser.add_argument('--update-catalog', action='store_true', default=False,
+                        help='record the inputs that are new or changed in --catalog')
     if CborChunk.is_available:
         parser.add_argument('--to-cbor', action='store_true', default=False)
     parser.add_argument('--verbose', action='store_true', default=False)
@@ -762,8 +865,17 @@ def main():
             paths.append(ipath)
     args.input_path = paths
 
+    catalog = None
+    if args.catalog:
+        catalog = Catalog(args.catalog)
+
     ## now actually do whatever was requested
-    if args.fields:
+    if args.update_catalog:
+        if catalog is None:
+            sys.exit('--update-catalog requires --catalog')
+        count = catalog.update(args.input_path)
+        sys.stderr.write('cataloged {0} chunks\n'.format(count))
+    elif args.fields:
         _show_fields(args.input_path, args.fields, args.len_fields)
     elif args.tagger_stats:
         _tagger_stats(args, args.input_path)
@@ -771,10 +883,12 @@ def main():
         _stats(args.input_path)
     elif args.find_stream_id:
         _find(args.input_path, stream_id=args.find_stream_id,
-              dump_binary_stream_item=args.dump_binary_stream_item)
+              dump_binary_stream_item=args.dump_binary_stream_item,
+              catalog=catalog)
     elif args.find_abs_url:
         _find(args.input_path, abs_url=args.find_abs_url,
-              dump_binary_stream_item=args.dump_binary_stream_item)
+              dump_binary_stream_item=args.dump_binary_stream_item,
+              catalog=catalog)
     elif args.tokens:
         _dump_tokens(args.input_path, args.annotator_ids, args.tagger_ids)
     elif args.find_missing:
@@ -787,6 +901,13 @@ def main():
                       include_header=args.include_header)
     elif args.copy:
         _copy(args)
+    elif args.merge_to:
+        _merge(args)
+    elif args.dedup:
+        _dedup(args)
+    elif args.export_columns:
+        rows = export_columns(args.input_path, args.export_columns)
+        sys.stderr.write('exported {0} items\n'.format(rows))
     elif args.to_cbor:
         _to_cbor(args)
     elif args.html:
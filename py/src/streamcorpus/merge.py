@@ -0,0 +1,159 @@
+'''Merge many chunks into one stream ordered by stream_time.
+
+merge_raw is a streaming k-way merge of chunks whose messages are
+each already in stream_time order: a heap holds the next message of
+every input, so memory grows with the number of inputs, not the number
+of messages.  sort_raw handles inputs in any order with an external
+sort, which sorts runs of `run_size` messages in memory, spills each to
+a temporary chunk, and merges the runs.
+
+Messages are carried as their serialized bytes, as from
+Chunk.iter_raw, and only stream_time.epoch_ticks is decoded from each,
+see project_spec.  merge writes them to a ChunkRoller, or anything else
+with add_raw.
+
+.. This software is released under an MIT/X11 open source license.
+   Copyright 2012-2015 Diffeo, Inc.
+'''
+from __future__ import absolute_import
+import heapq
+import itertools
+import logging
+import os
+import shutil
+import tempfile
+
+from thrift.transport import TTransport
+
+from streamcorpus.ttypes import StreamItem
+from streamcorpus._chunk import Chunk, protocol
+from streamcorpus._projection import project_spec, read_projected
+
+logger = logging.getLogger(__name__)
+
+## messages per run that sort_raw sorts in memory
+RUN_SIZE = 100000
+
+## most runs that sort_raw merges at once
+MAX_OPEN = 64
+
+_key_spec = project_spec(StreamItem, ['stream_time.epoch_ticks'])
+
+
+def stream_time_key(blob):
+    '''returns the stream_time.epoch_ticks of the serialized StreamItem
+    `blob`, or -inf if it has none, so such messages come first
+    '''
+    si = StreamItem()
+    read_projected(si, protocol(TTransport.TMemoryBuffer(blob)), _key_spec)
+    if si.stream_time is None or si.stream_time.epoch_ticks is None:
+        return float('-inf')
+    return si.stream_time.epoch_ticks
+
+
+def _keyed(path, num, key):
+    '''yields (key, num, position, blob) for each message in the chunk at
+    `path`, the `num`-th input, checking that they are in order
+    '''
+    last = None
+    for position, blob in enumerate(Chunk(path=path, mode='rb').iter_raw()):
+        k = key(blob)
+        if last is not None and k < last:
+            raise ValueError('%s is not in order at message %d; use sort_raw'
+                             % (path, position))
+        last = k
+        ## num and position break ties, so blobs are never compared
+        yield k, num, position, blob
+
+
+def merge_raw(paths, key=stream_time_key):
+    '''yields the serialized messages of the chunks at `paths`, each of
+    which must be ordered by `key`, merged into one sequence ordered by
+    `key`.  Ties keep the order of `paths`.  Raises ValueError if an
+    input is out of order.
+    '''
+    inputs = [_keyed(path, num, key) for num, path in enumerate(paths)]
+    for _, _, _, blob in heapq.merge(*inputs):
+        yield blob
+
+
+def _spill(run, tmp_dir, num):
+    'sort `run` and write it to a temporary chunk, returning its path'
+    run.sort()
+    path = os.path.join(tmp_dir, 'run-%d.sc' % num)
+    with Chunk(path=path, mode='wb', inline_md5=False) as ch:
+        for _, _, blob in run:
+            ch.add_raw(blob)
+    return path
+
+
+def sort_raw(paths, key=stream_time_key, run_size=RUN_SIZE, max_open=MAX_OPEN,
+             tmp_dir=None):
+    '''yields the serialized messages of the chunks at `paths`, in any
+    order, sorted by `key`, with ties in input order.
+
+    At most `run_size` messages are held in memory.  Larger inputs are
+    spilled as sorted runs to temporary chunks in a directory made in
+    `tmp_dir`, which are merged at most `max_open` at a time, and
+    removed when the generator finishes or is closed.
+    '''
+    ## sequence numbers keep the sort stable and never compare blobs
+    seq = itertools.count()
+    blobs = itertools.chain.from_iterable(
+        Chunk(path=path, mode='rb').iter_raw() for path in paths)
+    run = list(itertools.islice(((key(blob), next(seq), blob) for blob in blobs),
+                                run_size))
+    if len(run) < run_size:
+        ## it all fits in memory
+        run.sort()
+        for _, _, blob in run:
+            yield blob
+        return
+
+    spill_dir = tempfile.mkdtemp(prefix='tmp-streamcorpus-sort-', dir=tmp_dir)
+    try:
+        runs = []
+        while run:
+            runs.append(_spill(run, spill_dir, len(runs)))
+            run = list(itertools.islice(
+                ((key(blob), next(seq), blob) for blob in blobs), run_size))
+        logger.info('sorting %d runs of %d messages', len(runs), run_size)
+        ## merge in passes until few enough runs remain to open at once
+        num = len(runs)
+        while len(runs) > max_open:
+            merged = []
+            for start in range(0, len(runs), max_open):
+                group = runs[start:start + max_open]
+                path = os.path.join(spill_dir, 'run-%d.sc' % num)
+                num += 1
+                with Chunk(path=path, mode='wb', inline_md5=False) as ch:
+                    for blob in merge_raw(group, key):
+                        ch.add_raw(blob)
+                for done in group:
+                    os.remove(done)
+                merged.append(path)
+            runs = merged
+        for blob in merge_raw(runs, key):
+            yield blob
+    finally:
+        shutil.rmtree(spill_dir, ignore_errors=True)
+
+
+def merge(paths, output, presorted=True, **kwargs):
+    '''write the messages of the chunks at `paths` to `output`, such as a
+    ChunkRoller or a Chunk open for writing, in stream_time order.  If
+    `presorted`, each input must already be in order and they are
+    merged with merge_raw; otherwise they are sorted with sort_raw,
+    which takes the other keyword arguments.  `output` is not closed.
+
+    :returns: number of messages written
+    '''
+    if presorted:
+        blobs = merge_raw(paths, **kwargs)
+    else:
+        blobs = sort_raw(paths, **kwargs)
+    count = 0
+    for blob in blobs:
+        output.add_raw(blob)
+        count += 1
+    return count
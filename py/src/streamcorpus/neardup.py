@@ -0,0 +1,222 @@
+'''Find messages whose body.clean_visible is nearly the same as that of
+an earlier message, such as syndicated news or boilerplate pages.
+
+Each text is reduced to a MinHash signature over its shingles, runs of
+`shingle_size` words, and two texts are near duplicates if the
+fraction of equal signature values, which estimates the Jaccard
+similarity of their shingles, is at least `threshold`.  Candidates are
+found with locality sensitive hashing on bands of the signature, so
+each check costs about the same however many texts came before.
+
+With numpy, shingle hashes and signatures are computed with array
+operations over all shingles of a text at once; without it, the same
+signatures are computed in pure python, much more slowly.
+
+.. This software is released under an MIT/X11 open source license.
+   Copyright 2012-2015 Diffeo, Inc.
+'''
+from __future__ import absolute_import
+from collections import OrderedDict
+import logging
+import random
+import struct
+import zlib
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+logger = logging.getLogger(__name__)
+
+## key in StreamItem.source_metadata of the stream_id that a tagged
+## message nearly duplicates
+NEAR_DUPLICATE_KEY = 'near_duplicate_of'
+
+_MASK32 = 0xffffffff
+## multiplier for combining the word hashes of a shingle
+_SHINGLE_PRIME = 16777619
+## prime just above 2**32, for the MinHash permutations
+_MINHASH_PRIME = 4294967311
+
+## shingles per array operation, which bounds the temporary arrays to
+## SHINGLE_BLOCK * num_perm values
+SHINGLE_BLOCK = 4096
+
+
+def _word_hashes(text):
+    if isinstance(text, unicode):
+        text = text.encode('utf8')
+    return [zlib.crc32(word) & _MASK32 for word in text.lower().split()]
+
+
+class NearDuplicateDetector(object):
+    '''
+    LSH index of the MinHash signatures of recent texts.
+
+    :param threshold: least estimated Jaccard similarity of shingles
+    for two texts to be near duplicates
+
+    :param num_perm: number of values in a signature
+
+    :param bands: number of LSH bands that the signature is split
+    into; more bands find more candidates at lower similarity
+
+    :param shingle_size: words per shingle
+
+    :param max_items: most signatures to keep; beyond this, the oldest
+    are forgotten, so memory stays around max_items * num_perm * 8
+    bytes and near duplicates are only found among recent texts
+
+    :param seed: of the MinHash permutations; signatures are only
+    comparable between detectors with the same seed and num_perm
+    '''
+    def __init__(self, threshold=0.8, num_perm=128, bands=16, shingle_size=4,
+                 max_items=100000, seed=1):
+        assert num_perm % bands == 0, 'num_perm=%d is not a multiple of bands=%d' \
+            % (num_perm, bands)
+        self.threshold = threshold
+        self.num_perm = num_perm
+        self.bands = bands
+        self.rows = num_perm // bands
+        self.shingle_size = shingle_size
+        self.max_items = max_items
+        rand = random.Random(seed)
+        self._a = [rand.randint(1, _MASK32 - 1) for _ in range(num_perm)]
+        self._b = [rand.randint(0, _MASK32) for _ in range(num_perm)]
+        if np is not None:
+            self._np_a = np.array(self._a, dtype=np.uint64)
+            self._np_b = np.array(self._b, dtype=np.uint64)
+        ## band value -> keys with that band value, oldest first, one
+        ## dict per band
+        self._buckets = [{} for _ in range(bands)]
+        ## key -> (signature, band values), oldest first
+        self._items = OrderedDict()
+
+    def __len__(self):
+        return len(self._items)
+
+    def signature(self, text):
+        '''returns the MinHash signature of the bytes `text`, or None if it
+        has no words
+        '''
+        words = _word_hashes(text)
+        if not words:
+            return None
+        if np is None:
+            return self._signature_python(words)
+        return self._signature_numpy(words)
+
+    def _signature_numpy(self, words):
+        words = np.array(words, dtype=np.uint64)
+        num = max(1, len(words) - self.shingle_size + 1)
+        ## combine each run of shingle_size word hashes, all at once
+        shingles = np.zeros(num, dtype=np.uint64)
+        for j in range(min(self.shingle_size, len(words))):
+            shingles = (shingles * np.uint64(_SHINGLE_PRIME) + words[j:j + num]) \
+                & np.uint64(_MASK32)
+        sig = np.full(self.num_perm, _MINHASH_PRIME, dtype=np.uint64)
+        for start in range(0, num, SHINGLE_BLOCK):
+            block = shingles[start:start + SHINGLE_BLOCK, np.newaxis]
+            perms = (block * self._np_a + self._np_b) % np.uint64(_MINHASH_PRIME)
+            np.minimum(sig, perms.min(axis=0), out=sig)
+        return sig
+
+    def _signature_python(self, words):
+        num = max(1, len(words) - self.shingle_size + 1)
+        shingles = []
+        for i in range(num):
+            h = 0
+            for word in words[i:i + self.shingle_size]:
+                h = (h * _SHINGLE_PRIME + word) & _MASK32
+            shingles.append(h)
+        return [min((a * h + b) % _MINHASH_PRIME for h in shingles)
+                for a, b in zip(self._a, self._b)]
+
+    def _band_values(self, sig):
+        rows = self.rows
+        if np is not None and isinstance(sig, np.ndarray):
+            return [sig[i * rows:(i + 1) * rows].tostring() for i in range(self.bands)]
+        return [struct.pack('<%dQ' % rows, *sig[i * rows:(i + 1) * rows])
+                for i in range(self.bands)]
+
+    def similarity(self, sig1, sig2):
+        'estimated Jaccard similarity of the texts of two signatures'
+        if np is not None and isinstance(sig1, np.ndarray):
+            return np.count_nonzero(sig1 == sig2) / float(self.num_perm)
+        return sum(1 for v1, v2 in zip(sig1, sig2) if v1 == v2) / float(self.num_perm)
+
+    def find(self, sig):
+        '''returns the key of the most similar text in the index that is a
+        near duplicate of the one with signature `sig`, or None
+        '''
+        best, best_similarity = None, self.threshold
+        candidates = set()
+        for bucket, value in zip(self._buckets, self._band_values(sig)):
+            candidates.update(bucket.get(value, ()))
+        for key in candidates:
+            similarity = self.similarity(sig, self._items[key][0])
+            if similarity >= best_similarity:
+                best, best_similarity = key, similarity
+        return best
+
+    def add(self, key, sig):
+        'add the signature `sig` of the text of `key` to the index'
+        if key in self._items:
+            return
+        if len(self._items) >= self.max_items:
+            self._forget()
+        values = self._band_values(sig)
+        for bucket, value in zip(self._buckets, values):
+            bucket.setdefault(value, []).append(key)
+        self._items[key] = (sig, values)
+
+    def _forget(self):
+        key, (_, values) = self._items.popitem(last=False)
+        for bucket, value in zip(self._buckets, values):
+            keys = bucket[value]
+            ## the oldest key, so usually first
+            keys.remove(key)
+            if not keys:
+                del bucket[value]
+
+    def check(self, key, text):
+        '''returns the key of an earlier near duplicate of `text`, or
+        None after adding `text` under `key`
+        '''
+        sig = self.signature(text)
+        if sig is None:
+            return None
+        dup = self.find(sig)
+        if dup is None:
+            self.add(key, sig)
+        return dup
+
+
+def near_dedup(items, detector=None, action='drop'):
+    '''yields the StreamItems of `items`, except those whose
+    body.clean_visible nearly duplicates that of an earlier one.
+
+    :param detector: a NearDuplicateDetector, by default a new one
+
+    :param action: 'drop' near duplicates, or 'tag' them by setting
+    source_metadata[NEAR_DUPLICATE_KEY] to the stream_id of the
+    earlier item and yielding them too
+    '''
+    assert action in ('drop', 'tag'), action
+    if detector is None:
+        detector = NearDuplicateDetector()
+    dropped = 0
+    for si in items:
+        text = si.body and si.body.clean_visible
+        dup = text and detector.check(si.stream_id, text)
+        if not dup:
+            yield si
+        elif action == 'tag':
+            if si.source_metadata is None:
+                si.source_metadata = {}
+            si.source_metadata[NEAR_DUPLICATE_KEY] = dup
+            yield si
+        else:
+            dropped += 1
+    logger.debug('dropped %d near duplicates', dropped)
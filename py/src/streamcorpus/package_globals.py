@@ -58,18 +58,35 @@ from ._chunk import Chunk, PickleChunk, JsonChunk, \
     parse_file_extensions, known_compression_schemes, \
     decrypt_and_uncompress, compress_and_encrypt, \
     compress_and_encrypt_path, \
-    serialize, deserialize, \
+    serialize, serialize_many, deserialize, \
     VersionMismatchError
+from ._async_chunk import AsyncChunk, ChunkIOPool
+from ._bloom import BloomFilter
+from ._chunk_index import ChunkIndex
+from ._intern import InternTable, intern_strings
+from ._codecs import Codec, ZstdCodec, register_codec, \
+    train_dictionary, load_dictionary, register_dictionary
+from ._gpg import GpgContext
+from ._raw_messages import iter_raw_messages, count_raw_messages
+from ._block_chunk import BlockChunk
 from ._cbor_chunk import CborChunk
-from chunk_roller import ChunkRoller
+from chunk_roller import ChunkRoller, PartitionedChunkWriter
+from parallel_reader import ParallelChunkReader
 
 __all__ = ['Chunk', 'PickleChunk', 'JsonChunk', 'CborChunk',
-           'ChunkRoller',
+           'ChunkIndex', 'BlockChunk',
+           'AsyncChunk', 'ChunkIOPool', 'BloomFilter',
+           'InternTable', 'intern_strings',
+           'iter_raw_messages', 'count_raw_messages',
+           'ChunkRoller', 'PartitionedChunkWriter', 'ParallelChunkReader',
            'decrypt_and_uncompress', 'compress_and_encrypt',
            'compress_and_encrypt_path',
+           'GpgContext',
            'parse_file_extensions',
            'known_compression_schemes',
-           'serialize', 'deserialize',
+           'Codec', 'ZstdCodec', 'register_codec',
+           'train_dictionary', 'load_dictionary', 'register_dictionary',
+           'serialize', 'serialize_many', 'deserialize',
            'make_stream_time', 'make_stream_item',
            'get_entity_type',
            'get_date_hour',
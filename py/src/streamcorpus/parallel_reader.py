@@ -0,0 +1,177 @@
+'''Read many chunk files with a pool of worker processes.
+
+Decompression and Thrift decoding of each chunk happen in a worker,
+and the decoded messages are sent back to the process iterating over
+the ParallelChunkReader.  Block chunks (`.scb`) can be split into
+tasks of a few blocks each, so that a single large chunk is spread
+across workers.
+
+.. This software is released under an MIT/X11 open source license.
+   Copyright 2012-2015 Diffeo, Inc.
+'''
+from __future__ import absolute_import
+import logging
+import multiprocessing
+import Queue
+import traceback
+
+from streamcorpus.ttypes import StreamItem
+from streamcorpus._chunk import Chunk
+from streamcorpus._block_chunk import BLOCK_EXTENSION, BlockChunk
+
+logger = logging.getLogger(__name__)
+
+
+def _read_task(task):
+    '''runs in a worker process: read the messages of one task, which
+    is a whole chunk file or a range of blocks in a block chunk
+    '''
+    path, start, stop, message, read_wrapper = task
+    try:
+        ch = Chunk(path=path, mode='rb', message=message,
+                   read_wrapper=read_wrapper)
+        if start is None:
+            msgs = list(ch)
+            return msgs, ch.md5_hexdigest, None
+        else:
+            msgs = list(ch.iter_blocks(start, stop))
+            if read_wrapper is not None:
+                msgs = map(read_wrapper, msgs)
+            return msgs, None, ch.block_md5s[start:stop]
+    except Exception:
+        return None, traceback.format_exc(), None
+
+
+class ParallelChunkReader(object):
+    '''
+    Iterate over the messages in many chunk files, decoding them in a
+    pool of worker processes.
+
+    :param paths: list of paths to chunk files
+
+    :param workers: number of worker processes, defaults to the number
+    of CPUs
+
+    :param ordered: if True, yield messages in the order of `paths`
+    and the order within each file, like reading the chunks one after
+    another.  If False, yield each task's messages as soon as it is
+    done.
+
+    :param max_in_flight: maximum number of tasks that are queued,
+    running, or waiting to be yielded, which bounds memory use to
+    about that many chunks (or block ranges) of decoded messages.
+    Defaults to twice the number of workers.
+
+    :param blocks_per_task: split block chunks into tasks of this many
+    blocks; by default each file is one task.
+
+    :param message: Thrift class of the messages, as for Chunk
+
+    :param read_wrapper: as for Chunk, applied in the worker, so it
+    must be picklable, e.g. a module-level function.  The objects it
+    returns are what get sent back from the workers.
+
+    After a full pass, `md5_hexdigests` and `counts` hold the md5 and
+    number of messages of each path, as `Chunk.md5_hexdigest` and
+    `len(Chunk)` would report them, and `len()` is the total number
+    of messages.  Block chunks that were split report `block_md5s`
+    instead of an md5 for the whole file.
+    '''
+    def __init__(self, paths, workers=None, ordered=True, max_in_flight=None,
+                 blocks_per_task=None, message=StreamItem, read_wrapper=None):
+        self.paths = list(paths)
+        self.workers = workers or multiprocessing.cpu_count()
+        self.ordered = ordered
+        self.max_in_flight = max_in_flight or 2 * self.workers
+        self.blocks_per_task = blocks_per_task
+        self.message = message
+        self.read_wrapper = read_wrapper
+
+        self.md5_hexdigests = {}
+        self.block_md5s = {}
+        self.counts = {}
+        self._count = 0
+
+    def __len__(self):
+        return self._count
+
+    def __repr__(self):
+        return '{0}(paths={1}, len={2})'.format(
+            type(self).__name__, len(self.paths), len(self))
+
+    def _tasks(self):
+        for path in self.paths:
+            if self.blocks_per_task and path.endswith(BLOCK_EXTENSION):
+                num_blocks = len(BlockChunk(path=path, mode='rb').blocks)
+                for start in range(0, num_blocks, self.blocks_per_task):
+                    yield (path, start, start + self.blocks_per_task,
+                           self.message, self.read_wrapper)
+            else:
+                yield path, None, None, self.message, self.read_wrapper
+
+    def _record(self, task, md5_hexdigest, block_md5s, count):
+        path = task[0]
+        self.counts[path] = self.counts.get(path, 0) + count
+        if md5_hexdigest is not None:
+            self.md5_hexdigests[path] = md5_hexdigest
+        if block_md5s is not None:
+            self.block_md5s.setdefault(path, []).extend(block_md5s)
+
+    def __iter__(self):
+        self._count = 0
+        self.md5_hexdigests = {}
+        self.block_md5s = {}
+        self.counts = {}
+
+        results = Queue.Queue()
+        tasks = enumerate(self._tasks())
+        ## results that arrived ahead of their turn in ordered mode
+        done = {}
+        next_to_yield = 0
+        in_flight = 0
+
+        pool = multiprocessing.Pool(self.workers)
+        try:
+            while True:
+                ## keep up to max_in_flight tasks submitted
+                while in_flight < self.max_in_flight:
+                    try:
+                        num, task = next(tasks)
+                    except StopIteration:
+                        break
+                    pool.apply_async(
+                        _read_task, (task,),
+                        callback=lambda result, num=num, task=task:
+                            results.put((num, task, result)))
+                    in_flight += 1
+                if in_flight == 0:
+                    break
+
+                if self.ordered and next_to_yield in done:
+                    num, task, result = done.pop(next_to_yield)
+                else:
+                    ## poll with a timeout so KeyboardInterrupt works
+                    try:
+                        num, task, result = results.get(True, 1)
+                    except Queue.Empty:
+                        continue
+                    if self.ordered and num != next_to_yield:
+                        done[num] = (num, task, result)
+                        continue
+                next_to_yield += 1
+
+                msgs, md5_hexdigest, block_md5s = result
+                if msgs is None:
+                    raise RuntimeError('failed to read %s in a worker:\n%s' % (
+                        task[0], md5_hexdigest))
+                self._record(task, md5_hexdigest, block_md5s, len(msgs))
+                for msg in msgs:
+                    self._count += 1
+                    yield msg
+                ## free this task's slot only once its messages are
+                ## consumed, so memory stays bounded
+                in_flight -= 1
+            pool.close()
+        finally:
+            pool.terminate()
+            pool.join()
@@ -0,0 +1,112 @@
+'''Tests for AsyncChunk
+
+.. This software is released under an MIT/X11 open source license.
+   Copyright 2012-2015 Diffeo, Inc.
+'''
+from __future__ import absolute_import
+import os
+import threading
+
+import pytest
+
+from streamcorpus import AsyncChunk, ChunkIOPool, Chunk
+from streamcorpus._test_util import make_si
+
+
+@pytest.yield_fixture
+def pool():
+    pool = ChunkIOPool(workers=2)
+    yield pool
+    pool.close()
+
+
+def read_all(chunk):
+    sis = []
+    while True:
+        batch = chunk.read_batch().result()
+        if not batch:
+            return sis
+        sis.extend(batch)
+
+
+@pytest.mark.parametrize('ext', ['sc', 'sc.xz', 'sc.gz'])
+def test_async_chunk_round_trip(tmpdir, pool, ext):
+    path = os.path.join(str(tmpdir), 'test.' + ext)
+    ch = AsyncChunk(path, mode='wb', pool=pool, batch_size=7)
+    futures = [ch.add(make_si(i)) for i in range(50)]
+    ch.close().result()
+    assert all(future.done() for future in futures)
+    ## each future is of the batch its message was written in
+    assert sum(future.result() for future in set(futures)) == 50
+
+    ch = AsyncChunk(path, pool=pool, batch_size=7, max_pending=2)
+    assert len(ch.read_batch().result()) == 7
+    assert len(ch._reads) == 1
+    sis = read_all(ch)
+    assert [si.stream_id for si in sis] == \
+        [make_si(i).stream_id for i in range(7, 50)]
+
+
+def test_async_chunk_many_streams(tmpdir, pool):
+    paths = []
+    chunks = []
+    for num in range(6):
+        paths.append(os.path.join(str(tmpdir), '%d.sc' % num))
+        chunks.append(AsyncChunk(paths[-1], mode='wb', pool=pool))
+    ## interleave the adds, as a loop serving many producers would
+    for i in range(20):
+        for num, ch in enumerate(chunks):
+            ch.add(make_si(num * 100 + i))
+    for future in [ch.close() for ch in chunks]:
+        future.result()
+    for num, path in enumerate(paths):
+        assert [si.stream_id for si in Chunk(path)] == \
+            [make_si(num * 100 + i).stream_id for i in range(20)]
+
+
+def test_async_chunk_callback(tmpdir, pool):
+    path = os.path.join(str(tmpdir), 'test.sc')
+    with Chunk(path, mode='wb') as ch:
+        ch.add(make_si(1))
+    done = threading.Event()
+    batches = []
+    def on_done(future):
+        batches.append(future.result())
+        done.set()
+    AsyncChunk(path, pool=pool).read_batch().add_done_callback(on_done)
+    assert done.wait(10)
+    assert [si.stream_id for si in batches[0]] == [make_si(1).stream_id]
+
+
+def test_async_chunk_errors(tmpdir, pool):
+    ch = AsyncChunk(os.path.join(str(tmpdir), 'missing.sc'), pool=pool)
+    assert isinstance(ch.read_batch().exception(), IOError)
+    with pytest.raises(IOError):
+        ch.close().result()
+
+
+def test_async_chunk_max_pending_writes(tmpdir, pool):
+    path = os.path.join(str(tmpdir), 'test.sc')
+    ch = AsyncChunk(path, mode='wb', pool=pool, batch_size=2,
+                    max_pending_writes=2)
+    ch.flush().result()
+    ## hold up the pool in the first write
+    go = threading.Event()
+    add_many = ch.chunk.add_many
+    def slow_add_many(msgs):
+        go.wait(10)
+        add_many(msgs)
+    ch.chunk.add_many = slow_add_many
+    futures = [ch.add(make_si(i)) for i in range(10)]
+    ## the pool may start the first write before the second add, so
+    ## count batches by their futures
+    assert ch._writes == 2
+    assert len(ch._held) == len(set(futures)) - 2 >= 3
+    assert not any(future.done() for future in futures)
+    closed = ch.close()
+    assert len(ch._held) == len(set(futures)) - 1
+    go.set()
+    closed.result()
+    assert all(future.done() for future in futures)
+    assert [si.stream_id for si in Chunk(path)] == \
+        [make_si(i).stream_id for i in range(10)]
@@ -0,0 +1,141 @@
+'''Tests for BlockChunk
+
+.. This software is released under an MIT/X11 open source license.
+   Copyright 2012-2015 Diffeo, Inc.
+'''
+from __future__ import absolute_import
+import hashlib
+import os
+
+import pytest
+
+from streamcorpus import Chunk, BlockChunk, serialize
+from streamcorpus._block_chunk import block_codecs
+from streamcorpus._test_util import make_si
+
+
+@pytest.fixture(params=sorted(block_codecs))
+def codec(request):
+    return request.param
+
+
+@pytest.fixture
+def path(tmpdir):
+    return os.path.join(str(tmpdir), 'test.scb')
+
+
+def write_chunk(path, num=25, **kwargs):
+    sis = [make_si(i, grow=True) for i in range(num)]
+    kwargs.setdefault('block_items', 10)
+    with Chunk(path, mode='wb', **kwargs) as ch:
+        for si in sis:
+            ch.add(si)
+    return sis, ch
+
+
+def test_chunk_opens_block_chunk(path, codec):
+    sis, o_chunk = write_chunk(path, codec=codec)
+    assert isinstance(o_chunk, BlockChunk)
+    ch = Chunk(path)
+    assert isinstance(ch, BlockChunk)
+    assert list(ch) == sis
+    assert len(ch) == 25
+
+
+def test_blocks(path, codec):
+    sis, o_chunk = write_chunk(path, codec=codec)
+    ch = Chunk(path)
+    assert [b.count for b in ch.blocks] == [10, 10, 5]
+    assert [b.first_stream_id for b in ch.blocks] == \
+        [sis[0].stream_id, sis[10].stream_id, sis[20].stream_id]
+    for i, block in enumerate(ch.blocks):
+        data = ''.join(map(serialize, sis[i * 10:(i + 1) * 10]))
+        assert ch.block_md5s[i] == hashlib.md5(data).hexdigest()
+    assert list(ch.iter_blocks(1, 2)) == sis[10:20]
+
+
+def test_block_bytes(path):
+    sis, o_chunk = write_chunk(path, block_items=1000, block_bytes=200)
+    ch = Chunk(path)
+    assert len(ch.blocks) > 1
+    assert all(b.raw_length <= 200 or b.count == 1 for b in ch.blocks)
+    assert list(ch) == sis
+
+
+def test_md5_matches_plain_chunk(path, tmpdir):
+    sis, o_chunk = write_chunk(path)
+    sc_path = os.path.join(str(tmpdir), 'test.sc')
+    with Chunk(sc_path, mode='wb') as sc_chunk:
+        for si in sis:
+            sc_chunk.add(si)
+    assert o_chunk.md5_hexdigest == sc_chunk.md5_hexdigest
+    ch = Chunk(path)
+    list(ch)
+    assert ch.md5_hexdigest == sc_chunk.md5_hexdigest
+
+
+def test_corrupt_block(path):
+    write_chunk(path, codec='')
+    data = open(path, 'rb').read()
+    ## flip a byte in the body.raw of the first message
+    pos = data.index('hello 0!')
+    with open(path, 'wb') as fh:
+        fh.write(data[:pos] + 'j' + data[pos + 1:])
+    with pytest.raises(IOError):
+        list(Chunk(path))
+
+
+def test_not_closed(path):
+    ch = Chunk(path, mode='wb')
+    ch.add(make_si(0, grow=True))
+    ch.flush()
+    with pytest.raises(IOError):
+        Chunk(path)
+
+
+def test_index(path, codec):
+    sis, o_chunk = write_chunk(path, codec=codec, index=True)
+    ch = Chunk(path)
+    assert len(ch.index) == 25
+    assert ch.get(sis[17].stream_id) == sis[17]
+    ch.seek_to(13)
+    assert list(ch) == sis[13:]
+
+
+def test_append(path):
+    sis, o_chunk = write_chunk(path, num=15, index=True)
+    more = [make_si(i, grow=True) for i in range(15, 20)]
+    with Chunk(path, mode='ab', block_items=10, index=True) as ch:
+        for si in more:
+            ch.add(si)
+    assert len(ch) == 5
+    ch = Chunk(path)
+    assert [b.count for b in ch.blocks] == [10, 5, 5]
+    assert list(ch) == sis + more
+    assert ch.get(more[2].stream_id) == more[2]
+
+
+def test_digest(path):
+    sis, o_chunk = write_chunk(path, inline_md5='blake2b')
+    assert o_chunk.md5_hexdigest is None
+    ch = Chunk(path, inline_md5='blake2b')
+    list(ch)
+    assert ch.hexdigest == o_chunk.hexdigest
+
+
+def test_bloom_in_footer(path):
+    sis, _ = write_chunk(path, bloom=True)
+    assert not os.path.exists(path + '.bloom')
+    ch = Chunk(path)
+    assert ch.bloom is not None
+    assert all(ch.might_contain(stream_id=si.stream_id) for si in sis)
+    assert not ch.might_contain(stream_id='1-0000')
+    assert list(ch) == sis
+
+    more = [make_si(i, grow=True) for i in range(25, 30)]
+    with Chunk(path, mode='ab', bloom=True) as ch:
+        for si in more:
+            ch.add(si)
+    ch = Chunk(path)
+    assert all(ch.might_contain(stream_id=si.stream_id) for si in sis + more)
+    assert list(ch) == sis + more
@@ -0,0 +1,84 @@
+'''Tests for BloomFilter
+
+.. This software is released under an MIT/X11 open source license.
+   Copyright 2012-2015 Diffeo, Inc.
+'''
+from __future__ import absolute_import
+
+import os
+
+import pytest
+
+from streamcorpus import BloomFilter, Chunk, make_stream_item, serialize
+from streamcorpus._bloom import bloom_path_for
+
+
+def test_bloom_filter():
+    bloom = BloomFilter(1000, error_rate=0.01)
+    assert bloom.num_hashes == 7
+    keys = ['key-%d' % i for i in range(1000)]
+    assert all(bloom.add(key) for key in keys[:500])
+    assert not bloom.add(keys[0])
+    assert all(key in bloom for key in keys[:500])
+    false_positives = sum(key in bloom for key in keys[500:])
+    ## about 0.1%, at half capacity
+    assert false_positives < 10
+    assert len(bloom) == 500
+    assert u'caf\xe9' not in bloom
+
+
+def test_bloom_filter_string():
+    bloom = BloomFilter(100)
+    for i in range(50):
+        bloom.add(str(i))
+    data = bloom.to_string()
+    copy = BloomFilter.from_string(data)
+    assert all(str(i) in copy for i in range(50))
+    assert (copy.num_bits, copy.num_hashes, len(copy)) == \
+        (bloom.num_bits, bloom.num_hashes, 50)
+    with pytest.raises(ValueError):
+        BloomFilter.from_string(data[:-1])
+
+
+def test_chunk_bloom_sidecar(tmpdir):
+    path = os.path.join(str(tmpdir), 'test.sc.xz')
+    sis = [make_stream_item(i, 'http://example.com/%d' % i) for i in range(20)]
+    with Chunk(path, mode='wb', bloom=True) as ch:
+        for si in sis[:10]:
+            ch.add(si)
+        ch.add_raw(serialize(sis[10]))
+    assert os.path.exists(bloom_path_for(path))
+
+    ch = Chunk(path)
+    assert all(ch.might_contain(stream_id=si.stream_id) for si in sis[:11])
+    assert ch.might_contain(doc_id=sis[3].doc_id)
+    assert sum(ch.might_contain(stream_id=si.stream_id) for si in sis[11:]) < 2
+
+    ## appending keeps the ids already in the chunk
+    with Chunk(path, mode='ab', bloom=True) as ch:
+        for si in sis[11:]:
+            ch.add(si)
+    ch = Chunk(path)
+    assert all(ch.might_contain(stream_id=si.stream_id) for si in sis)
+    assert list(ch) == sis
+
+
+def test_chunk_bloom_stale_or_missing(tmpdir):
+    path = os.path.join(str(tmpdir), 'test.sc')
+    si = make_stream_item(0, 'http://example.com/0')
+    with Chunk(path, mode='wb') as ch:
+        ch.add(si)
+    assert Chunk(path).bloom is None
+    assert Chunk(path).might_contain(stream_id='nope')
+
+    BloomFilter(1).save(bloom_path_for(path))
+    assert not Chunk(path).might_contain(stream_id=si.stream_id)
+    ## a chunk changed after its sidecar was written ignores it
+    mtime = os.path.getmtime(bloom_path_for(path))
+    os.utime(path, (mtime + 10, mtime + 10))
+    assert Chunk(path).might_contain(stream_id=si.stream_id)
+
+
+def test_chunk_bloom_requires_path():
+    with pytest.raises(ValueError):
+        Chunk(mode='wb', bloom=True)
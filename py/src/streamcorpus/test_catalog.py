@@ -0,0 +1,91 @@
+'''Tests for streamcorpus.catalog
+
+.. This software is released under an MIT/X11 open source license.
+   Copyright 2012-2015 Diffeo, Inc.
+'''
+from __future__ import absolute_import
+import os
+
+import pytest
+
+from streamcorpus import Chunk
+from streamcorpus.catalog import Catalog, hour_range
+from streamcorpus._test_util import make_si, write_chunk
+
+
+@pytest.fixture
+def paths(tmpdir):
+    ## one hour per chunk
+    return [write_chunk(str(tmpdir.join('%d.sc.xz' % hour)),
+                        [make_si(hour * 3600 + i * 60, source=['news', 'blog'][hour])
+                         for i in range(10)])
+            for hour in range(2)]
+
+
+@pytest.mark.parametrize('workers', [1, 2])
+def test_catalog(tmpdir, paths, workers):
+    catalog = Catalog(str(tmpdir.join('catalog.db')))
+    assert catalog.update(paths, workers=workers) == 2
+    assert len(catalog) == 2
+
+    info = catalog.get(paths[1])
+    assert info['count'] == 10
+    chunk = Chunk(path=paths[1])
+    list(chunk)
+    assert info['md5'] == chunk.md5_hexdigest
+    assert (info['min_epoch'], info['max_epoch']) == (3600, 3600 + 540)
+    assert info['sources'] == ['blog']
+
+    si = make_si(3600 + 120)
+    assert catalog.find(stream_id=si.stream_id) == [paths[1]]
+    assert catalog.find(abs_url=si.abs_url) == [paths[1]]
+    assert catalog.find(stream_id=make_si(99999).stream_id) == []
+    assert catalog.covering('1970-01-01-00') == [paths[0]]
+    assert catalog.covering('1970-01-01-02') == []
+    assert catalog.with_source('news') == [paths[0]]
+    catalog.close()
+
+
+def test_catalog_incremental(tmpdir, paths):
+    db = str(tmpdir.join('catalog.db'))
+    with Catalog(db) as catalog:
+        assert catalog.update(paths[:1]) == 1
+    with Catalog(db) as catalog:
+        assert catalog.update(paths) == 1
+        assert catalog.update(paths) == 0
+        os.remove(paths[0])
+        write_chunk(paths[0], [make_si(7200, source='forum')])
+        os.utime(paths[0], (0, 12345))
+        assert catalog.update(paths) == 1
+        assert catalog.get(paths[0])['sources'] == ['forum']
+        assert catalog.with_source('news') == []
+        os.remove(paths[1])
+        assert catalog.prune() == [paths[1]]
+        assert len(catalog) == 1
+
+
+def test_catalog_fractional_epoch(tmpdir):
+    ## make_stream_item puts only the whole seconds in the stream_id
+    si = make_si(1000.5)
+    assert si.stream_id.startswith('1000-')
+    path = write_chunk(str(tmpdir.join('frac.sc.xz')), [si])
+    catalog = Catalog(str(tmpdir.join('catalog.db')))
+    catalog.update([path])
+    assert catalog.find(stream_id=si.stream_id) == [os.path.abspath(path)]
+    assert catalog.find(abs_url=si.abs_url) == [os.path.abspath(path)]
+
+
+def test_catalog_stream_id_without_stream_time(tmpdir):
+    si = make_si(1000)
+    ## re-timed, and then without any stream_time
+    si.stream_time = None
+    path = write_chunk(str(tmpdir.join('untimed.sc.xz')), [si])
+    catalog = Catalog(str(tmpdir.join('catalog.db')))
+    catalog.update([path])
+    assert catalog.get(path)['min_epoch'] is None
+    assert catalog.find(stream_id=si.stream_id) == [os.path.abspath(path)]
+    assert catalog.covering('1970-01-01-00') == []
+
+
+def test_hour_range():
+    assert hour_range('1970-01-01-01') == (3600, 7200)
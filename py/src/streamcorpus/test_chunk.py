@@ -17,7 +17,7 @@ ch.setFormatter(formatter)
 logger.addHandler(ch)
 
 ## import from inside the local package, i.e. get these things through __init__.py
-from . import make_stream_item, ContentItem, Chunk, serialize, deserialize, \
+from . import make_stream_item, ContentItem, Chunk, serialize, serialize_many, deserialize, \
     parse_file_extensions, \
     compress_and_encrypt, decrypt_and_uncompress, \
     compress_and_encrypt_path
@@ -339,6 +339,8 @@ def test_parse_file_extensions():
         ('dog', (None, None, None)),
         ('dog.sc', ('sc', None, None)),
         ('dog.xz', (None, 'xz', None)),
+        ('dog.sc.zst.gpg', ('sc', 'zst', 'gpg')),
+        ('dog.sc.lz4', ('sc', 'lz4', None)),
         ]
     for ex in examples:
         assert ex[1] == parse_file_extensions(ex[0])
@@ -351,10 +353,10 @@ def test_fileobj():
         assert si.body.clean_visible
     assert count == 197
 
-@pytest.mark.parametrize('compression', ['xz', 'gz', 'sz', ''])
+@pytest.mark.parametrize('compression', ['xz', 'gz', 'sz', 'zst', 'lz4', ''])
 def test_compression(compression, path):
     ## analog of pytest.skipif for parametrize:
-    if compression and not getattr(_chunk, compression):
+    if compression and not _chunk.codecs[compression].available:
         logger.warn('not able to run test_compression(%r) because %r not available',
                     compression, compression)
         return
@@ -385,10 +387,10 @@ def test_compression(compression, path):
     assert not errors
     assert rdata2 == rdata
 
-@pytest.mark.parametrize('compression', ['xz', 'gz', 'sz', ''])
+@pytest.mark.parametrize('compression', ['xz', 'gz', 'sz', 'zst', 'lz4', ''])
 def test_detect_compression(compression, path):
     ## analog of pytest.skipif for parametrize:
-    if compression and not getattr(_chunk, compression):
+    if compression and not _chunk.codecs[compression].available:
         logger.warn('not able to run test_compression(%r) because %r not available',
                     compression, compression)
         return
@@ -418,3 +420,78 @@ def test_detect_compression(compression, path):
     errors, rdata2 = decrypt_and_uncompress(cdata, compression='auto')
     assert not errors
     assert rdata2 == rdata
+
+@pytest.mark.parametrize('fields', [None, ['stream_id']])
+def test_mmap(path, fields):
+    sis = [make_stream_item(i, 'http://example.com/%d' % i) for i in range(10)]
+    with Chunk(path=path, mode='wb') as o_chunk:
+        for si in sis:
+            o_chunk.add(si)
+    ch = Chunk(path=path, mode='rb', use_mmap=True, fields=fields)
+    assert isinstance(ch._i_chunk_fh, _chunk.mmap_file)
+    ## lazy md5 is available before reading anything
+    assert ch.md5_hexdigest == o_chunk.md5_hexdigest
+    assert [si.stream_id for si in ch] == [si.stream_id for si in sis]
+    if fields is None:
+        assert list(ch) == sis
+    assert len(list(ch.iter_raw())) == 10
+
+def test_mmap_empty(path):
+    open(path, 'wb').close()
+    ch = Chunk(path=path, mode='rb', use_mmap=True)
+    assert list(ch) == []
+    assert ch.md5_hexdigest == Chunk().md5_hexdigest
+
+@pytest.mark.skipif('not _chunk.xz')
+def test_xz_stream():
+    data = ''.join(str(i) for i in range(100000))
+    ## two concatenated streams, like `cat a.xz b.xz`
+    cdata = _chunk.xz.compress(data[:1000]) + _chunk.xz.compress(data[1000:])
+    fh = _chunk.xz_stream(StringIO(cdata), block_size=100)
+    parts = []
+    while True:
+        part = fh.read(777)
+        if not part:
+            break
+        parts.append(part)
+    assert ''.join(parts) == data
+    assert _chunk.xz_stream(StringIO(cdata)).read() == data
+    with pytest.raises(EOFError):
+        _chunk.xz_stream(StringIO(cdata[:-10])).read()
+
+@pytest.mark.skipif('not _chunk.xz')
+def test_chunk_xz_data():
+    sis = [make_stream_item(i, 'http://example.com/%d' % i) for i in range(10)]
+    cdata = _chunk.xz.compress(''.join(map(serialize, sis)))
+    assert list(Chunk(data=cdata)) == sis
+    ch = Chunk(data=cdata)
+    assert list(ch) == sis
+    ## iterating again rewinds the stream
+    assert list(ch) == sis
+
+def test_serialize_many():
+    sis = [make_stream_item(i, 'http://example.com/%d' % i) for i in range(5)]
+    assert serialize_many(sis) == ''.join(map(serialize, sis))
+    assert list(Chunk(data=serialize_many(sis))) == sis
+
+@pytest.mark.parametrize('ext', ['sc', 'sc.xz', 'scb'])
+def test_add_many(tmpdir, ext, monkeypatch):
+    ## several batches
+    monkeypatch.setattr(_chunk, 'ADD_MANY_BYTES', 1000)
+    sis = [make_stream_item(i, 'http://example.com/%d' % i) for i in range(20)]
+    path = str(tmpdir.join('many.' + ext))
+    with Chunk(path, mode='wb', index=True) as ch:
+        ch.add(sis[0])
+        assert ch.add_many(iter(sis[1:15])) == 14
+        ch.add(sis[15])
+        assert ch.add_many(sis[16:]) == 4
+    assert len(ch) == 20
+    ch2 = Chunk(path)
+    assert list(ch2) == sis
+    assert ch2.md5_hexdigest == ch.md5_hexdigest
+    assert ch2.get(sis[7].stream_id) == sis[7]
+
+def test_add_many_wrong_type():
+    ch = Chunk(message=StreamItem_v0_2_0)
+    with pytest.raises(VersionMismatchError):
+        ch.add_many([make_si()])
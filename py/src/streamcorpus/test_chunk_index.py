@@ -0,0 +1,129 @@
+'''Tests for the chunk index sidecar
+
+.. This software is released under an MIT/X11 open source license.
+   Copyright 2012-2015 Diffeo, Inc.
+'''
+from __future__ import absolute_import
+import os
+from cStringIO import StringIO
+
+import pytest
+
+from streamcorpus import Chunk, ChunkIndex, ChunkRoller
+from streamcorpus import _chunk
+from streamcorpus._chunk_index import index_path_for
+from streamcorpus._test_util import make_si
+
+
+@pytest.fixture(params=['sc', 'sc.xz'])
+def path(request, tmpdir):
+    if request.param.endswith('xz') and not _chunk.xz:
+        pytest.skip('backports.lzma is not installed')
+    return os.path.join(str(tmpdir), 'test.' + request.param)
+
+
+def write_chunk(path, num=10, **kwargs):
+    sis = [make_si(i, grow=True) for i in range(num)]
+    with Chunk(path, mode='wb', index=True, **kwargs) as ch:
+        for si in sis:
+            ch.add(si)
+    return sis
+
+
+def test_index_written(path):
+    sis = write_chunk(path)
+    assert os.path.exists(index_path_for(path))
+    index = Chunk(path).index
+    assert len(index) == 10
+    assert [e.stream_id for e in index] == [si.stream_id for si in sis]
+    assert index[0].offset == 0
+    for prev, entry in zip(index, index[1:]):
+        assert entry.offset == prev.offset + prev.length
+
+
+def test_get(path):
+    sis = write_chunk(path)
+    ch = Chunk(path)
+    assert ch.get(sis[7].stream_id) == sis[7]
+    assert ch.get(doc_id=sis[3].doc_id) == sis[3]
+    assert ch.get(abs_url=sis[5].abs_url) == sis[5]
+    assert ch.get('no-such-stream-id') is None
+
+
+def test_get_without_index(path):
+    sis = [make_si(i, grow=True) for i in range(5)]
+    with Chunk(path, mode='wb') as ch:
+        for si in sis:
+            ch.add(si)
+    ch = Chunk(path)
+    assert ch.index is None
+    assert ch.get(sis[4].stream_id) == sis[4]
+
+
+def test_seek_to(path):
+    sis = write_chunk(path)
+    ch = Chunk(path)
+    ch.seek_to(6)
+    assert list(ch) == sis[6:]
+    ch.seek_to(10)
+    assert list(ch) == []
+    ch.seek_to(0)
+    assert list(ch) == sis
+
+
+def test_seek_to_without_index(path):
+    with Chunk(path, mode='wb') as ch:
+        ch.add(make_si(0, grow=True))
+    with pytest.raises(ValueError):
+        Chunk(path).seek_to(0)
+
+
+def test_append_continues_index(path):
+    sis = write_chunk(path, num=3)
+    more = [make_si(i, grow=True) for i in range(3, 6)]
+    with Chunk(path, mode='ab', index=True) as ch:
+        for si in more:
+            ch.add(si)
+    ch = Chunk(path)
+    assert len(ch.index) == 6
+    assert ch.get(more[1].stream_id) == more[1]
+    assert ch.get(sis[1].stream_id) == sis[1]
+
+
+def test_append_builds_missing_index(path):
+    sis = [make_si(i, grow=True) for i in range(3)]
+    with Chunk(path, mode='wb') as ch:
+        for si in sis:
+            ch.add(si)
+    with Chunk(path, mode='ab', index=True) as ch:
+        ch.add(make_si(3, grow=True))
+    ch = Chunk(path)
+    assert [e.stream_id for e in ch.index] == \
+        [si.stream_id for si in sis] + [make_si(3, grow=True).stream_id]
+    assert ch.get(sis[2].stream_id) == sis[2]
+
+
+def test_index_round_trip():
+    index = ChunkIndex()
+    index.add(0, 10, 'a', 'b', 'http://x\ty\n')
+    index.add(10, 5, 'c', None, None)
+    fh = StringIO()
+    index.dump(fh)
+    index2 = ChunkIndex.load(StringIO(fh.getvalue()))
+    assert index2.entries == index.entries
+    assert index2.find(abs_url='http://x\ty\n') == [0]
+    assert index2.end == 15
+
+
+def test_chunk_roller_index(tmpdir):
+    cr = ChunkRoller(str(tmpdir), chunk_max=4, index=True)
+    for i in range(6):
+        cr.add(make_si(i, grow=True))
+    cr.close()
+    fnames = os.listdir(str(tmpdir))
+    chunks = [f for f in fnames if f.endswith('.xz')]
+    assert len(chunks) == 2
+    for fname in chunks:
+        assert fname + '.idx' in fnames
+        ch = Chunk(os.path.join(str(tmpdir), fname))
+        assert len(ch.index) == int(fname.split('-')[0])
@@ -6,7 +6,10 @@
 
 import os
 
-from streamcorpus import ChunkRoller, make_stream_item
+import pytest
+
+from streamcorpus import Chunk, ChunkRoller, PartitionedChunkWriter, \
+    get_date_hour, make_stream_item
 
 
 def test_chunk_roller(tmpdir):
@@ -27,3 +30,91 @@ def test_chunk_roller(tmpdir):
         files.append(count)
 
     assert sorted(files) == [5, 10, 10]
+
+
+def test_chunk_roller_digest(tmpdir):
+    cr = ChunkRoller(str(tmpdir), chunk_max=10, digest='blake2b')
+    for i in range(15):
+        cr.add(make_stream_item(i, str(i)))
+    cr.close()
+
+    fnames = sorted(os.listdir(str(tmpdir)))
+    assert len(fnames) == 2
+    for fname in fnames:
+        count, digest, hexdigest = fname.split('.')[0].split('-')
+        assert digest == 'blake2b'
+        assert len(hexdigest) == 32
+
+
+@pytest.mark.parametrize('digest', [None, False])
+def test_chunk_roller_no_digest(tmpdir, digest):
+    cr = ChunkRoller(str(tmpdir), chunk_max=1, digest=digest)
+    for i in range(3):
+        cr.add(make_stream_item(i, str(i)))
+    cr.close()
+    fnames = os.listdir(str(tmpdir))
+    assert len(fnames) == 3
+    assert not any('None' in fname for fname in fnames)
+    assert sorted(si.stream_id for fname in fnames
+                  for si in Chunk(os.path.join(str(tmpdir), fname))) == \
+        sorted(make_stream_item(i, str(i)).stream_id for i in range(3))
+
+
+def test_partitioned_chunk_writer_no_digest(tmpdir):
+    with PartitionedChunkWriter(str(tmpdir), key=lambda si: 'all',
+                                chunk_max=1, digest=None) as writer:
+        for i in range(3):
+            writer.add(make_stream_item(i, str(i)))
+    assert len(os.listdir(str(tmpdir.join('all')))) == 3
+
+
+def test_chunk_roller_bloom(tmpdir):
+    cr = ChunkRoller(str(tmpdir), chunk_max=10, bloom=True)
+    sis = [make_stream_item(i, str(i)) for i in range(15)]
+    for si in sis:
+        cr.add(si)
+    cr.close()
+    fnames = sorted(os.listdir(str(tmpdir)))
+    assert len(fnames) == 4
+    assert all(fname.endswith('.sc.xz.bloom') for fname in fnames[1::2])
+    stream_ids = set()
+    for fname in fnames[::2]:
+        ch = Chunk(os.path.join(str(tmpdir), fname))
+        assert all(ch.might_contain(stream_id=si.stream_id) for si in ch)
+        stream_ids.update(si.stream_id for si in ch)
+    assert stream_ids == set(si.stream_id for si in sis)
+
+
+def test_partitioned_chunk_writer(tmpdir):
+    ## three hours, interleaved
+    hours = [0, 1, 2] * 7
+    with PartitionedChunkWriter(str(tmpdir), chunk_max=5, max_open=2) as writer:
+        for i, hour in enumerate(hours):
+            writer.add(make_stream_item(hour * 3600 + i, str(i)))
+    ## every add after the first two partitions evicts one
+    assert writer.evictions == len(hours) - 2
+
+    assert sorted(os.listdir(str(tmpdir))) == \
+        ['1970-01-01-00', '1970-01-01-01', '1970-01-01-02']
+    for date_hour in os.listdir(str(tmpdir)):
+        counts = 0
+        for fname in os.listdir(str(tmpdir.join(date_hour))):
+            assert 'tmp' not in fname
+            path = str(tmpdir.join(date_hour, fname))
+            sis = list(Chunk(path))
+            assert int(fname.split('-')[0]) == len(sis)
+            assert all(get_date_hour(si) == date_hour for si in sis)
+            counts += len(sis)
+        assert counts == 7
+
+
+def test_partitioned_chunk_writer_key(tmpdir):
+    writer = PartitionedChunkWriter(str(tmpdir), chunk_max=2,
+                                    key=lambda si: si.abs_url[0])
+    for url in ['a1', 'b1', 'a2', 'a3']:
+        writer.add(make_stream_item(0, url))
+    writer.close()
+    assert writer.evictions == 0
+    assert sorted(int(fname.split('-')[0])
+                  for fname in os.listdir(str(tmpdir.join('a')))) == [1, 2]
+    assert len(os.listdir(str(tmpdir.join('b')))) == 1
@@ -0,0 +1,156 @@
+'''Tests for the compression codec registry
+
+.. This software is released under an MIT/X11 open source license.
+   Copyright 2012-2015 Diffeo, Inc.
+'''
+from __future__ import absolute_import
+import os
+from cStringIO import StringIO
+
+import pytest
+
+from streamcorpus import Chunk, ContentItem, ZstdCodec, make_stream_item, \
+    serialize, deserialize, compress_and_encrypt, decrypt_and_uncompress, \
+    train_dictionary, load_dictionary
+from streamcorpus import _codecs, zstd_dictionary
+from streamcorpus._codecs import codecs, codec_for_path, codec_stream, \
+    detect_codec, get_codec
+
+DATA = ''.join(str(i) for i in range(100000))
+
+
+@pytest.fixture(params=sorted(codecs))
+def codec(request):
+    codec = codecs[request.param]
+    if not codec.available:
+        pytest.skip('%s is not available' % codec.name)
+    return codec
+
+
+def test_round_trip(codec):
+    cdata = codec.compress(DATA)
+    assert len(cdata) < len(DATA)
+    assert cdata.startswith(codec.magic)
+    assert detect_codec(cdata) is codec
+    assert codec.decompress(cdata) == DATA
+    ## concatenated streams, as written by appending
+    assert codec.decompress(cdata + codec.compress('more')) == DATA + 'more'
+
+
+def test_command_round_trip(codec):
+    if not codec.has_command:
+        pytest.skip('%s has no command line tool here' % codec.name)
+    cdata = codec._run(codec.compress_command(), DATA)
+    assert codec.decompress(cdata) == DATA
+    assert codec._run(codec.decompress_command(), codec.compress(DATA)) == DATA
+
+
+def test_incremental(codec):
+    if codec.library is None:
+        pytest.skip('%s library is not installed' % codec.name)
+    compress = codec.compressor()
+    cdata = ''.join(compress(DATA[i:i + 1000]) for i in range(0, len(DATA), 1000))
+    cdata += compress(None)
+    fh = codec_stream(StringIO(cdata), codec, block_size=100)
+    assert fh.read(10) == DATA[:10]
+    fh.seek(5)
+    assert fh.read() == DATA[5:]
+
+
+@pytest.mark.parametrize('name', ['xz', 'zst', 'lz4'])
+def test_truncated(name):
+    codec = codecs[name]
+    if codec.library is None:
+        pytest.skip('%s library is not installed' % name)
+    with pytest.raises(EOFError):
+        codec_stream(StringIO(codec.compress(DATA)[:-10]), codec).read()
+
+
+@pytest.mark.parametrize('name,levels', [('xz', (0, 9)), ('gz', (1, 9)),
+                                         ('zst', (1, 19)), ('lz4', (0, 16))])
+def test_levels(name, levels):
+    codec = codecs[name]
+    if codec.library is None:
+        pytest.skip('%s library is not installed' % name)
+    low, high = [codec.compress(DATA, level) for level in levels]
+    ## the level reaches the compressor
+    assert low != high
+    assert codec.decompress(low) == codec.decompress(high) == DATA
+
+
+def test_lookup():
+    assert codec_for_path('foo.sc.zst') is codecs['zst']
+    assert codec_for_path('foo.sc') is None
+    assert get_codec('') is None
+    with pytest.raises(ValueError):
+        get_codec('bz2')
+    assert detect_codec(DATA) is None
+
+
+@pytest.mark.parametrize('background', [None, 'thread', 'process'])
+def test_chunk_path(codec, tmpdir, background):
+    if background == 'process' and not codec.has_command:
+        pytest.skip('%s has no command line tool here' % codec.name)
+    sis = [make_stream_item(i, 'url%d' % i) for i in range(100)]
+    path = str(tmpdir.join('foo.sc.' + codec.name))
+    with Chunk(path=path, mode='wb', compression_level=1,
+               background_compression=background) as chunk:
+        chunk.add_many(sis[:50])
+    with Chunk(path=path, mode='ab') as chunk:
+        chunk.add_many(sis[50:])
+    assert detect_codec(open(path).read()) is codec
+    assert list(Chunk(path=path)) == sis
+    assert list(Chunk(data=open(path).read())) == sis
+
+
+def make_items(count):
+    sis = []
+    for i in range(count):
+        si = make_stream_item(i, 'http://example.com/%d' % i)
+        si.body = ContentItem(raw='<html>item %d</html>' % i,
+                              clean_visible='item %d' % i)
+        si.source = 'news'
+        sis.append(si)
+    return sis
+
+
+@pytest.fixture
+def dictionary():
+    if _codecs.zstandard is None:
+        pytest.skip('zstandard is not installed')
+    return train_dictionary(map(serialize, make_items(1000)), size=8192)
+
+
+def test_dictionary_serialize(dictionary):
+    codec = ZstdCodec(dictionary)
+    si = make_items(1001)[-1]
+    blob = serialize(si, compression=codec)
+    assert len(blob) < len(serialize(si, compression='zst')) / 2
+    assert deserialize(blob) == si
+
+    errors, data = compress_and_encrypt(serialize(si), compression=codec)
+    assert not errors
+    assert decrypt_and_uncompress(data) == ([], serialize(si))
+
+
+def test_dictionary_unknown(dictionary):
+    blob = serialize(make_items(1)[0], compression=ZstdCodec(dictionary))
+    del _codecs.zstd_dictionaries[dictionary.dict_id()]
+    with pytest.raises(IOError):
+        codecs['zst'].decompress(blob)
+
+
+def test_zstd_dictionary_main(dictionary, tmpdir, monkeypatch):
+    chunk_path = str(tmpdir.join('sample.sc'))
+    with Chunk(path=chunk_path, mode='wb') as chunk:
+        chunk.add_many(make_items(1000))
+    dict_path = str(tmpdir.join('news.dict'))
+    monkeypatch.setattr('sys.argv', ['streamcorpus_zstd_dictionary', '--size',
+                                     '8192', '--output', dict_path, chunk_path])
+    zstd_dictionary.main()
+
+    _codecs.zstd_dictionaries.clear()
+    trained = load_dictionary(dict_path)
+    assert trained.dict_id() in _codecs.zstd_dictionaries
+    blob = serialize(make_items(1)[0], compression=ZstdCodec(trained))
+    assert deserialize(blob) == make_items(1)[0]
@@ -0,0 +1,61 @@
+'''Tests for streamcorpus.columns
+
+.. This software is released under an MIT/X11 open source license.
+   Copyright 2012-2015 Diffeo, Inc.
+'''
+from __future__ import absolute_import
+
+import pytest
+
+from streamcorpus import ContentItem, Language, Rating, Annotator, Target
+from streamcorpus import columns
+from streamcorpus.columns import export_columns, extract_columns, read_columns
+from streamcorpus._test_util import make_si, write_chunk
+
+
+def make_rated_si(i):
+    si = make_si(i * 3600, url='http://example.com/%d' % i,
+                 source=['news', 'blog'][i % 2])
+    if i % 3:
+        si.body = ContentItem(raw='x' * i, media_type='text/html',
+                              language=Language(code='en'))
+    else:
+        si.body = None
+    si.ratings = {'annotator': [Rating(annotator=Annotator(annotator_id='annotator'),
+                                       target=Target(target_id='t'))] * (i % 4)}
+    return si
+
+
+@pytest.fixture
+def paths(tmpdir):
+    return [write_chunk(str(tmpdir.join('%d.sc.xz' % num)),
+                        [make_rated_si(i) for i in range(num * 5, num * 5 + 5)])
+            for num in range(3)]
+
+
+def test_extract_columns(paths):
+    cols = extract_columns(paths[0])
+    assert cols['source'] == ['news', 'blog'] * 2 + ['news']
+    assert cols['epoch_ticks'] == [i * 3600 for i in range(5)]
+    assert cols['raw_length'] == [0, 1, 2, 0, 4]
+    assert cols['media_type'] == ['', 'text/html', 'text/html', '', 'text/html']
+    assert cols['language'] == ['', 'en', 'en', '', 'en']
+    assert cols['num_ratings'] == [0, 1, 2, 3, 0]
+    assert cols['clean_visible_length'] == [0] * 5
+
+
+@pytest.mark.skipif('columns.np is None')
+@pytest.mark.parametrize('ext,workers', [('npz', 1), ('npz', 2), ('parquet', 1)])
+def test_export_columns(tmpdir, paths, ext, workers):
+    if ext == 'parquet' and columns.pyarrow is None:
+        pytest.skip('pyarrow is not installed')
+    out = str(tmpdir.join('out.' + ext))
+    assert export_columns(paths, out, workers=workers) == 15
+    cols = read_columns(out)
+    sis = [make_rated_si(i) for i in range(15)]
+    assert list(cols['stream_id']) == [si.stream_id for si in sis]
+    assert list(cols['path']) == [path for path in paths for _ in range(5)]
+    assert list(cols['epoch_ticks']) == [i * 3600.0 for i in range(15)]
+    assert cols['num_ratings'].sum() == sum(i % 4 for i in range(15))
+    assert (cols['source'] == 'news').sum() == 8
+    assert set(read_columns(out, columns=['source'])) == set(['source'])
@@ -0,0 +1,79 @@
+'''Tests for streamcorpus.dedup
+
+.. This software is released under an MIT/X11 open source license.
+   Copyright 2012-2015 Diffeo, Inc.
+'''
+from __future__ import absolute_import
+
+import pytest
+
+from streamcorpus import BloomFilter, Chunk
+from streamcorpus.dedup import SqliteKeys, dedup, dedup_paths
+from streamcorpus._test_util import make_si, write_chunk
+
+
+@pytest.fixture
+def paths(tmpdir):
+    chunks = [
+        [make_si(10, url='a', raw='A'), make_si(20, url='b', raw='B'), make_si(30, url='c', raw='A')],
+        [make_si(40, url='a', raw='A2'), make_si(5, url='b', raw='B'), make_si(50, url='d', raw='D')],
+    ]
+    return [write_chunk(str(tmpdir.join('%d.sc.xz' % num)), sis)
+            for num, sis in enumerate(chunks)]
+
+
+def summarize(blobs):
+    return [(si.abs_url, si.stream_time.epoch_ticks)
+            for si in Chunk(data=''.join(blobs))]
+
+
+def test_dedup():
+    sis = [make_si(1, url='a', raw='x'), make_si(2, url='a', raw='y'), make_si(3, url='b', raw='x')]
+    assert list(dedup(sis)) == [sis[0], sis[2]]
+    assert list(dedup(sis, key='content')) == [sis[0], sis[1]]
+    assert list(dedup(sis, key=lambda si: None)) == sis
+    with pytest.raises(ValueError):
+        list(dedup(sis, key='url'))
+
+
+@pytest.mark.parametrize('seen', [None, 'bloom', 'sqlite'])
+def test_dedup_paths_first(paths, seen):
+    if seen == 'bloom':
+        seen = BloomFilter(100)
+    elif seen == 'sqlite':
+        seen = SqliteKeys()
+    assert summarize(dedup_paths(paths, seen=seen)) == \
+        [('a', 10), ('b', 20), ('c', 30), ('d', 50)]
+
+
+def test_dedup_paths_content(paths):
+    assert summarize(dedup_paths(paths, key='content')) == \
+        [('a', 10), ('b', 20), ('a', 40), ('d', 50)]
+
+
+@pytest.mark.parametrize('seen', [None, 'sqlite'])
+def test_dedup_paths_latest(paths, tmpdir, seen):
+    if seen == 'sqlite':
+        seen = SqliteKeys(str(tmpdir.join('keys.db')))
+    assert summarize(dedup_paths(paths, policy='latest', seen=seen)) == \
+        [('b', 20), ('c', 30), ('a', 40), ('d', 50)]
+
+
+def test_dedup_paths_errors(paths):
+    with pytest.raises(ValueError):
+        list(dedup_paths(paths, policy='last'))
+    with pytest.raises(ValueError):
+        list(dedup_paths(paths, policy='latest', seen=BloomFilter(100)))
+
+
+@pytest.mark.parametrize('commit_every', [1, 10000])
+def test_sqlite_keys_persist(tmpdir, commit_every):
+    path = str(tmpdir.join('keys.db'))
+    seen = SqliteKeys(path, commit_every=commit_every)
+    assert seen.add('a') and seen.add('b')
+    seen.close()
+    ## a later run over a named database skips the keys seen before
+    seen = SqliteKeys(path)
+    assert not seen.add('a')
+    assert seen.add('c')
+    seen.close()
@@ -0,0 +1,159 @@
+'''Tests for GpgContext
+
+.. This software is released under an MIT/X11 open source license.
+   Copyright 2012-2015 Diffeo, Inc.
+'''
+from __future__ import absolute_import
+import hashlib
+import os
+import shutil
+import subprocess
+import tempfile
+
+import pytest
+
+from streamcorpus import Chunk, GpgContext, ContentItem, make_stream_item, \
+    serialize, compress_and_encrypt, decrypt_and_uncompress, \
+    compress_and_encrypt_path
+from streamcorpus import _chunk
+
+try:
+    subprocess.check_output(['gpg', '--version'])
+    have_gpg = True
+except OSError:
+    have_gpg = False
+
+pytestmark = pytest.mark.skipif('not have_gpg')
+
+
+@pytest.fixture(scope='module')
+def keys(request):
+    '''make a throwaway key pair without a passphrase, and return the
+    paths to its exported public and private keys
+    '''
+    homedir = tempfile.mkdtemp()
+    request.addfinalizer(lambda: shutil.rmtree(homedir, ignore_errors=True))
+    gpg = ['gpg', '--batch', '--quiet', '--homedir', homedir]
+    subprocess.check_call(gpg + [
+        '--passphrase', '', '--quick-gen-key',
+        'streamcorpus test <trec-kba@example.com>',
+        'future-default', 'default', 'never'])
+    public = os.path.join(homedir, 'public.gpg')
+    private = os.path.join(homedir, 'private.gpg')
+    subprocess.check_call(gpg + ['--export', '-o', public])
+    subprocess.check_call(gpg + ['--pinentry-mode', 'loopback', '--passphrase', '',
+                                 '--export-secret-keys', '-o', private])
+    subprocess.call(['gpgconf', '--homedir', homedir, '--kill', 'gpg-agent'])
+    return public, private
+
+
+@pytest.fixture
+def gpg(request, keys):
+    ctx = GpgContext(gpg_public=keys[0], gpg_private=keys[1])
+    request.addfinalizer(ctx.close)
+    return ctx
+
+
+def test_round_trip(gpg):
+    data = 'hello ' * 10000
+    errors, cdata = gpg.encrypt(data)
+    assert not errors
+    assert cdata and 'hello' not in cdata
+    for _ in range(3):
+        ## the same context is reused without importing again
+        errors, rdata = gpg.decrypt(cdata)
+        assert not errors
+        assert rdata == data
+
+
+def test_close(keys):
+    with GpgContext(gpg_public=keys[0]) as gpg:
+        homedir = gpg.homedir
+        assert os.path.exists(homedir)
+    assert not os.path.exists(homedir)
+
+
+def test_decrypt_failure(gpg):
+    errors, data = gpg.decrypt('not encrypted at all')
+    assert errors
+    assert data is None
+
+
+def test_bytes_apis(gpg, keys):
+    data = ''.join(serialize(make_stream_item(i, 'http://example.com/%d' % i))
+                   for i in range(10))
+    errors, cdata = compress_and_encrypt(data, gpg=gpg)
+    assert not errors
+    errors, rdata = decrypt_and_uncompress(cdata, gpg=gpg)
+    assert not errors
+    assert rdata == data
+
+    ## the one-off path, which imports the key for each call
+    errors, cdata = compress_and_encrypt(data, gpg_public=keys[0])
+    errors, rdata = decrypt_and_uncompress(cdata, gpg_private=keys[1])
+    assert rdata == data
+
+
+@pytest.mark.skipif('not _chunk.xz')
+def test_chunk_path(gpg, tmpdir):
+    sis = [make_stream_item(i, 'http://example.com/%d' % i) for i in range(10)]
+    path = str(tmpdir.join('test.sc'))
+    with Chunk(path, mode='wb') as ch:
+        for si in sis:
+            ch.add(si)
+    errors, o_path = compress_and_encrypt_path(path, gpg=gpg, tmp_dir=str(tmpdir))
+    assert not errors
+    os.rename(o_path, path + '.xz.gpg')
+    ch = Chunk(path + '.xz.gpg', gpg=gpg)
+    assert list(ch) == sis
+    assert [stage['name'] for stage in ch.pipeline.stats()] == \
+        ['read', 'decrypt', 'decompress']
+    assert ch.md5_hexdigest == hashlib.md5(open(path, 'rb').read()).hexdigest()
+
+
+def test_chunk_path_wrong_key(keys, tmpdir):
+    path = str(tmpdir.join('test.sc'))
+    with Chunk(path, mode='wb') as ch:
+        ch.add(make_stream_item(0, 'http://example.com/0'))
+    with GpgContext(gpg_public=keys[0]) as gpg:
+        errors, o_path = compress_and_encrypt_path(path, gpg=gpg, tmp_dir=str(tmpdir))
+        os.rename(o_path, path + '.xz.gpg')
+        ## no private key in this context
+        with pytest.raises(IOError):
+            list(Chunk(path + '.xz.gpg', gpg=gpg))
+
+
+def test_one_off_bad_key(tmpdir):
+    bad = str(tmpdir.join('no-such-key.gpg'))
+    errors, data = decrypt_and_uncompress('not encrypted', gpg_private=bad)
+    assert data is None
+    assert errors[-1] == 'gpg -> no data'
+    errors, data = compress_and_encrypt('hello', gpg_public=bad)
+    assert data is None
+    assert errors
+    with pytest.raises(RuntimeError):
+        GpgContext(gpg_private=bad)
+
+
+@pytest.mark.skipif('not _chunk.xz')
+def test_chunk_path_close_early(gpg, tmpdir):
+    path = str(tmpdir.join('test.sc'))
+    with Chunk(path, mode='wb') as ch:
+        for i in range(200):
+            si = make_stream_item(i, 'http://example.com/%d' % i)
+            si.body = ContentItem(raw=os.urandom(50000))
+            ch.add(si)
+    errors, o_path = compress_and_encrypt_path(path, gpg=gpg, tmp_dir=str(tmpdir))
+    os.rename(o_path, path + '.xz.gpg')
+    ch = Chunk(path + '.xz.gpg', gpg=gpg)
+    pipeline = ch.pipeline
+    si = next(iter(ch))
+    assert si.stream_id == make_stream_item(0, 'http://example.com/0').stream_id
+    ch.close()
+    assert ch.pipeline is None
+    ## the gpg child is reaped and the stage threads are gone
+    decrypt = pipeline.stages[1]
+    assert decrypt.returncode is not None
+    with pytest.raises(OSError):
+        os.kill(decrypt._child.pid, 0)
+    assert not any(thread.is_alive() for thread in pipeline._threads)
@@ -0,0 +1,69 @@
+'''Tests for interning repeated strings while decoding
+
+.. This software is released under an MIT/X11 open source license.
+   Copyright 2012-2015 Diffeo, Inc.
+'''
+from __future__ import absolute_import
+import os
+
+from streamcorpus import Chunk, StreamItem_v0_2_0, InternTable, \
+    intern_strings, make_stream_item, serialize, ContentItem, Sentence, \
+    Token, Label, Annotator
+from streamcorpus._chunk import decrypt_and_uncompress
+from streamcorpus._intern import string_bytes
+
+TEST_XZ_PATH = os.path.join(os.path.dirname(__file__), '../../../test-data/john-smith-tagged-by-lingpipe-0-v0_2_0.sc.xz')
+
+
+def test_intern_table():
+    table = InternTable(max_size=4)
+    a = ''.join(['a', 'b'])
+    assert table(a) is a
+    assert table(''.join(['a', 'b'])) is a
+    assert (table.hits, table.misses) == (1, 1)
+    for s in 'wxyz':
+        table(s * 2)
+    ## bounded, with 'ab' evicted
+    assert len(table) <= 4
+    assert table(''.join(['a', 'b'])) is not a
+
+
+def test_intern_strings():
+    def make_si():
+        si = make_stream_item(10, 'http://example.com')
+        tokens = [Token(token=''.join(['th', 'e']), pos=''.join(['D', 'T']),
+                        labels={'x': [Label(annotator=Annotator(annotator_id=''.join(['a', 'b'])))]})
+                  for _ in range(3)]
+        si.body = ContentItem(sentences={'tagger': [Sentence(tokens=tokens)]})
+        return si
+    si = make_si()
+    intern_strings(si, InternTable())
+    tokens = si.body.sentences['tagger'][0].tokens
+    assert len(set(id(tok.token) for tok in tokens)) == 1
+    assert len(set(id(tok.pos) for tok in tokens)) == 1
+    assert len(set(id(tok.labels['x'][0].annotator.annotator_id) for tok in tokens)) == 1
+    assert si == make_si()
+
+
+def test_chunk_intern():
+    errors, data = decrypt_and_uncompress(open(TEST_XZ_PATH).read())
+    full = list(Chunk(data=data, message=StreamItem_v0_2_0))
+    table = InternTable()
+    interned = list(Chunk(data=data, message=StreamItem_v0_2_0, intern=table))
+    assert interned == full
+    assert table.hits > 10 * table.misses
+    ## 24MB of strings in tokens and labels down to under 1MB
+    assert string_bytes(interned) * 10 < string_bytes(full)
+
+
+def test_chunk_intern_shared_table():
+    si = make_stream_item(10, 'http://example.com')
+    si.body = ContentItem(sentences={'tagger': [Sentence(tokens=[Token(token='hello', pos='UH')])]})
+    data = serialize(si)
+    table = InternTable()
+    si1, = Chunk(data=data, intern=table)
+    si2, = Chunk(data=data, intern=table)
+    assert si1.body.sentences['tagger'][0].tokens[0].pos is \
+        si2.body.sentences['tagger'][0].tokens[0].pos
+    si3, = Chunk(data=data, intern=True)
+    assert si3 == si1
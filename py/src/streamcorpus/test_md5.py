@@ -2,8 +2,9 @@
 import uuid
 from . import make_stream_item, ContentItem, Chunk
 from cStringIO import StringIO
-from _chunk import md5_file
+from _chunk import md5_file, digests, new_digest
 import hashlib
+import pytest
 
 def test_md5():
     _data = 'foo' * 100
@@ -39,3 +40,46 @@ def test_md5_through_chunk():
     data = open(path).read()
 
     assert ch.md5_hexdigest == hashlib.md5(data).hexdigest()
+
+@pytest.fixture(params=sorted(name for name in digests if digests[name]))
+def digest(request):
+    return request.param
+
+def test_digests(digest, tmpdir):
+    si = make_stream_item('2012-08-08T08:24:23.0Z', 'hi')
+    si.body = ContentItem(raw = 'foo' * 100)
+
+    path = str(tmpdir.join('foo.sc'))
+    ch = Chunk(path=path, mode='wb', inline_md5=digest)
+    ch.add(si)
+    ch.close()
+
+    expected = new_digest(digest)
+    expected.update(open(path).read())
+    assert ch.hexdigest == expected.hexdigest()
+    assert ch.digest_name == digest
+    if digest != 'md5':
+        assert ch.md5_hexdigest is None
+
+    ch = Chunk(path=path, mode='rb', inline_md5=digest)
+    assert list(ch) == [si]
+    assert ch.hexdigest == expected.hexdigest()
+
+def test_no_digest():
+    ch = Chunk(inline_md5=None)
+    ch.add(make_stream_item('2012-08-08T08:24:23.0Z', 'hi'))
+    assert ch.hexdigest is None
+    assert ch.md5_hexdigest is None
+
+def test_unknown_digest():
+    with pytest.raises(ValueError):
+        Chunk(inline_md5='crc7')
+
+def test_md5_file_strides():
+    _data = ''.join(str(i) for i in range(10000))
+    fh = StringIO(_data)
+    mfh = md5_file(fh)
+    mfh.DIGEST_STRIDE = 100
+    while mfh.read(7):
+        pass
+    assert mfh.md5_hexdigest == hashlib.md5(_data).hexdigest()
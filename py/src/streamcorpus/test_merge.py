@@ -0,0 +1,74 @@
+'''Tests for streamcorpus.merge
+
+.. This software is released under an MIT/X11 open source license.
+   Copyright 2012-2015 Diffeo, Inc.
+'''
+from __future__ import absolute_import
+import os
+import random
+
+import pytest
+
+from streamcorpus import Chunk, ChunkRoller, make_stream_item, serialize
+from streamcorpus.merge import merge, merge_raw, sort_raw, stream_time_key
+from streamcorpus.ttypes import StreamItem
+from streamcorpus._test_util import make_si, write_chunk
+
+
+def write_times(path, times):
+    ## distinct urls, so that messages with the same time differ
+    return write_chunk(path, [
+        make_si(t, url='http://example.com/%s/%d' % (path, num))
+        for num, t in enumerate(times)])
+
+
+def epochs(blobs):
+    return [stream_time_key(blob) for blob in blobs]
+
+
+def test_merge_raw(tmpdir):
+    paths = [write_times(str(tmpdir.join('%d.sc.xz' % i)), range(i, 30, 3))
+             for i in range(3)]
+    assert epochs(merge_raw(paths)) == range(30)
+
+
+def test_merge_raw_ties(tmpdir):
+    paths = [write_times(str(tmpdir.join('%d.sc' % i)), [5, 5]) for i in range(2)]
+    merged = list(merge_raw(paths))
+    expected = [blob for path in paths for blob in Chunk(path=path).iter_raw()]
+    assert merged == expected
+
+
+def test_merge_raw_unsorted(tmpdir):
+    path = write_times(str(tmpdir.join('bad.sc')), [3, 1])
+    with pytest.raises(ValueError):
+        list(merge_raw([path]))
+
+
+def test_stream_time_key_missing():
+    assert stream_time_key(serialize(StreamItem())) == float('-inf')
+    assert stream_time_key(serialize(make_stream_item(7, 'url'))) == 7
+
+
+@pytest.mark.parametrize('run_size,max_open', [(1000, 64), (7, 64), (7, 2)])
+def test_sort_raw(tmpdir, run_size, max_open):
+    times = range(100)
+    random.Random(1).shuffle(times)
+    paths = [write_times(str(tmpdir.join('%d.sc' % i)), times[i::4])
+             for i in range(4)]
+    spill = tmpdir.mkdir('spill')
+    assert epochs(sort_raw(paths, run_size=run_size, max_open=max_open,
+                           tmp_dir=str(spill))) == range(100)
+    ## spill files are removed
+    assert os.listdir(str(spill)) == []
+
+
+def test_merge_to_roller(tmpdir):
+    paths = [write_times(str(tmpdir.join('%d.sc' % i)), [9 - i, i])
+             for i in range(5)]
+    out = tmpdir.mkdir('out')
+    roller = ChunkRoller(str(out), chunk_max=4)
+    assert merge(paths, roller, presorted=False, run_size=3) == 10
+    roller.close()
+    fnames = sorted(os.listdir(str(out)), key=lambda name: int(name.split('-')[0]))
+    assert [int(name.split('-')[0]) for name in fnames] == [2, 4, 4]
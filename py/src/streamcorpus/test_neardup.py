@@ -0,0 +1,83 @@
+'''Tests for streamcorpus.neardup
+
+.. This software is released under an MIT/X11 open source license.
+   Copyright 2012-2015 Diffeo, Inc.
+'''
+from __future__ import absolute_import
+import random
+
+import pytest
+
+from streamcorpus import neardup
+from streamcorpus.neardup import NEAR_DUPLICATE_KEY, NearDuplicateDetector, \
+    near_dedup
+from streamcorpus._test_util import make_si
+
+
+def text(seed, words=300):
+    rand = random.Random(seed)
+    return ' '.join('w%d' % rand.randint(0, 5000) for _ in range(words))
+
+
+def edited(text):
+    ## change one word in the middle
+    words = text.split()
+    words[len(words) // 2] = 'EDITED'
+    return ' '.join(words)
+
+
+@pytest.mark.skipif('neardup.np is None')
+def test_signature_numpy_matches_python(monkeypatch):
+    detector = NearDuplicateDetector()
+    for sample in [text(1), 'two words', 'one', text(2, words=5000)]:
+        sig = detector.signature(sample)
+        monkeypatch.setattr(neardup, 'np', None)
+        assert list(sig) == detector._signature_python(neardup._word_hashes(sample))
+        monkeypatch.undo()
+    assert detector.signature('  ') is None
+
+
+def test_check():
+    detector = NearDuplicateDetector()
+    original = text(1)
+    assert detector.check('a', original) is None
+    assert detector.check('b', text(2)) is None
+    assert detector.check('c', edited(original)) == 'a'
+    assert detector.check('d', original.upper()) == 'a'
+    assert len(detector) == 2
+
+
+def test_max_items():
+    detector = NearDuplicateDetector(max_items=2)
+    for key in range(3):
+        assert detector.check(key, text(key)) is None
+    assert len(detector) == 2
+    ## the first was forgotten
+    assert detector.check('again', text(0)) is None
+    assert detector.check('again2', text(2)) == 2
+    assert all(key in (1, 2, 'again') for bucket in detector._buckets
+               for keys in bucket.values() for key in keys)
+
+
+def test_max_items_keeps_shared_bands():
+    detector = NearDuplicateDetector(threshold=0.75, num_perm=4, bands=2,
+                                     max_items=2)
+    detector.add('a', [1, 2, 3, 4])
+    ## shares the first band with 'a', but is not its near duplicate
+    detector.add('b', [1, 2, 9, 9])
+    ## forgets 'a', and must keep the first band of 'b'
+    detector.add('d', [5, 6, 7, 8])
+    assert detector.find([1, 2, 9, 8]) == 'b'
+
+
+@pytest.mark.parametrize('action', ['drop', 'tag'])
+def test_near_dedup(action):
+    sis = [make_si(0, clean_visible=text(1)), make_si(1, clean_visible=text(2)),
+           make_si(2, clean_visible=edited(text(1))), make_si(3)]
+    out = list(near_dedup(sis, action=action))
+    if action == 'drop':
+        assert out == [sis[0], sis[1], sis[3]]
+    else:
+        assert out == sis
+        assert sis[2].source_metadata[NEAR_DUPLICATE_KEY] == sis[0].stream_id
+        assert NEAR_DUPLICATE_KEY not in sis[1].source_metadata
@@ -0,0 +1,75 @@
+'''Tests for ParallelChunkReader
+
+.. This software is released under an MIT/X11 open source license.
+   Copyright 2012-2015 Diffeo, Inc.
+'''
+from __future__ import absolute_import
+import os
+
+import pytest
+
+from streamcorpus import Chunk, ParallelChunkReader
+from streamcorpus._test_util import make_si
+
+
+def get_stream_id(si):
+    return si.stream_id
+
+
+@pytest.fixture
+def paths(tmpdir):
+    paths = []
+    for num in range(4):
+        path = os.path.join(str(tmpdir), '%d.sc' % num)
+        kwargs = {}
+        if num % 2:
+            path += 'b'
+            kwargs['block_items'] = 3
+        with Chunk(path, mode='wb', **kwargs) as ch:
+            for i in range(num * 10, num * 10 + 10):
+                ch.add(make_si(i))
+        paths.append(path)
+    return paths
+
+
+def expected(paths):
+    sis = []
+    for path in paths:
+        sis.extend(Chunk(path))
+    return sis
+
+
+@pytest.mark.parametrize('blocks_per_task', [None, 2])
+def test_ordered(paths, blocks_per_task):
+    reader = ParallelChunkReader(paths, workers=3, max_in_flight=2,
+                                 blocks_per_task=blocks_per_task)
+    assert list(reader) == expected(paths)
+    assert len(reader) == 40
+    assert reader.counts == dict((path, 10) for path in paths)
+    for path in paths:
+        ch = Chunk(path)
+        list(ch)
+        if blocks_per_task and path.endswith('.scb'):
+            assert reader.block_md5s[path] == ch.block_md5s
+        else:
+            assert reader.md5_hexdigests[path] == ch.md5_hexdigest
+
+
+def test_unordered(paths):
+    reader = ParallelChunkReader(paths, workers=3, ordered=False,
+                                 blocks_per_task=1)
+    stream_ids = [si.stream_id for si in reader]
+    assert sorted(stream_ids) == sorted(si.stream_id for si in expected(paths))
+    assert len(reader) == 40
+
+
+def test_read_wrapper(paths):
+    reader = ParallelChunkReader(paths, workers=2, read_wrapper=get_stream_id)
+    assert list(reader) == [si.stream_id for si in expected(paths)]
+
+
+def test_worker_error(paths, tmpdir):
+    bad_path = os.path.join(str(tmpdir), 'does-not-exist.sc')
+    reader = ParallelChunkReader(paths + [bad_path], workers=2)
+    with pytest.raises(RuntimeError):
+        list(reader)
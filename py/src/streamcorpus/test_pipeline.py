@@ -0,0 +1,227 @@
+'''Tests for ChunkPipeline
+
+.. This software is released under an MIT/X11 open source license.
+   Copyright 2012-2015 Diffeo, Inc.
+'''
+from __future__ import absolute_import
+import os
+from cStringIO import StringIO
+
+import pytest
+
+from streamcorpus import Chunk, make_stream_item, serialize
+from streamcorpus import _chunk
+from streamcorpus._pipeline import BackgroundWriter, ChunkPipeline, \
+    CompressorProcess, FuncStage, ProcessStage, ReadAhead, decompress_stage
+
+DATA = ''.join(str(i) for i in range(200000))
+
+
+def read_all(pipeline, size=1000):
+    parts = []
+    while True:
+        part = pipeline.read(size)
+        if not part:
+            return ''.join(parts)
+        parts.append(part)
+
+
+def test_no_stages():
+    pipeline = ChunkPipeline(StringIO(DATA), [], block_size=1000)
+    assert read_all(pipeline, size=777) == DATA
+    assert pipeline.stats()[0]['bytes_out'] == len(DATA)
+
+
+def test_func_and_process_stages():
+    pipeline = ChunkPipeline(StringIO(DATA), [
+        FuncStage('upper', lambda block: block and block.replace('1', 'a')),
+        ProcessStage('cat', ['cat']),
+    ], block_size=4096, max_blocks=2)
+    assert pipeline.read() == DATA.replace('1', 'a')
+    stats = pipeline.stats()
+    assert [s['name'] for s in stats] == ['read', 'upper', 'cat']
+    assert all(s['bytes_in'] == len(DATA) for s in stats)
+    assert pipeline.stages[2].returncode == 0
+    assert 'cat: ' in pipeline.format_stats()
+
+
+@pytest.mark.skipif('not _chunk.xz')
+def test_decompress_xz():
+    ## two concatenated streams, like `cat a.xz b.xz`
+    cdata = _chunk.xz.compress(DATA[:1000]) + _chunk.xz.compress(DATA[1000:])
+    pipeline = ChunkPipeline(StringIO(cdata), [decompress_stage('xz')],
+                             block_size=100)
+    assert read_all(pipeline) == DATA
+
+    pipeline = ChunkPipeline(StringIO(cdata[:-10]), [decompress_stage('xz')])
+    with pytest.raises(IOError) as excinfo:
+        read_all(pipeline)
+    assert 'decompress' in str(excinfo.value)
+
+
+def test_process_failure():
+    pipeline = ChunkPipeline(StringIO(DATA), [
+        ProcessStage('fail', ['sh', '-c', 'echo oops >&2; exit 3'])])
+    with pytest.raises(IOError) as excinfo:
+        read_all(pipeline)
+    assert 'status 3' in str(excinfo.value)
+    assert 'oops' in str(excinfo.value)
+    assert pipeline.stages[1].returncode == 3
+
+
+def test_close_early():
+    pipeline = ChunkPipeline(StringIO(DATA * 20), [ProcessStage('cat', ['cat'])],
+                             block_size=1000, max_blocks=1)
+    assert pipeline.read(10) == DATA[:10]
+    pipeline.close()
+    assert pipeline.stages[1].returncode is not None
+
+
+@pytest.mark.skipif('not _chunk.xz')
+def test_open_path(tmpdir):
+    sis = [make_stream_item(i, 'http://example.com/%d' % i) for i in range(10)]
+    path = str(tmpdir.join('test.sc.xz'))
+    with open(path, 'wb') as fh:
+        fh.write(_chunk.xz.compress(''.join(map(serialize, sis))))
+    pipeline = ChunkPipeline.open(path)
+    assert [stage.name for stage in pipeline.stages] == ['read', 'decompress']
+    assert list(Chunk(file_obj=pipeline)) == sis
+
+
+@pytest.mark.parametrize('background', ['thread', 'process'])
+def test_background_compression(tmpdir, background, monkeypatch):
+    ## small buffers so that writes reach the background many times
+    monkeypatch.setattr(_chunk, 'WRITE_BUFFER_SIZE', 1000)
+    items = [make_stream_item(i, 'url%d' % i) for i in range(500)]
+
+    plain = Chunk(path=str(tmpdir.join('plain.sc.xz')), mode='wb')
+    plain.add_many(items)
+    plain.close()
+
+    path = str(tmpdir.join('%s.sc.xz' % background))
+    chunk = Chunk(path=path, mode='wb', background_compression=background)
+    for si in items[:250]:
+        chunk.add(si)
+    chunk.add_many(items[250:])
+    chunk.close()
+
+    assert chunk.md5_hexdigest == plain.md5_hexdigest
+    assert list(Chunk(path=path, mode='rb')) == items
+
+
+class _Broken(object):
+    def __init__(self):
+        self.written = []
+        self.closed = False
+
+    def write(self, data):
+        if data == 'b':
+            raise IOError('disk full')
+        self.written.append(data)
+
+    def close(self):
+        self.closed = True
+
+
+def test_background_writer_error():
+    fh = _Broken()
+    writer = BackgroundWriter(fh, max_blocks=1)
+    writer.write('a')
+    writer.write('b')
+    with pytest.raises(IOError):
+        ## the failure surfaces here at the latest
+        writer.flush()
+    ## and again on every later call, without writing past the hole
+    with pytest.raises(IOError):
+        writer.write('c')
+    with pytest.raises(IOError):
+        writer.flush()
+    with pytest.raises(IOError):
+        writer.close()
+    with pytest.raises(IOError):
+        writer.close()
+    assert fh.written == ['a']
+    assert fh.closed
+
+
+def test_compressor_process_failure(tmpdir):
+    fh = open(str(tmpdir.join('out')), 'wb')
+    writer = CompressorProcess(['sh', '-c', 'cat >/dev/null; exit 3'], fh)
+    writer.write(DATA)
+    with pytest.raises(IOError) as exc:
+        writer.close()
+    assert 'status 3' in str(exc.value)
+    assert fh.closed
+
+
+def test_compressor_process_early_exit(tmpdir):
+    fh = open(str(tmpdir.join('out')), 'wb')
+    writer = CompressorProcess(['sh', '-c', 'exit 3'], fh)
+    with pytest.raises(IOError) as exc:
+        for _ in range(1000):
+            writer.write(DATA)
+    assert 'status 3' in str(exc.value)
+    ## the child was reaped on write, and close still closes fh
+    with pytest.raises(IOError):
+        writer.close()
+    assert fh.closed
+
+
+def test_read_ahead():
+    reader = ReadAhead(StringIO(DATA), prefetch_bytes=3000, block_size=1000)
+    assert reader.read(10) == DATA[:10]
+    assert reader.read(2500) == DATA[10:2510]
+    assert reader.tell() == 2510
+    reader.seek(100)
+    assert read_all(reader, size=777) == DATA[100:]
+    stats = reader.stats()
+    assert stats['bytes'] == 10 + 2500 + len(DATA) - 100
+    assert stats['stalls'] >= 1
+    reader.seek(0)
+    assert reader.read() == DATA
+    reader.close()
+
+
+class _Failing(object):
+    def __init__(self):
+        self._reads = 0
+
+    def read(self, size):
+        self._reads += 1
+        if self._reads > 2:
+            raise IOError('stale NFS file handle')
+        return 'x' * size
+
+    def close(self):
+        pass
+
+
+def test_read_ahead_error():
+    reader = ReadAhead(_Failing(), block_size=10)
+    with pytest.raises(IOError):
+        read_all(reader, size=5)
+    ## no seek on the underlying file
+    with pytest.raises(IOError):
+        reader.seek(3)
+
+
+@pytest.mark.parametrize('ext,library', [('sc', True), ('sc.xz', True), ('sc.xz', False)])
+def test_chunk_prefetch(tmpdir, ext, library, monkeypatch):
+    items = [make_stream_item(i, 'url%d' % i) for i in range(100)]
+    path = str(tmpdir.join('test.' + ext))
+    if ext.endswith('xz') and not _chunk.codecs['xz'].has_command:
+        pytest.skip('xz is not installed')
+    with Chunk(path=path, mode='wb') as chunk:
+        chunk.add_many(items)
+    if not library:
+        ## decompress in an xz child fed from the ReadAhead
+        monkeypatch.setattr(_chunk.codecs['xz'], 'library', None)
+    chunk = Chunk(path=path, mode='rb', prefetch_bytes=True)
+    assert chunk.read_ahead.prefetch_bytes == _chunk.PREFETCH_BYTES
+    assert list(chunk) == items
+    assert chunk.read_ahead.stats()['bytes'] == os.path.getsize(path)
+    if ext == 'sc':
+        ## iterating again seeks back to the start
+        assert list(chunk) == items
+    chunk.close()
+    assert chunk.read_ahead is None
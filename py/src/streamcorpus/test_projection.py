@@ -0,0 +1,86 @@
+'''Tests for decoding StreamItems with field projection
+
+.. This software is released under an MIT/X11 open source license.
+   Copyright 2012-2015 Diffeo, Inc.
+'''
+from __future__ import absolute_import
+import os
+
+import pytest
+from thrift.transport import TTransport
+from thrift.protocol.TBinaryProtocol import TBinaryProtocol
+
+from streamcorpus import Chunk, StreamItem_v0_2_0, make_stream_item, \
+    ContentItem, Sentence, Token, serialize
+from streamcorpus._chunk import decrypt_and_uncompress
+from streamcorpus._projection import project_spec, read_projected
+
+TEST_XZ_PATH = os.path.join(os.path.dirname(__file__), '../../../test-data/john-smith-tagged-by-lingpipe-0-v0_2_0.sc.xz')
+
+
+def make_si():
+    si = make_stream_item(10, 'http://example.com')
+    si.source = 'news'
+    si.body = ContentItem(raw='raw!', clean_visible='visible!',
+                          sentences={'tagger': [Sentence(tokens=[Token(token='hi')])]})
+    si.other_content['title'] = ContentItem(raw='title raw', clean_visible='title')
+    return si
+
+
+def test_project_spec():
+    si = make_si()
+    spec = project_spec(type(si), ['stream_id', 'body.clean_visible'])
+    names = [field[2] for field in spec if field is not None]
+    assert names == ['version', 'body', 'stream_id']
+    body_spec = [field for field in spec if field and field[2] == 'body'][0][3][1]
+    assert [field[2] for field in body_spec if field is not None] == ['clean_visible']
+
+
+def test_project_spec_unknown_field():
+    si = make_si()
+    with pytest.raises(ValueError):
+        project_spec(type(si), ['no_such_field'])
+    with pytest.raises(ValueError):
+        project_spec(type(si), ['stream_id.foo'])
+
+
+@pytest.mark.parametrize('accelerated', [True, False])
+def test_read_projected(accelerated):
+    si = make_si()
+    fields = ['stream_id', 'body.clean_visible', 'other_content.clean_visible']
+    spec = project_spec(type(si), fields)
+    if accelerated:
+        ch = Chunk(data=serialize(si), fields=fields)
+        si2 = list(ch)[0]
+    else:
+        si2 = type(si)()
+        iprot = TBinaryProtocol(TTransport.TMemoryBuffer(serialize(si)))
+        read_projected(si2, iprot, spec)
+    assert si2.stream_id == si.stream_id
+    assert si2.version == si.version
+    assert si2.body.clean_visible == 'visible!'
+    assert si2.body.raw is None
+    assert si2.body.sentences == {}
+    assert si2.source is None
+    assert si2.stream_time is None
+    assert si2.other_content['title'].clean_visible == 'title'
+    assert si2.other_content['title'].raw is None
+
+
+def test_whole_field_wins():
+    si = make_si()
+    ch = Chunk(data=serialize(si), fields=['body.raw', 'body'])
+    assert list(ch)[0].body == si.body
+
+
+def test_projected_chunk():
+    errors, data = decrypt_and_uncompress(open(TEST_XZ_PATH).read())
+    full = list(Chunk(data=data, message=StreamItem_v0_2_0))
+    projected = list(Chunk(data=data, message=StreamItem_v0_2_0,
+                           fields=['stream_id', 'body.clean_visible']))
+    assert len(projected) == len(full) == 197
+    for si, si2 in zip(full, projected):
+        assert si2.stream_id == si.stream_id
+        assert si2.body.clean_visible == si.body.clean_visible
+        assert si2.body.raw is None
+        assert not si2.body.sentences
@@ -0,0 +1,89 @@
+'''Tests for scanning serialized messages without decoding them
+
+.. This software is released under an MIT/X11 open source license.
+   Copyright 2012-2015 Diffeo, Inc.
+'''
+from __future__ import absolute_import
+import hashlib
+import os
+from cStringIO import StringIO
+
+import pytest
+
+from streamcorpus import Chunk, ChunkRoller, StreamItem_v0_2_0, \
+    serialize, deserialize, iter_raw_messages, count_raw_messages
+from streamcorpus._chunk import decrypt_and_uncompress
+from streamcorpus import _raw_messages
+from streamcorpus._test_util import make_si
+
+TEST_XZ_PATH = os.path.join(os.path.dirname(__file__), '../../../test-data/john-smith-tagged-by-lingpipe-0-v0_2_0.sc.xz')
+
+
+@pytest.fixture(scope='module')
+def data():
+    errors, data = decrypt_and_uncompress(open(TEST_XZ_PATH).read())
+    return data
+
+
+@pytest.fixture(params=['fastbinary', 'python'])
+def walker(request, monkeypatch):
+    if request.param == 'python':
+        monkeypatch.setattr(_raw_messages, 'fastbinary', None)
+    elif _raw_messages.fastbinary is None:
+        pytest.skip('fastbinary is not available')
+
+
+@pytest.mark.parametrize('block_size', [2**20, 1000, 1])
+def test_iter_raw_messages(data, block_size, walker):
+    blobs = list(iter_raw_messages(StringIO(data), block_size=block_size))
+    assert len(blobs) == 197
+    assert ''.join(blobs) == data
+    sis = list(Chunk(data=data, message=StreamItem_v0_2_0))
+    for si, blob in zip(sis, blobs):
+        assert deserialize(blob, message=StreamItem_v0_2_0) == si
+
+
+def test_count_raw_messages(data):
+    assert count_raw_messages(StringIO(data)) == 197
+    assert count_raw_messages(StringIO('')) == 0
+
+
+def test_truncated(data, walker):
+    blobs = list(iter_raw_messages(StringIO(data[:-10])))
+    assert len(blobs) == 196
+
+
+def test_add_raw(data, tmpdir):
+    path = os.path.join(str(tmpdir), 'copy.sc')
+    ichunk = Chunk(data=data, message=StreamItem_v0_2_0)
+    with Chunk(path, mode='wb', message=StreamItem_v0_2_0, index=True) as ochunk:
+        for blob in ichunk.iter_raw():
+            ochunk.add_raw(blob)
+    assert len(ichunk) == len(ochunk) == 197
+    assert open(path, 'rb').read() == data
+    assert ochunk.md5_hexdigest == ichunk.md5_hexdigest == hashlib.md5(data).hexdigest()
+    ## index entries are decoded from the raw bytes
+    sis = list(Chunk(path, message=StreamItem_v0_2_0))
+    assert Chunk(path, message=StreamItem_v0_2_0).get(sis[100].stream_id) == sis[100]
+
+
+def test_block_chunk_raw(tmpdir):
+    sis = [make_si(i) for i in range(12)]
+    path = os.path.join(str(tmpdir), 'test.scb')
+    with Chunk(path, mode='wb', block_items=5) as ch:
+        for si in sis:
+            ch.add_raw(serialize(si))
+    ch = Chunk(path)
+    assert [b.first_stream_id for b in ch.blocks] == \
+        [sis[0].stream_id, sis[5].stream_id, sis[10].stream_id]
+    assert list(ch.iter_raw()) == map(serialize, sis)
+    assert list(ch) == sis
+
+
+def test_chunk_roller_add_raw(tmpdir):
+    cr = ChunkRoller(str(tmpdir), chunk_max=5)
+    for i in range(7):
+        cr.add_raw(serialize(make_si(i)))
+    cr.close()
+    counts = sorted(int(fname.split('-')[0]) for fname in os.listdir(str(tmpdir)))
+    assert counts == [2, 5]
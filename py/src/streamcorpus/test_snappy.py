@@ -0,0 +1,74 @@
+'''Tests for the snappy framing format
+
+.. This software is released under an MIT/X11 open source license.
+   Copyright 2012-2015 Diffeo, Inc.
+'''
+from __future__ import absolute_import
+import struct
+
+import pytest
+
+from streamcorpus import _snappy
+from streamcorpus._chunk import snappy_decompress
+from streamcorpus._snappy import STREAM_IDENTIFIER, FrameCompressor, \
+    FrameDecompressor, crc32c, crc32c_python, masked_crc32c
+
+DATA = ''.join(str(i) for i in range(100000))
+
+
+def chunk(chunk_type, body):
+    return struct.pack('<I', chunk_type | len(body) << 8) + body
+
+
+def uncompressed(data):
+    return chunk(0x01, struct.pack('<I', masked_crc32c(data)) + data)
+
+
+def decompress_all(stream, step=None):
+    decompressor = FrameDecompressor()
+    if step is None:
+        out = decompressor.decompress(stream)
+    else:
+        out = ''.join(decompressor.decompress(stream[i:i + step])
+                      for i in range(0, len(stream), step))
+    return out + decompressor.flush()
+
+
+@pytest.mark.parametrize('func', [crc32c, crc32c_python])
+def test_crc32c(func):
+    ## the check value of CRC-32C
+    assert func('123456789') == 0xe3069283
+
+
+def test_uncompressed_chunks():
+    stream = (STREAM_IDENTIFIER + uncompressed('hello ') +
+              chunk(0xfe, '\x00' * 10) + chunk(0x80, 'skip me') +
+              STREAM_IDENTIFIER + uncompressed('world'))
+    assert decompress_all(stream) == 'hello world'
+    assert decompress_all(stream, step=1) == 'hello world'
+    assert decompress_all(memoryview(stream)) == 'hello world'
+    ## without python-snappy too
+    assert snappy_decompress(stream) == 'hello world'
+
+
+@pytest.mark.parametrize('stream,error', [
+    (uncompressed('no identifier'), IOError),
+    (STREAM_IDENTIFIER + uncompressed('ok')[:-1] + 'x', IOError),
+    (STREAM_IDENTIFIER + chunk(0x02, 'reserved'), IOError),
+    (STREAM_IDENTIFIER + uncompressed('cut short')[:-3], EOFError),
+])
+def test_bad_streams(stream, error):
+    with pytest.raises(error):
+        decompress_all(stream)
+
+
+@pytest.mark.skipif('not _snappy.sz')
+def test_round_trip():
+    compressor = FrameCompressor()
+    stream = (compressor.compress(DATA) + compressor.compress(memoryview(DATA)) +
+              compressor.flush())
+    assert stream.startswith(STREAM_IDENTIFIER)
+    assert len(stream) < len(DATA)
+    assert decompress_all(stream, step=1000) == DATA + DATA
+    ## python-snappy reads the same format
+    assert _snappy.sz.StreamDecompressor().decompress(stream) == DATA + DATA
@@ -1,4 +1,6 @@
 import os
+import subprocess
+import sys
 import time
 
 ## this is a python thing that makes a byte-buffer look like a filehandle
@@ -155,6 +157,60 @@ def test_serialize_deserialize():
     _test_deserialize(string_of_data, num_objects=100)
 
 
+## reads the chunk at argv[2] in the way named by argv[1], and prints
+## the peak RSS of the process in kilobytes.  ru_maxrss can include
+## the memory of the parent before exec, so prefer VmHWM on linux.
+_PEAK_RSS_READER = '''
+import os, resource, sys
+def peak_rss():
+    if os.path.exists('/proc/self/status'):
+        for line in open('/proc/self/status'):
+            if line.startswith('VmHWM:'):
+                return int(line.split()[1])
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+from streamcorpus import Chunk, decrypt_and_uncompress
+how, path = sys.argv[1:]
+if how == 'path':
+    chunk = Chunk(path)
+elif how == 'data':
+    chunk = Chunk(data=open(path).read())
+else:
+    errors, data = decrypt_and_uncompress(open(path).read())
+    chunk = Chunk(data=data)
+count = 0
+for si in chunk:
+    count += 1
+print count, peak_rss()
+'''
+
+def test_xz_peak_rss(tmpdir):
+    from streamcorpus import Chunk, make_stream_item, ContentItem
+    from streamcorpus import _chunk
+    if _chunk.xz is None:
+        return
+    path = str(tmpdir.join('big.sc'))
+    with Chunk(path, mode='wb') as chunk:
+        for i in range(400):
+            si = make_stream_item(i, 'http://example.com/%d' % i)
+            si.body = ContentItem(raw=os.urandom(50000).encode('hex'))
+            chunk.add(si)
+    with open(path + '.xz', 'wb') as fh:
+        fh.write(_chunk.xz.compress(open(path).read(), preset=0))
+
+    env = dict(os.environ, PYTHONPATH=os.path.dirname(os.path.dirname(
+        os.path.abspath(__file__))))
+    peak = {}
+    for how in ['path', 'data', 'decrypt_and_uncompress']:
+        out = subprocess.check_output(
+            [sys.executable, '-c', _PEAK_RSS_READER, how, path + '.xz'], env=env)
+        count, peak[how] = map(int, out.split())
+        assert count == 400
+        print '%s: peak RSS %d KB reading %d bytes' % (how, peak[how], os.path.getsize(path))
+    ## streaming never holds the whole decompressed chunk; the other
+    ## peaks are only printed, since they depend on the allocator
+    assert peak['path'] * 1024 < os.path.getsize(path)
+
+
 if __name__ == '__main__':
     import argparse
     parser = argparse.ArgumentParser()
@@ -0,0 +1,70 @@
+#!/usr/bin/env python
+'''Train a zstandard dictionary on the messages in sample chunks.
+
+.. This software is released under an MIT/X11 open source license.
+   Copyright 2012-2015 Diffeo, Inc.
+
+:program:`streamcorpus_zstd_dictionary` writes a dictionary trained on
+the serialized messages in some chunks, for compressing small chunks
+and single messages with :class:`streamcorpus.ZstdCodec`.  Basic
+usage is:
+
+.. code-block:: bash
+
+    streamcorpus_zstd_dictionary --output news.dict sample-*.sc.xz
+
+Readers need the same dictionary, loaded with
+:func:`streamcorpus.load_dictionary`, and find it by the id that each
+compressed frame carries.
+
+'''
+from __future__ import absolute_import
+import logging
+
+from streamcorpus._chunk import Chunk
+from streamcorpus._codecs import DICTIONARY_SIZE, train_dictionary
+
+logger = logging.getLogger('streamcorpus')
+
+
+def iter_samples(paths, max_samples=None):
+    '''yield the serialized messages in the chunks at `paths`, at most
+    `max_samples` of them
+    '''
+    count = 0
+    for path in paths:
+        for blob in Chunk(path=path, mode='rb').iter_raw():
+            if max_samples is not None and count >= max_samples:
+                return
+            count += 1
+            yield blob
+
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser(
+        description='train a zstd dictionary on the messages in chunks')
+    parser.add_argument('input_path', nargs='+', help='paths to sample chunks')
+    parser.add_argument('--output', required=True,
+                        help='path to which to write the dictionary')
+    parser.add_argument('--size', type=int, default=DICTIONARY_SIZE,
+                        help='largest size of the dictionary in bytes')
+    parser.add_argument('--max-samples', type=int, default=100000,
+                        help='train on at most this many messages')
+    parser.add_argument('--level', type=int, default=None,
+                        help='zstd level at which the dictionary will be used')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+
+    samples = list(iter_samples(args.input_path, args.max_samples))
+    dictionary = train_dictionary(samples, size=args.size, level=args.level)
+    data = dictionary.as_bytes()
+    with open(args.output, 'wb') as fh:
+        fh.write(data)
+    logger.info('wrote dictionary %d of %d bytes, trained on %d messages, to %s',
+                dictionary.dict_id(), len(data), len(samples), args.output)
+
+
+if __name__ == '__main__':
+    main()